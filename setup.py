@@ -25,7 +25,7 @@ setup(
     scripts = glob.glob('bin/*'),
     install_requires = (
         'seine>=3.0.2',
-        'systematic>=4.2.6',
+        'systematic>=4.4.8,<4.7',
     ),
 )
 
@@ -0,0 +1,18 @@
+"""
+Unit tests for ultimatum
+
+Run with python -m unittest test
+"""
+
+from test.benchmark import BenchmarkTests, SnapshotBenchmarkTests, RecordsBenchmarkTests, AuthBenchmarkTests
+from test.test_auth import AuthLogReaderTests, SSHMessageClassifierTests, SSHSessionCacheTests, LogCheckpointTests
+from test.test_auth import SSHViolationsDatabaseTests
+from test.test_filesystems import MountParserTests, DFUsageTests, MountPointsTests
+from test.test_follow import AddressCountersTests, SSHViolationsFollowerTests
+from test.test_netblocks import NetblockParserTests, LRUCacheTests, NetblockIndexTests
+from test.test_replication import ReplicationStreamTests
+from test.test_resolver import WhoisResolverTests
+from test.test_runner import ReplayRunnerTests, RecordingRunnerTests
+from test.test_sysctl import SysCtlParserTests, SysCtlDecoderTests, SysCtlTreeTests, SysCtlSamplerTests
+from test.test_zfs import ParseTagEpochTests, ZFSSnapshotListTests, ZFSSnapshotIndexTests
+from test.test_zfs import PropertyCacheTests, CreateSnapshotsTests, DatasetNamesTests, ZFSCommandTests, ReplicationOrderTests
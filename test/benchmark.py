@@ -0,0 +1,527 @@
+"""
+Benchmarks with synthetic data
+
+Runs the workflows of bin/zfs-snapshots against synthetic pools with
+ReplayRunner and reports number of started commands and wall time, and
+measures memory use and sort time of snapshot records, memory use of
+reading zfs output and sshd message classification rate. Run with
+
+    python -m test.benchmark workflows [--latency seconds] [datasets ...]
+    python -m test.benchmark snapshots [snapshots ...]
+    python -m test.benchmark records [rows ...]
+    python -m test.benchmark auth [lines ...]
+"""
+
+import argparse
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from multiprocessing import Pool
+
+from ultimatum.logformats.auth import SSH_MESSAGES, SSH_FAILURE_KINDS
+from ultimatum.runner import CommandRunner, ReplayRunner, set_runner
+from ultimatum.zfs import execute, iter_execute, ZFSError, SNAPSHOT_DATE_FORMAT
+from ultimatum.zfs.snapshots import ZFSSnapshot
+from ultimatum.zfs.zpool import ZPool
+
+from test.fixtures import zfs_fixtures
+
+BENCHMARK_DATASETS = ( 10, 1000, 10000, )
+BENCHMARK_SNAPSHOTS = ( 1000, 10000, 100000, )
+BENCHMARK_ROWS = ( 100000, 1000000, 5000000, )
+BENCHMARK_AUTH_LINES = ( 1000000, )
+
+# Synthetic snapshots per dataset in snapshot benchmark
+SNAPSHOTS_PER_DATASET = 100
+
+# Simulated process startup latency in seconds
+BENCHMARK_LATENCY = 0.0
+
+BENCHMARK_TAG = '20170101-000000'
+
+def list_snapshots(source, backup):
+    """List workflow
+
+    List snapshots of all filesystems in both pools like zfs-snapshots list
+
+    """
+    snapshots = []
+    for pool in ( source, backup ):
+        if not pool.is_available:
+            continue
+        for fs in pool.iter_filesystems():
+            snapshots.extend(fs.snapshots)
+    return snapshots
+
+def create_snapshots(source, backup):
+    """Create workflow
+
+    Create tagged snapshots of all filesystems in batches like zfs-snapshots
+    create
+
+    """
+    filesystems = [fs for fs in source.filesystems if BENCHMARK_TAG not in fs.snapshots]
+    return source.create_snapshots(BENCHMARK_TAG, mode='batch', filesystems=filesystems)
+
+def prepare_clone(source, backup):
+    """Clone workflow
+
+    Prepare replications of all filesystems to backup pool like zfs-snapshots
+    clone, without streaming
+
+    """
+    if not backup.is_available:
+        return []
+    replications = []
+    for fs in source.filesystems:
+        if fs.get_property('mountpoint') is None:
+            continue
+        if BENCHMARK_TAG in fs.snapshots:
+            continue
+        replications.append(fs.replication(backup, tag=BENCHMARK_TAG))
+    return replications
+
+WORKFLOWS = (
+    ( 'list', list_snapshots ),
+    ( 'create', create_snapshots ),
+    ( 'clone', prepare_clone ),
+)
+
+def run_workflow(workflow, datasets, latency=BENCHMARK_LATENCY):
+    """Run workflow
+
+    Run workflow against synthetic pools with given number of datasets and
+    return tuple (commands, seconds)
+
+    """
+    runner = ReplayRunner(zfs_fixtures(datasets, create_tag=BENCHMARK_TAG), latency)
+    previous = set_runner(runner)
+    try:
+        started = time.time()
+        workflow(ZPool('tank'), ZPool('backups'))
+        return runner.count, time.time() - started
+    finally:
+        set_runner(previous)
+
+
+def records_size(records):
+    """Size of records
+
+    Return bytes used by records, their attribute dictionaries and attribute
+    values. Values shared by records, like interned strings, are counted once.
+
+    """
+    seen = set()
+    size = 0
+    for record in records:
+        values = [record]
+        if hasattr(record, '__dict__'):
+            values.extend([record.__dict__] + record.__dict__.values())
+        for attr in getattr(type(record), '__slots__', ()):
+            values.append(getattr(record, attr))
+        for value in values:
+            if id(value) not in seen:
+                seen.add(id(value))
+                size += sys.getsizeof(value)
+    return size
+
+
+class LegacyZFSSnapshot(list):
+    """Legacy snapshot record
+
+    Snapshot record as it was before tags were parsed once per snapshot: a
+    list subclass with attribute dictionary, parsing both tags with strptime
+    on every comparison. Used as baseline in the snapshot benchmark.
+
+    The list base class compares all records equal with <, so __lt__ is
+    defined here to sort by __cmp__ as the legacy code was meant to.
+
+    """
+    def __init__(self, name):
+        self.name = name
+        try:
+            self.volume, self.tag = name.split('@')
+        except ValueError:
+            raise ZFSError('Invalid snapshot name: %s' % name)
+
+    def __cmp__(self, other):
+        if self.volume != other.volume:
+            return cmp(self.volume, other.volume)
+        try:
+            my_date = time.strptime(self.tag, SNAPSHOT_DATE_FORMAT)
+            other_date = time.strptime(other.tag, SNAPSHOT_DATE_FORMAT)
+            return cmp(my_date, other_date)
+        except ValueError:
+            pass
+        return cmp(self.tag, other.tag)
+
+    def __lt__(self, other):
+        return self.__cmp__(other) < 0
+
+    def __eq__(self, other):
+        return self.__cmp__(other) == 0
+
+    def __ne__(self, other):
+        return self.__cmp__(other) != 0
+
+    def __repr__(self):
+        return '%s@%s' % (self.volume, self.tag)
+
+SNAPSHOT_CLASSES = (
+    ( 'legacy', LegacyZFSSnapshot ),
+    ( 'current', ZFSSnapshot ),
+)
+
+def snapshot_names(count, seed=0):
+    """Snapshot names
+
+    Return count snapshot names with hourly tags for datasets with
+    SNAPSHOTS_PER_DATASET snapshots each, in random order
+
+    """
+    started = int(time.mktime((2017, 1, 1, 0, 0, 0, 0, 0, -1)))
+    names = [
+        'tank/group%d@%s' % (
+            i // SNAPSHOTS_PER_DATASET,
+            time.strftime(SNAPSHOT_DATE_FORMAT, time.localtime(started + (i % SNAPSHOTS_PER_DATASET) * 3600)),
+        )
+        for i in range(count)
+    ]
+    random.Random(seed).shuffle(names)
+    return names
+
+def run_snapshots(snapshot_class, count):
+    """Run snapshot benchmark
+
+    Create count snapshot records of snapshot_class and return tuple
+    (bytes, seconds) with memory used by the records and time spent sorting
+    them
+
+    """
+    snapshots = [snapshot_class(name) for name in snapshot_names(count)]
+    started = time.time()
+    snapshots.sort()
+    return records_size(snapshots), time.time() - started
+
+
+class FakeZFSRunner(CommandRunner):
+    """Fake zfs command runner
+
+    Runs awk in place of any command, writing rows of zfs list -Hp snapshot
+    output
+
+    """
+    def __init__(self, rows):
+        CommandRunner.__init__(self)
+        self.rows = rows
+
+    def popen(self, cmd, stdin=None, stdout=None, stderr=None, close_fds=False):
+        script = 'BEGIN { for (i = 0; i < %d; i++) ' \
+            'printf "tank/group%%d/fs%%d@%s\\t%%d\\t0\\t4096\\t%%d\\n", i / 10000, i %% 100, 1483228800 + i, i }' % (
+            self.rows, BENCHMARK_TAG
+        )
+        return CommandRunner.popen(self, ['awk', script], stdin, stdout, stderr, close_fds)
+
+def read_execute(rows):
+    return len([line.split('\t') for line in execute('zfs list -Hp -t snapshot')])
+
+def read_iter_execute(rows):
+    return sum(1 for record in iter_execute('zfs list -Hp -t snapshot'))
+
+READERS = (
+    ( 'execute', read_execute ),
+    ( 'iter', read_iter_execute ),
+)
+
+def measure_records_worker(reader, rows):
+    previous = set_runner(FakeZFSRunner(rows))
+    try:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.time()
+        count = reader(rows)
+        seconds = time.time() - started
+        return count, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before, seconds
+    finally:
+        set_runner(previous)
+
+def run_records(reader, rows):
+    """Run records benchmark
+
+    Read rows of fake zfs output with reader in a child process and return
+    tuple (records, kilobytes, seconds) with number of records read, growth
+    of maximum resident set size of the child as reported by getrusage and
+    time spent reading
+
+    """
+    pool = Pool(1)
+    try:
+        return pool.apply(measure_records_worker, (reader, rows))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# sshd message regexps matched by auth log parsing before messages were
+# classified once by SSH_MESSAGES
+LEGACY_SSH_LOGINS = [
+    re.compile('^Accepted publickey for (?P<user>[^\s]+) from (?P<address>.*) ' +
+        'port (?P<port>\d+) (?P<sshversion>.*): (?P<keytype>.*) (?P<key>.*)$'
+    ),
+]
+LEGACY_SSH_ATTEMPTS = [
+    re.compile('^Invalid user (?P<user>[^\s]+) from (?P<address>.*)'),
+    re.compile('^Failed publickey for (?P<user>[^\s]+) from (?P<address>.*) ' +
+        'port (?P<port>\d+) (?P<sshversion>.*) (?P<keytype>.*) (?P<fingerprint>.*)$'
+    ),
+    re.compile('^error: Received disconnect from (?P<address>[^:+]):.*: Auth fail [preauth]'),
+]
+LEGACY_SSH_SESSION = [
+    re.compile('^Connection from (?P<address>[^\s]+) port (?P<port>\d+)$'),
+    re.compile('^Accepted publickey for (?P<username>[^\s]+) from (?P<address>[^\s]+) port (?P<port>\d+) ' +
+        '(?P<version>[^:]+): (?P<keytype>[^\s]+) (?P<fingerprint>.*)'
+    ),
+    re.compile('User child is on pid (?P<pid>\d+)$'),
+    re.compile('Received disconnect from (?P<address>[^\s]+): .*: disconnected by user'),
+    re.compile('^Invalid user (?P<username>.*) from (?P<address>[^\s]+)$'),
+]
+
+AUTH_LOG_MESSAGES = (
+    ( 'sshd', 'Connection from %(address)s port %(port)d' ),
+    ( 'sshd', 'Invalid user %(user)s from %(address)s' ),
+    ( 'sshd', 'Failed publickey for %(user)s from %(address)s port %(port)d ssh2: RSA SHA256:%(key)s' ),
+    ( 'sshd', 'Received disconnect from %(address)s: 11: Bye Bye [preauth]' ),
+    ( 'sshd', 'Connection closed by %(address)s [preauth]' ),
+    ( 'sshd', 'Accepted publickey for %(user)s from %(address)s port %(port)d ssh2: RSA SHA256:%(key)s' ),
+    ( 'sshd', 'User child is on pid %(pid)d' ),
+    ( 'sshd', 'Received disconnect from %(address)s: 11: disconnected by user' ),
+    ( 'sshd', 'fatal: Read from socket failed: Connection reset by peer [preauth]' ),
+    ( 'sshd', 'pam_unix(sshd:session): session opened for user %(user)s by (uid=0)' ),
+    ( 'cron', '(root) CMD (/usr/libexec/atrun)' ),
+    ( 'sudo', '%(user)s : TTY=pts/0 ; PWD=/home/%(user)s ; USER=root ; COMMAND=/usr/bin/id' ),
+    ( 'su', '%(user)s to root on /dev/pts/0' ),
+    ( 'login', 'login on ttyv0 as %(user)s' ),
+)
+
+def auth_log_lines(count, seed=0):
+    """Auth log lines
+
+    Yield count syslog lines with sshd messages of AUTH_LOG_MESSAGES for
+    about 60% of lines and messages of other programs for the rest
+
+    """
+    generator = random.Random(seed)
+    sshd = [x for x in AUTH_LOG_MESSAGES if x[0] == 'sshd']
+    other = [x for x in AUTH_LOG_MESSAGES if x[0] != 'sshd']
+    for i in range(count):
+        program, message = generator.choice(generator.random() < 0.6 and sshd or other)
+        pid = generator.randint(1000, 99999)
+        yield 'Jan %2d %02d:%02d:%02d host %s[%d]: %s\n' % (
+            i // 86400 % 28 + 1, i // 3600 % 24, i // 60 % 60, i % 60, program, pid, message % {
+                'address': '10.%d.%d.%d' % (generator.randint(0, 255), generator.randint(0, 255), generator.randint(1, 254)),
+                'port': generator.randint(1024, 65535),
+                'user': generator.choice(( 'root', 'admin', 'oracle', 'hile', 'test' )),
+                'key': '%032x' % generator.getrandbits(128),
+                'pid': pid + 1,
+            }
+        )
+
+def parse_syslog_message(line):
+    """Syslog message
+
+    Return tuple (program, message) for a syslog line
+
+    """
+    source, message = line.rstrip('\n').split(': ', 1)
+    return source.rsplit(' ', 1)[1].split('[', 1)[0], message
+
+def legacy_match(program, message):
+    """Legacy sshd message matching
+
+    Match message like auth log parsing did before SSH_MESSAGES: sshd
+    messages with session regexps and all messages with failure and login
+    regexps. Returns 'failure', 'login' or None.
+
+    """
+    if program == 'sshd':
+        for regexp in LEGACY_SSH_SESSION:
+            if regexp.match(message):
+                break
+    result = None
+    for regexp in LEGACY_SSH_ATTEMPTS:
+        if regexp.match(message):
+            result = 'failure'
+            break
+    for regexp in LEGACY_SSH_LOGINS:
+        if regexp.match(message):
+            result = 'login'
+            break
+    return result
+
+def current_match(program, message):
+    """Current sshd message matching
+
+    Classify message once with SSH_MESSAGES. Returns 'failure', 'login' or
+    None.
+
+    """
+    kind, fields = SSH_MESSAGES.classify(message)
+    if kind in SSH_FAILURE_KINDS:
+        return 'failure'
+    if kind == 'accepted_publickey':
+        return 'login'
+    return None
+
+MATCHERS = (
+    ( 'legacy', legacy_match ),
+    ( 'current', current_match ),
+)
+
+def run_auth(matchers, lines):
+    """Run auth benchmark
+
+    Write synthetic auth log with given number of lines and match the
+    messages of each line with each matcher. Returns list of tuples
+    (lines per second, failures, logins) in same order as matchers.
+
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'auth.log')
+        with open(path, 'w') as fd:
+            fd.writelines(auth_log_lines(lines))
+
+        results = []
+        for matcher in matchers:
+            found = {'failure': 0, 'login': 0, None: 0}
+            with open(path, 'r') as fd:
+                started = time.time()
+                for line in fd:
+                    found[matcher(*parse_syslog_message(line))] += 1
+                seconds = time.time() - started
+            results.append((lines / seconds, found['failure'], found['login']))
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+class BenchmarkTests(unittest.TestCase):
+    """Command counts of workflows
+
+    Commands started by workflows must not depend on pool size, except for
+    one snapshot per replication prepared by clone
+
+    """
+    def test_list(self):
+        self.assertEqual(run_workflow(list_snapshots, 10)[0], run_workflow(list_snapshots, 500)[0])
+
+    def test_create(self):
+        self.assertEqual(run_workflow(create_snapshots, 10)[0], run_workflow(create_snapshots, 200)[0])
+
+    def test_clone(self):
+        small = run_workflow(prepare_clone, 10)[0]
+        large = run_workflow(prepare_clone, 500)[0]
+        self.assertEqual(large - small, 490)
+
+
+class SnapshotBenchmarkTests(unittest.TestCase):
+    """Snapshot records
+
+    Snapshot records sort like legacy records and use less memory
+
+    """
+    def test_sort(self):
+        names = snapshot_names(1000)
+        self.assertEqual(
+            [repr(x) for x in sorted(ZFSSnapshot(name) for name in names)],
+            [repr(x) for x in sorted(LegacyZFSSnapshot(name) for name in names)]
+        )
+
+    def test_memory(self):
+        self.assertTrue(run_snapshots(ZFSSnapshot, 1000)[0] < run_snapshots(LegacyZFSSnapshot, 1000)[0] / 2)
+
+
+class RecordsBenchmarkTests(unittest.TestCase):
+    """Reading zfs output
+
+    Memory used by iterating output does not grow with number of rows
+
+    """
+    def test_records(self):
+        self.assertEqual(run_records(read_iter_execute, 1000)[0], 1000)
+        self.assertEqual(run_records(read_execute, 1000)[0], 1000)
+
+    def test_memory(self):
+        self.assertTrue(run_records(read_iter_execute, 200000)[1] < run_records(read_execute, 200000)[1] / 4)
+
+
+class AuthBenchmarkTests(unittest.TestCase):
+    """Auth log matching
+
+    Current classification finds same failures and logins as legacy regexps
+
+    """
+    def test_matches(self):
+        legacy, current = run_auth([legacy_match, current_match], 10000)
+        self.assertEqual(legacy[1:], current[1:])
+        self.assertTrue(current[1] > 0 and current[2] > 0)
+
+
+def benchmark_workflows(args):
+    print '%-8s %8s %8s %10s' % ('workflow', 'datasets', 'commands', 'seconds')
+    for datasets in args.datasets:
+        for name, workflow in WORKFLOWS:
+            commands, seconds = run_workflow(workflow, datasets, args.latency)
+            print '%-8s %8d %8d %10.3f' % (name, datasets, commands, seconds)
+
+def benchmark_snapshots(args):
+    print '%-8s %10s %10s %10s' % ('records', 'snapshots', 'memory KB', 'sort secs')
+    for count in args.snapshots:
+        for name, snapshot_class in SNAPSHOT_CLASSES:
+            size, seconds = run_snapshots(snapshot_class, count)
+            print '%-8s %10d %10d %10.3f' % (name, count, size / 1024, seconds)
+
+def benchmark_records(args):
+    print '%-8s %10s %10s %10s' % ('reader', 'rows', 'memory KB', 'seconds')
+    for rows in args.rows:
+        for name, reader in READERS:
+            count, memory, seconds = run_records(reader, rows)
+            print '%-8s %10d %10d %10.3f' % (name, count, memory, seconds)
+
+def benchmark_auth(args):
+    print '%-8s %10s %10s %10s %10s' % ('matcher', 'lines', 'lines/sec', 'failures', 'logins')
+    for lines in args.lines:
+        results = run_auth([matcher for name, matcher in MATCHERS], lines)
+        for (name, matcher), (rate, failures, logins) in zip(MATCHERS, results):
+            print '%-8s %10d %10d %10d %10d' % (name, lines, rate, failures, logins)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks with synthetic data')
+    subparsers = parser.add_subparsers()
+
+    subparser = subparsers.add_parser('workflows', help='zfs-snapshots workflows with replayed commands')
+    subparser.add_argument('--latency', type=float, default=BENCHMARK_LATENCY, help='Simulated command startup latency')
+    subparser.add_argument('datasets', type=int, nargs='*', default=BENCHMARK_DATASETS, help='Synthetic pool sizes')
+    subparser.set_defaults(benchmark=benchmark_workflows)
+
+    subparser = subparsers.add_parser('snapshots', help='Snapshot record memory use and sort time')
+    subparser.add_argument('snapshots', type=int, nargs='*', default=BENCHMARK_SNAPSHOTS, help='Synthetic snapshot counts')
+    subparser.set_defaults(benchmark=benchmark_snapshots)
+
+    subparser = subparsers.add_parser('records', help='Memory use of reading fake zfs output')
+    subparser.add_argument('rows', type=int, nargs='*', default=BENCHMARK_ROWS, help='Rows of zfs output')
+    subparser.set_defaults(benchmark=benchmark_records)
+
+    subparser = subparsers.add_parser('auth', help='sshd message classification rate')
+    subparser.add_argument('lines', type=int, nargs='*', default=BENCHMARK_AUTH_LINES, help='Synthetic auth.log lines')
+    subparser.set_defaults(benchmark=benchmark_auth)
+
+    args = parser.parse_args()
+    args.benchmark(args)
@@ -0,0 +1,86 @@
+"""
+Synthetic command fixtures for tests and benchmarks
+
+Fixtures are dictionaries of command lines to recorded output, served with
+ultimatum.runner.ReplayRunner.
+"""
+
+from ultimatum.zfs.properties import ZFSPropertyCache
+from ultimatum.zfs.snapshots import ZFSSnapshotIndex
+from ultimatum.zfs.zpool import SNAPSHOT_BATCH_SIZE
+
+# Datasets per group dataset in synthetic pools
+GROUP_SIZE = 100
+
+# Creation timestamp of first snapshot in synthetic pools
+SNAPSHOT_CREATION = 1500000000
+
+def dataset_names(pool, datasets):
+    """Synthetic dataset names
+
+    Return list of datasets names for pool with given number of datasets,
+    including the pool root. Datasets are grouped to group datasets of at
+    most GROUP_SIZE children.
+
+    """
+    names = [pool]
+    group = None
+    while len(names) < datasets:
+        if group is None or (len(names) - 1) % (GROUP_SIZE + 1) == 0:
+            group = '%s/group%d' % (pool, len(names) / (GROUP_SIZE + 1))
+            names.append(group)
+        else:
+            names.append('%s/ds%d' % (group, len(names)))
+    return names
+
+def zfs_pool_fixtures(pool, datasets, tags=('base',), create_tag=None, guid_offset=0):
+    """Synthetic zpool fixtures
+
+    Return command fixtures for zpool with given number of datasets, each
+    with snapshots for tags. If create_tag is given, fixtures for creating
+    snapshots with that tag in batches and one by one are included.
+
+    """
+    names = dataset_names(pool, datasets)
+
+    properties = []
+    for name in names:
+        properties.append('%s\tmountpoint\t/%s\n' % (name, name))
+        properties.append('%s\treceive_resume_token\t-\n' % name)
+
+    snapshots = []
+    for i, tag in enumerate(tags):
+        for j, name in enumerate(names):
+            snapshots.append('%s@%s\t%d\t0\t%d\t%d\n' % (
+                name, tag, SNAPSHOT_CREATION + i, 4096 * (j + 1), guid_offset + i * len(names) + j + 1
+            ))
+
+    fixtures = {
+        'zfs list -Hr -o name %s' % pool: {'output': ''.join('%s\n' % name for name in names)},
+        ' '.join(ZFSPropertyCache(pool).command): {'output': ''.join(properties)},
+        ' '.join(ZFSSnapshotIndex(pool).command): {'output': ''.join(snapshots)},
+    }
+
+    if create_tag is not None:
+        snapshot_names = ['%s@%s' % (name, create_tag) for name in names]
+        for name in snapshot_names:
+            fixtures['zfs snapshot %s' % name] = {'output': ''}
+        for i in range(0, len(snapshot_names), SNAPSHOT_BATCH_SIZE):
+            batch = snapshot_names[i:i+SNAPSHOT_BATCH_SIZE]
+            fixtures['zfs snapshot %s' % ' '.join(batch)] = {'output': ''}
+
+    return fixtures
+
+def zfs_fixtures(datasets, source='tank', backup='backups', create_tag=None):
+    """Synthetic source and backup pool fixtures
+
+    Return command fixtures for source pool with given number of datasets
+    and backup pool with the root dataset only
+
+    """
+    fixtures = {
+        'zpool list -H -o name': {'output': '%s\n%s\n' % (source, backup)},
+    }
+    fixtures.update(zfs_pool_fixtures(source, datasets, create_tag=create_tag))
+    fixtures.update(zfs_pool_fixtures(backup, 1, guid_offset=1000000000))
+    return fixtures
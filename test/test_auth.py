@@ -0,0 +1,546 @@
+"""
+Tests for auth log parsing
+"""
+
+import bz2
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta
+
+from seine.address import IPv4Address
+
+from ultimatum.logformats.auth import AuthLogReader, LogCheckpoint, SSHMessageClassifier, SSHSession, SSHSessionCache
+from ultimatum.logformats import auth
+from ultimatum.logformats.auth import read_failures, rotated_log_order, SSHViolationsDatabase
+from ultimatum.logformats.resolver import WhoisResolver
+from ultimatum.logformats.auth import SSH_CONNECT, SSH_MESSAGES
+
+SESSION_START = datetime(2017, 1, 1)
+
+AUTH_LOG_LINE = 'Jan  1 00:00:%02d host sshd[%d]: Invalid user %s from 10.0.0.%d\n'
+
+
+class AuthLogReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'auth.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def append(self, data):
+        with open(self.path, 'a') as fd:
+            fd.write(data)
+
+    def test_partial_line(self):
+        self.append('first line\nsecond ')
+        reader = AuthLogReader(open(self.path, 'r'))
+        try:
+            self.assertEqual(reader.readline(), 'first line\n')
+            self.assertEqual(reader.readline(), '')
+            self.assertEqual(reader.offset, 11)
+
+            self.append('line\n')
+            self.assertEqual(reader.readline(), 'second line\n')
+            self.assertEqual(reader.readline(), '')
+            self.assertEqual(reader.offset, 23)
+        finally:
+            reader.close()
+
+    def test_offset(self):
+        self.append('first line\nsecond line\n')
+        reader = AuthLogReader(open(self.path, 'r'), offset=11)
+        try:
+            self.assertEqual(reader.readline(), 'second line\n')
+            self.assertEqual(reader.read_head(5), 'first')
+            self.assertEqual(reader.readline(), '')
+        finally:
+            reader.close()
+
+
+class SSHMessageClassifierTests(unittest.TestCase):
+
+    def test_kinds(self):
+        self.assertEqual(
+            SSH_MESSAGES.classify('Connection from 10.0.0.1 port 52000'),
+            ('connect', {'address': '10.0.0.1', 'port': '52000'})
+        )
+        self.assertEqual(
+            SSH_MESSAGES.classify('Connection closed by 10.0.0.1 [preauth]'),
+            ('connection_closed', {'address': '10.0.0.1', 'reason': '[preauth]'})
+        )
+        kind, fields = SSH_MESSAGES.classify('Accepted publickey for hile from 10.0.0.1 port 52000 ssh2: RSA SHA256:abc')
+        self.assertEqual(kind, 'accepted_publickey')
+        self.assertEqual(fields['username'], 'hile')
+        self.assertEqual(fields['keytype'], 'RSA')
+        self.assertEqual(fields['fingerprint'], 'SHA256:abc')
+        kind, fields = SSH_MESSAGES.classify('Failed publickey for root from 10.0.0.1 port 52000 ssh2: RSA SHA256:abc')
+        self.assertEqual(kind, 'failed_publickey')
+        self.assertEqual(fields['user'], 'root')
+        self.assertEqual(SSH_MESSAGES.classify('User child is on pid 1234'), ('user_child', {'pid': '1234'}))
+        self.assertEqual(
+            SSH_MESSAGES.classify('Received disconnect from 10.0.0.1: 11: Bye Bye [preauth]'),
+            ('disconnect', {'address': '10.0.0.1', 'reason': '11: Bye Bye [preauth]'})
+        )
+        self.assertEqual(
+            SSH_MESSAGES.classify('fatal: Read from socket failed: Connection reset by peer [preauth]'),
+            ('connection_reset', {})
+        )
+
+    def test_invalid_user(self):
+        self.assertEqual(
+            SSH_MESSAGES.classify('Invalid user admin from 10.0.0.1'),
+            ('invalid_user', {'user': 'admin', 'address': '10.0.0.1', 'port': None})
+        )
+        self.assertEqual(
+            SSH_MESSAGES.classify('Invalid user sys admin from 10.0.0.1 port 52000'),
+            ('invalid_user', {'user': 'sys admin', 'address': '10.0.0.1', 'port': '52000'})
+        )
+
+    def test_unknown(self):
+        for message in ( '', 'pam_unix(sshd:session): session opened for user hile',
+                         'Connection reset by 10.0.0.1', 'Connection from 10.0.0.1',
+                         'User child is on pid x', 'fatal: Read from socket failed: Connection reset by peer',
+                         'fatal: Read from socket failed: Connection reset by peer [preauth] again', ):
+            self.assertEqual(SSH_MESSAGES.classify(message), (None, None), message)
+
+    def test_formats(self):
+        classifier = SSHMessageClassifier([
+            ('Connection from ', 'connect', SSH_CONNECT),
+            ('Connection reset', 'reset', None),
+        ])
+        self.assertEqual(sorted(classifier.keys()), ['Connection'])
+        self.assertEqual(classifier.classify('Connection reset'), ('reset', {}))
+        self.assertEqual(classifier.classify('Connection closed by 10.0.0.1 [preauth]'), (None, None))
+
+
+class SyntheticEntry(object):
+    """Synthetic sshd log entry
+
+    Entry with the attributes of AuthLogEntry used by SSH sessions, logged
+    seconds after SESSION_START
+
+    """
+    def __init__(self, pid, seconds, message):
+        self.pid = pid
+        self.time = SESSION_START + timedelta(seconds=seconds)
+        self.message = message
+        self.kind, self.fields = SSH_MESSAGES.classify(message)
+
+
+class SSHSessionCacheTests(unittest.TestCase):
+
+    def log(self, cache, pid, seconds, message='Connection from 10.0.0.1 port 52000'):
+        # Like AuthLogEntry for sshd entries
+        entry = SyntheticEntry(pid, seconds, message)
+        session = cache.match(entry)
+        if session is not None:
+            session.append(entry)
+        else:
+            session = SSHSession(cache, entry)
+            cache.append(session)
+        return session
+
+    def test_expire(self):
+        cache = SSHSessionCache()
+        self.log(cache, '100', 0)
+        self.log(cache, '200', 30)
+        self.assertEqual(sorted(cache.keys()), ['100', '200'])
+
+        self.log(cache, '300', 61)
+        self.assertEqual(sorted(cache.keys()), ['200', '300'])
+        self.assertEqual(cache.expired, 1)
+        self.assertEqual(cache.live, 2)
+
+        self.assertEqual(cache.expire(SESSION_START + timedelta(seconds=200)), 2)
+        self.assertEqual(cache.keys(), [])
+        self.assertEqual(cache.live, 0)
+
+    def test_user_session_expire(self):
+        cache = SSHSessionCache(user_session_expire=3600)
+        login = self.log(cache, '100', 0, 'Accepted publickey for hile from 10.0.0.1 port 52000 ssh2: RSA SHA256:abc')
+        self.log(cache, '100', 1, 'User child is on pid 101')
+        self.assertEqual(login.state, 'login')
+        user = cache['101'][0]
+        self.assertEqual(user.state, 'user_session')
+        self.assertEqual(user.info['username'], 'hile')
+
+        self.log(cache, '200', 120)
+        self.assertFalse('100' in cache)
+        self.assertIs(self.log(cache, '101', 3000, 'Starting session: shell on pts/0 for hile'), user)
+
+        # Heap entry of the user session is pushed again with later expiry
+        self.log(cache, '300', 3000 + 3599)
+        self.assertTrue('101' in cache)
+        self.log(cache, '400', 3000 + 3601)
+        self.assertFalse('101' in cache)
+        self.assertEqual(sorted(cache.keys()), ['300', '400'])
+
+    def test_logout(self):
+        cache = SSHSessionCache(user_session_expire=3600)
+        self.log(cache, '100', 0, 'Accepted publickey for hile from 10.0.0.1 port 52000 ssh2: RSA SHA256:abc')
+        self.log(cache, '100', 1, 'User child is on pid 101')
+        user = self.log(cache, '101', 30, 'Received disconnect from 10.0.0.1: 11: disconnected by user')
+        self.assertEqual(user.state, 'logout')
+        self.assertEqual(user.info['session_length'], 29)
+
+        # Sessions which are no longer user sessions expire after match timeout
+        self.log(cache, '200', 62)
+        self.assertEqual(sorted(cache.keys()), ['200'])
+
+    def test_evict(self):
+        cache = SSHSessionCache(max_sessions=3)
+        for i, pid in enumerate(( '100', '200', '300', '400', )):
+            self.log(cache, pid, i)
+        self.assertEqual(sorted(cache.keys()), ['200', '300', '400'])
+        self.assertEqual(cache.evicted, 1)
+        self.assertEqual(cache.expired, 0)
+        self.assertEqual(cache.live, 3)
+
+    def test_same_pid(self):
+        cache = SSHSessionCache()
+        first = self.log(cache, '100', 0)
+        second = self.log(cache, '100', 100)
+        self.assertIsNot(first, second)
+        self.assertEqual(cache['100'], [second])
+        self.assertEqual(cache.live, 1)
+
+    def test_summary(self):
+        for summary in ( False, True, ):
+            cache = SSHSessionCache(summary=summary)
+            session = self.log(cache, '100', 0)
+            self.log(cache, '100', 5, 'Invalid user admin from 10.0.0.1')
+            self.log(cache, '100', 6, 'Connection closed by 10.0.0.1 [preauth]')
+            self.assertEqual(session.state, 'preauth_no_key')
+            self.assertEqual(session.info['src_address'], '10.0.0.1')
+            self.assertEqual(session.entries, 3)
+            self.assertEqual(session.last_seen, SESSION_START + timedelta(seconds=6))
+            self.assertEqual(len(session), 0 if summary else 3)
+
+
+class LogCheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'auth.log')
+        self.lines = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, count, mode='a'):
+        with open(self.path, mode) as fd:
+            for i in range(count):
+                self.lines += 1
+                fd.write(AUTH_LOG_LINE % (self.lines, 1000 + self.lines, 'user%d' % self.lines, self.lines))
+
+    def read(self, path=None, checkpoints=None):
+        checkpoint, failures = read_failures(path or self.path, checkpoints if checkpoints is not None else {})
+        return checkpoint, [username for timestamp, address, username in failures]
+
+    def test_resume(self):
+        self.write(3)
+        checkpoint, users = self.read()
+        self.assertEqual(users, ['user1', 'user2', 'user3'])
+        self.assertEqual(checkpoint.offset, os.path.getsize(self.path))
+        self.assertEqual(checkpoint.inode, os.stat(self.path).st_ino)
+
+        self.assertEqual(self.read(checkpoints={self.path: checkpoint})[1], [])
+        self.write(2)
+        checkpoint, users = self.read(checkpoints={self.path: checkpoint})
+        self.assertEqual(users, ['user4', 'user5'])
+        self.assertEqual(checkpoint.offset, os.path.getsize(self.path))
+
+    def test_partial_line(self):
+        self.write(2)
+        with open(self.path, 'a') as fd:
+            fd.write('Jan  1 00:00:10 host sshd[2000]: Invalid user par')
+        checkpoint, users = self.read()
+        self.assertEqual(users, ['user1', 'user2'])
+
+        with open(self.path, 'a') as fd:
+            fd.write('tial from 10.0.0.10\n')
+        self.assertEqual(self.read(checkpoints={self.path: checkpoint})[1], ['partial'])
+
+    def test_rotation(self):
+        self.write(2)
+        checkpoint = self.read()[0]
+        self.write(1)
+        rotated = '%s.0' % self.path
+        os.rename(self.path, rotated)
+        self.write(2)
+
+        # New file with same path has another inode and is read from start
+        new, users = self.read(checkpoints={self.path: checkpoint})
+        self.assertNotEqual(new.inode, checkpoint.inode)
+        self.assertEqual(users, ['user4', 'user5'])
+
+        # Rotated file is recognized by head and read from checkpoint offset
+        old, users = self.read(rotated, checkpoints={self.path: checkpoint})
+        self.assertEqual(users, ['user3'])
+        self.assertEqual(old.path, rotated)
+
+        # Offsets are counted in uncompressed content of compressed files
+        compressed = bz2.BZ2File('%s.bz2' % rotated, 'w')
+        with open(rotated, 'r') as fd:
+            compressed.write(fd.read())
+        compressed.close()
+        os.unlink(rotated)
+        self.assertEqual(self.read('%s.bz2' % rotated, checkpoints={self.path: checkpoint})[1], ['user3'])
+
+    def test_truncate(self):
+        self.write(5)
+        checkpoint = self.read()[0]
+        inode = checkpoint.inode
+
+        self.lines = 10
+        self.write(1, mode='w')
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        self.assertTrue(os.path.getsize(self.path) < checkpoint.offset)
+        checkpoint, users = self.read(checkpoints={self.path: checkpoint})
+        self.assertEqual(users, ['user11'])
+        self.assertEqual(checkpoint.offset, os.path.getsize(self.path))
+
+    def test_unknown_file(self):
+        self.write(2)
+        checkpoint = LogCheckpoint('/var/log/other.log', 1, 100, 50, 'abc', 3)
+        self.assertEqual(self.read(checkpoints={checkpoint.path: checkpoint})[1], ['user1', 'user2'])
+
+
+class WhoisNetblock(object):
+    def __init__(self, network, start, end):
+        self.network = IPv4Address(network)
+        self.start = IPv4Address(start)
+        self.end = IPv4Address(end)
+        self.description = 'test netblock'
+
+
+class WhoisRegistration(list):
+    """Whois registration
+
+    Registration returned by stub whois queries with netblocks for
+    (network, start, end) tuples
+
+    """
+    def __init__(self, handle, netblocks):
+        list.__init__(self, [WhoisNetblock(*netblock) for netblock in netblocks])
+        self.version = 1
+        self.handle = handle
+        self.comment = None
+        self.registered = None
+        self.updated = None
+
+
+class SSHViolationsDatabaseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = self.open_database('violations.db')
+
+    def open_database(self, name):
+        def query(address):
+            raise ValueError('No whois in tests')
+        return SSHViolationsDatabase(os.path.join(self.directory, name), resolver=WhoisResolver(query=query))
+
+    def tearDown(self):
+        self.database.conn.close()
+        shutil.rmtree(self.directory)
+
+    def query(self, sql, *args):
+        c = self.database.cursor
+        c.execute(sql, args)
+        return c.fetchall()
+
+    def test_add_batch(self):
+        self.assertEqual(self.database.add_batch([]), 0)
+        self.assertEqual(self.database.add_batch([
+            ('2017-01-01 00:00:01', None, '10.0.0.1', 'root'),
+            ('2017-01-01 00:00:02', None, '10.0.0.1', 'root'),
+            ('2017-01-01 00:00:01', None, '10.0.0.1', 'root'),
+        ]), 2)
+        self.assertEqual(self.database.add_batch([
+            ('2017-01-01 00:00:02', None, '10.0.0.1', 'root'),
+            ('2017-01-01 00:00:02', None, '10.0.0.1', 'admin'),
+            ('2017-01-01 00:00:02', None, '10.0.0.2', 'root'),
+        ]), 2)
+        self.assertEqual(self.database.add_batch([
+            ('2017-01-01 00:00:01', None, '10.0.0.1', 'root'),
+        ]), 0)
+        self.assertEqual(self.query("""SELECT timestamp, address, username FROM login ORDER BY id"""), [
+            ('2017-01-01 00:00:01', '10.0.0.1', 'root'),
+            ('2017-01-01 00:00:02', '10.0.0.1', 'root'),
+            ('2017-01-01 00:00:02', '10.0.0.1', 'admin'),
+            ('2017-01-01 00:00:02', '10.0.0.2', 'root'),
+        ])
+
+    def test_uncovered_registration(self):
+        queries = []
+        def query(address):
+            queries.append(address)
+            return WhoisRegistration('NET-1', [('10.1.0.0/24', '10.1.0.0', '10.1.0.255')])
+
+        self.database.conn.close()
+        self.database = SSHViolationsDatabase(
+            os.path.join(self.directory, 'whois.db'), resolver=WhoisResolver(query=query)
+        )
+        for address in ( '10.0.0.1', '10.1.0.1', ):
+            self.assertEqual(self.database.lookup_registration(address), None)
+        self.assertTrue(self.database.resolver.wait(5))
+        self.assertEqual(self.database.process_whois_results(), ['10.1.0.1'])
+
+        self.assertEqual(self.database.lookup_registration('10.0.0.1'), None)
+        self.assertEqual(self.database.lookup_registration('10.1.0.1'), 1)
+        self.assertFalse(self.database.resolver.busy)
+        self.assertEqual(sorted(queries), ['10.0.0.1', '10.1.0.1'])
+
+    def test_add_batch_error(self):
+        self.assertRaises(Exception, self.database.add_batch, [
+            ('2017-01-01 00:00:01', None, '10.0.0.1', 'root'),
+            ('2017-01-01 00:00:02', None, '10.0.0.1'),
+        ])
+        self.assertEqual(self.query("""SELECT COUNT(*) FROM login"""), [(0,)])
+        self.assertEqual(self.database.add_batch([('2017-01-01 00:00:01', None, '10.0.0.1', 'root')]), 1)
+
+    def address_aggregates(self):
+        return sorted(self.query(
+            """SELECT address, COUNT(DISTINCT timestamp), MIN(timestamp), MAX(timestamp), MAX(registration) """ +
+            """FROM login GROUP BY address"""
+        ))
+
+    def add_random_attempts(self, count, seed=0):
+        for handle in ( 'NET-1', 'NET-2', ):
+            self.query("""INSERT INTO registration (handle) VALUES (?)""", handle)
+        registrations = {'10.0.0.1': 1, '10.0.0.2': 2, '10.0.0.3': None, '10.0.0.4': None}
+
+        generator = random.Random(seed)
+        attempts = []
+        for i in range(count):
+            address = generator.choice(sorted(registrations.keys()))
+            attempts.append((
+                '2017-01-01 00:%02d:%02d' % (generator.randint(0, 9), generator.randint(0, 59)),
+                registrations[address],
+                address,
+                generator.choice(( 'root', 'admin', 'test', )),
+            ))
+        self.database.add_batch(attempts[:count // 2])
+        for timestamp, registration, address, username in attempts[count // 2:]:
+            self.database.add(timestamp, address, username, registration, fetch=False)
+
+    def test_address_statistics(self):
+        self.add_random_attempts(1000)
+        self.assertEqual(sorted(self.database.address_statistics()), self.address_aggregates())
+        self.assertEqual(len(self.database.address_statistics()), 4)
+
+    def test_rebuild_address_statistics(self):
+        self.add_random_attempts(200)
+        expected = self.address_aggregates()
+        self.query("""UPDATE address SET count=0, first_seen=NULL""")
+        self.query("""DELETE FROM address WHERE address='10.0.0.1'""")
+        self.database.rebuild_address_statistics()
+        self.assertEqual(sorted(self.database.address_statistics()), expected)
+
+    def attempt_ids(self, **kwargs):
+        return [row['id'] for row in self.database.login_attempts(netblocks=False, **kwargs)]
+
+    def test_login_attempts_chunks(self):
+        self.add_random_attempts(500)
+        expected = [r[0] for r in self.query("""SELECT id FROM login ORDER BY timestamp, id""")]
+        self.assertTrue(len(expected) > 400)
+        for chunk_size in ( 1, 7, 100, 1000, ):
+            self.assertEqual(self.attempt_ids(chunk_size=chunk_size), expected, chunk_size)
+        self.assertEqual(self.attempt_ids(chunk_size=7, limit=30), expected[:30])
+
+    def test_login_attempts_pages(self):
+        self.add_random_attempts(500)
+        expected = [r[0] for r in self.query("""SELECT id FROM login ORDER BY timestamp, id""")]
+
+        pages = []
+        after = None
+        while True:
+            page = list(self.database.login_attempts(after=after, limit=13, netblocks=False, chunk_size=5))
+            if not page:
+                break
+            self.assertTrue(len(page) <= 13)
+            pages.append([row['id'] for row in page])
+            after = (page[-1]['timestamp'], page[-1]['id'])
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(len(pages), (len(expected) + 12) // 13)
+
+    def test_login_attempts_filters(self):
+        self.add_random_attempts(500)
+        start, end = '2017-01-01 00:03:00', '2017-01-01 00:05:00'
+        expected = [r[0] for r in self.query(
+            """SELECT id FROM login WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp, id""", start, end
+        )]
+        self.assertTrue(expected)
+        self.assertEqual(self.attempt_ids(start=start, end=end, chunk_size=7), expected)
+
+        expected = [r[0] for r in self.query(
+            """SELECT id FROM login WHERE timestamp >= ? AND address=? AND username=? ORDER BY timestamp, id""",
+            start, '10.0.0.1', 'root'
+        )]
+        self.assertTrue(expected)
+        self.assertEqual(self.attempt_ids(start=start, address='10.0.0.1', username='root', chunk_size=3), expected)
+
+    def test_login_attempts_netblocks(self):
+        self.add_random_attempts(10)
+        self.query("""UPDATE address SET netblocks='10.0.0.0/24' WHERE address='10.0.0.1'""")
+        for row in self.database.login_attempts(chunk_size=3):
+            self.assertEqual(row['netblocks'], row['address'] == '10.0.0.1' and ['10.0.0.0/24'] or [])
+
+    def write_rotated_logs(self):
+        # Newest lines in auth.log, older in files with higher rotation index
+        paths = []
+        line = 0
+        for name in ( 'auth.log.2.bz2', 'auth.log.1.bz2', 'auth.log.0', 'auth.log', ):
+            path = os.path.join(self.directory, name)
+            fd = name.endswith('.bz2') and bz2.BZ2File(path, 'w') or open(path, 'w')
+            for i in range(20):
+                line += 1
+                fd.write(AUTH_LOG_LINE.replace(':00:', ':%02d:' % (line // 60)) % (
+                    line % 60, 1000 + line, 'user%d' % line, line % 5 + 1
+                ))
+            fd.close()
+            paths.append(path)
+        return paths
+
+    def test_rotated_log_order(self):
+        self.assertEqual(
+            sorted(( 'auth.log', 'auth.log.0.bz2', 'auth.log.1.bz2', 'auth.log.10.bz2', 'auth.log.2.bz2', ),
+                   key=rotated_log_order),
+            ['auth.log.10.bz2', 'auth.log.2.bz2', 'auth.log.1.bz2', 'auth.log.0.bz2', 'auth.log']
+        )
+        self.assertEqual(
+            sorted(( 'messages', 'auth.log.1.gz', 'auth.log', 'messages.0', 'auth.log.2', ), key=rotated_log_order),
+            ['auth.log.2', 'auth.log.1.gz', 'auth.log', 'messages.0', 'messages']
+        )
+
+    def test_update_jobs(self):
+        paths = self.write_rotated_logs()
+        patterns = auth.AUTH_LOG_PATTERNS
+        auth.AUTH_LOG_PATTERNS = ( os.path.join(self.directory, 'auth.log*'), )
+        try:
+            serial = self.database.update(jobs=1)
+            parallel_database = self.open_database('parallel.db')
+            parallel = parallel_database.update(jobs=3)
+        finally:
+            auth.AUTH_LOG_PATTERNS = patterns
+
+        self.assertEqual(serial.inserted, 80)
+        self.assertEqual(parallel.inserted, 80)
+        sql = """SELECT id, timestamp, address, username FROM login ORDER BY id"""
+        rows = self.query(sql)
+        c = parallel_database.cursor
+        c.execute(sql)
+        self.assertEqual(c.fetchall(), rows)
+        self.assertEqual(sorted(self.database.address_statistics()), sorted(parallel_database.address_statistics()))
+        parallel_database.conn.close()
+
+        # Files are inserted oldest first
+        self.assertEqual([row[3] for row in rows], ['user%d' % (i + 1) for i in range(80)])
+        self.assertEqual(sorted(self.database.checkpoints().keys()), sorted(paths))
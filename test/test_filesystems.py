@@ -0,0 +1,149 @@
+"""
+Tests for mount table and usage parsing
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ultimatum.runner import ReplayRunner, set_runner
+
+from ultimatum.filesystems import parse_mount_output, parse_mountinfo, df_usage, MountPoints
+from ultimatum.filesystems import FileSystemError, MOUNT_ADDED, MOUNT_REMOVED, MOUNT_CHANGED
+
+MOUNT_OUTPUT = """/dev/ada0p2 on / (ufs, local, journaled soft-updates)
+devfs on /dev (devfs, local, multilabel)
+tank/home on /home (zfs, local, nfsv4acls)
+map -hosts on /net (autofs)
+garbage line
+"""
+
+MOUNTINFO = """22 28 0:20 / /sys rw,nosuid,nodev,noexec,relatime shared:7 - sysfs sysfs rw
+28 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw,errors=remount-ro
+40 28 0:35 / /mnt/my\\040disk rw,relatime - fuse.sshfs host:/path\\040x rw
+41 28 0:36 / /srv rw - tmpfs tmpfs rw
+"""
+
+DF_OUTPUT = """Filesystem                     1024-blocks      Used     Avail Capacity  Mounted on
+/dev/ada0p2                       20307196   8134552  10548072    44%    /
+tank/home                        100000000  25000000  75000000    25%    /home
+/dev/mapper/very-long-volume-group-name-home
+                                   1000000    500000    500000    50%    /mnt/my disk
+"""
+
+
+class MountParserTests(unittest.TestCase):
+
+    def test_parse_mount_output(self):
+        self.assertEqual(parse_mount_output(MOUNT_OUTPUT), [
+            ('/dev/ada0p2', '/', 'ufs', ('local', 'journaled soft-updates')),
+            ('devfs', '/dev', 'devfs', ('local', 'multilabel')),
+            ('tank/home', '/home', 'zfs', ('local', 'nfsv4acls')),
+        ])
+
+    def test_parse_mountinfo(self):
+        self.assertEqual(parse_mountinfo(MOUNTINFO), [
+            ('sysfs', '/sys', 'sysfs', ('rw', 'nosuid', 'nodev', 'noexec', 'relatime')),
+            ('/dev/sda1', '/', 'ext4', ('rw', 'relatime')),
+            ('host:/path x', '/mnt/my disk', 'fuse.sshfs', ('rw', 'relatime')),
+            ('tmpfs', '/srv', 'tmpfs', ('rw',)),
+        ])
+
+    def test_parse_mountinfo_invalid(self):
+        self.assertEqual(parse_mountinfo('28 1 8:1 / / rw,relatime shared:1 ext4 /dev/sda1 rw\n'), [])
+
+
+class DFUsageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = ReplayRunner({
+            'df -k': {'output': DF_OUTPUT},
+            'df -k /home': {'output': DF_OUTPUT, 'returncode': 1},
+        })
+        self.previous = set_runner(self.runner)
+
+    def tearDown(self):
+        set_runner(self.previous)
+
+    def test_usage(self):
+        usage = df_usage()
+        self.assertEqual(sorted(usage.keys()), ['/', '/home', '/mnt/my disk'])
+        self.assertEqual(usage['/'], {
+            'mountpoint': '/', 'size': 20307196, 'used': 8134552, 'free': 10548072, 'percent': 44,
+        })
+        self.assertEqual(usage['/mnt/my disk']['percent'], 50)
+        self.assertEqual(self.runner.count, 1)
+
+    def test_partial_output(self):
+        usage = df_usage(['/home'])
+        self.assertEqual(usage['/home']['used'], 25000000)
+
+    def test_error(self):
+        self.assertRaises(FileSystemError, df_usage, ['/missing'])
+
+
+class MountPointsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'mountinfo')
+        self.write(MOUNTINFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, data):
+        with open(self.path, 'w') as fd:
+            fd.write(data)
+
+    def test_update(self):
+        events = []
+        mountpoints = MountPoints(mountinfo=self.path)
+        mountpoints.register_callback(lambda event, entry, previous: events.append((event, entry.mountpoint)))
+        self.assertEqual(sorted(mountpoints.keys()), ['/', '/mnt/my disk', '/srv', '/sys'])
+        entry = mountpoints['/']
+
+        self.assertEqual(mountpoints.update(), [])
+        self.write(MOUNTINFO.replace('41 28 0:36 / /srv rw', '41 28 0:36 / /srv ro').replace('/sys', '/proc'))
+        mountpoints.update()
+        self.assertEqual(sorted(events), [
+            (MOUNT_ADDED, '/proc'), (MOUNT_CHANGED, '/srv'), (MOUNT_REMOVED, '/sys'),
+        ])
+        self.assertIs(mountpoints['/'], entry)
+
+    def test_stacked_mounts(self):
+        stacked = MOUNTINFO + '42 41 0:37 / /srv rw - nfs server:/srv rw\n'
+        self.write(stacked)
+        mountpoints = MountPoints(mountinfo=self.path)
+        self.assertEqual(mountpoints['/srv'].device, 'server:/srv')
+
+        events = []
+        mountpoints.register_callback(lambda event, entry, previous: events.append((event, entry.mountpoint)))
+        self.write(stacked.replace('/sys', '/proc'))
+        mountpoints.update()
+        self.assertEqual(sorted(events), [(MOUNT_ADDED, '/proc'), (MOUNT_REMOVED, '/sys')])
+        self.assertEqual(mountpoints['/srv'].device, 'server:/srv')
+
+    def test_stale_mount_usage(self):
+        self.write(
+            '28 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+            '50 28 0:40 / /nfs/gone rw - nfs server:/gone rw\n'
+            '51 28 0:41 / /nfs/gone2 rw - nfs server:/gone2 rw\n'
+        )
+        df_output = {
+            'output': '%s\nserver:/gone2 1000 250 750 25%% /nfs/gone2\n' % DF_OUTPUT.split('\n')[0],
+            'returncode': 1,
+        }
+        runner = ReplayRunner({
+            'df -k /nfs/gone /nfs/gone2': df_output,
+            'df -k /nfs/gone2 /nfs/gone': df_output,
+        })
+        previous = set_runner(runner)
+        try:
+            usage = MountPoints(mountinfo=self.path).usage()
+        finally:
+            set_runner(previous)
+        self.assertEqual(sorted(usage.keys()), ['/', '/nfs/gone2'])
+        self.assertEqual(usage['/nfs/gone2']['percent'], 25)
+        self.assertEqual(runner.count, 1)
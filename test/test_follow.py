@@ -0,0 +1,161 @@
+"""
+Tests for following auth.log and serving address counters
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ultimatum.logformats.auth import SSHViolationsDatabase
+from ultimatum.logformats.follow import AddressCounters, CountersSocketThread, SSHViolationsFollower, read_counters
+from ultimatum.logformats.resolver import WhoisResolver
+
+AUTH_LOG_LINE = 'Jan  1 00:00:%02d host sshd[%d]: Invalid user %s from 10.0.0.%d\n'
+
+
+def no_whois(address):
+    raise ValueError('No whois in tests')
+
+
+class AddressCountersTests(unittest.TestCase):
+
+    def test_add(self):
+        counters = AddressCounters()
+        counter, new = counters.add('2017-01-01 00:00:01', '10.0.0.1')
+        self.assertTrue(new)
+        self.assertEqual(counter.count, 1)
+
+        counter, new = counters.add('2017-01-01 00:00:01', '10.0.0.1', registration=1)
+        self.assertFalse(new)
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(counter.registration, 1)
+
+        counters.add('2017-01-01 00:00:02', '10.0.0.1')
+        counters.add('2017-01-01 00:00:02', '10.0.0.2')
+        self.assertEqual(counters.total, 3)
+        self.assertEqual([(x['address'], x['count']) for x in counters.summary()], [
+            ('10.0.0.1', 2), ('10.0.0.2', 1),
+        ])
+        self.assertEqual(counters['10.0.0.1'].first_seen, '2017-01-01 00:00:01')
+        self.assertEqual(counters['10.0.0.1'].last_seen, '2017-01-01 00:00:02')
+
+    def test_socket(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'counters.sock')
+        counters = AddressCounters()
+        counters.add('2017-01-01 00:00:01', '10.0.0.1')
+        counters.add('2017-01-01 00:00:02', '10.0.0.1')
+        counters.add('2017-01-01 00:00:01', '10.0.0.2')
+
+        thread = CountersSocketThread(counters, path)
+        thread.start()
+        try:
+            self.assertEqual(read_counters(path), counters.summary())
+            counters.add('2017-01-01 00:00:03', '10.0.0.3')
+            self.assertEqual(len(read_counters(path)), 3)
+        finally:
+            thread.stop()
+            thread.join(5)
+            shutil.rmtree(directory)
+        self.assertFalse(os.path.exists(path))
+
+
+class SSHViolationsFollowerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'auth.log')
+        self.database = SSHViolationsDatabase(
+            os.path.join(self.directory, 'violations.db'), resolver=WhoisResolver(query=no_whois)
+        )
+        self.lines = 0
+
+    def tearDown(self):
+        self.database.conn.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, count, path=None):
+        with open(path or self.path, 'a') as fd:
+            for i in range(count):
+                self.lines += 1
+                fd.write(AUTH_LOG_LINE % (self.lines, 1000 + self.lines, 'user%d' % self.lines, self.lines))
+
+    def follower(self, batch_size=100):
+        follower = SSHViolationsFollower(self.database, self.path, batch_size=batch_size, poll_interval=0.01)
+        follower.counters.load(self.database)
+        follower.__open__()
+        return follower
+
+    def read_lines(self, follower):
+        while True:
+            line = follower.log.reader.readline()
+            if line == '':
+                break
+            follower.process_line(line)
+
+    def usernames(self):
+        c = self.database.cursor
+        c.execute("""SELECT username FROM login ORDER BY id""")
+        return [r[0] for r in c.fetchall()]
+
+    def test_partial_line(self):
+        self.write(2)
+        with open(self.path, 'a') as fd:
+            fd.write('Jan  1 00:00:10 host sshd[2000]: Invalid user par')
+        follower = self.follower()
+        self.read_lines(follower)
+        follower.flush()
+        self.assertEqual(self.usernames(), ['user1', 'user2'])
+        self.assertEqual(follower.counters.total, 2)
+        offset = self.database.checkpoints()[self.path].offset
+        self.assertEqual(offset, os.path.getsize(self.path) - len('Jan  1 00:00:10 host sshd[2000]: Invalid user par'))
+
+        with open(self.path, 'a') as fd:
+            fd.write('tial from 10.0.0.10\n')
+        self.read_lines(follower)
+        follower.flush()
+        follower.log.reader.close()
+        self.assertEqual(self.usernames(), ['user1', 'user2', 'partial'])
+        self.assertEqual(self.database.checkpoints()[self.path].offset, os.path.getsize(self.path))
+
+    def test_resume_from_checkpoint(self):
+        self.write(3)
+        follower = self.follower()
+        self.read_lines(follower)
+        follower.flush()
+        follower.log.reader.close()
+
+        self.write(2)
+        follower = self.follower()
+        self.assertEqual(follower.counters.total, 3)
+        self.read_lines(follower)
+        follower.flush()
+        follower.log.reader.close()
+        self.assertEqual(self.usernames(), ['user1', 'user2', 'user3', 'user4', 'user5'])
+        self.assertEqual(follower.counters.total, 5)
+
+    def test_run_rotation(self):
+        self.write(3)
+        rotated = '%s.0' % self.path
+        events = []
+
+        def rotate(counter, new):
+            events.append((counter.address, new))
+            if len(events) == 2:
+                # Rotate while the follower still has an unread line in the old file
+                os.rename(self.path, rotated)
+                self.write(2)
+            elif len(events) == 5:
+                follower.stop()
+
+        follower = SSHViolationsFollower(self.database, self.path, batch_size=2, poll_interval=0.01)
+        follower.register_callback(rotate)
+        follower.run()
+
+        self.assertEqual([new for address, new in events], [True] * 5)
+        self.assertEqual(self.usernames(), ['user1', 'user2', 'user3', 'user4', 'user5'])
+        checkpoint = self.database.checkpoints()[self.path]
+        self.assertEqual(checkpoint.inode, os.stat(self.path).st_ino)
+        self.assertEqual(checkpoint.offset, os.path.getsize(self.path))
+        self.assertEqual(follower.counters.total, 5)
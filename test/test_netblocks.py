@@ -0,0 +1,98 @@
+"""
+Tests for netblock index lookups
+"""
+
+import random
+import unittest
+
+from ultimatum.logformats.netblocks import address_value, network_range, LRUCache, NetblockIndex
+
+
+class NetblockParserTests(unittest.TestCase):
+
+    def test_address_value(self):
+        self.assertEqual(address_value('10.0.0.1'), (4, 0x0a000001))
+        self.assertEqual(address_value('10.0.0.1/8'), (4, 0x0a000001))
+        self.assertEqual(address_value('2001:db8::1'), (6, 0x20010db8000000000000000000000001))
+        self.assertRaises(ValueError, address_value, '10.0.0.256')
+        self.assertRaises(ValueError, address_value, 'example.com')
+
+    def test_network_range(self):
+        self.assertEqual(network_range('10.1.2.3/16'), (4, 0x0a010000, 0x0a01ffff))
+        self.assertEqual(network_range('10.1.2.3'), (4, 0x0a010203, 0x0a010203))
+        self.assertEqual(network_range('0.0.0.0/0'), (4, 0, 0xffffffff))
+        self.assertEqual(network_range('2001:db8::/32')[1:], (
+            0x20010db8000000000000000000000000, 0x20010db8ffffffffffffffffffffffff
+        ))
+        self.assertRaises(ValueError, network_range, '10.0.0.0/33')
+        self.assertRaises(ValueError, network_range, '10.0.0.0/x')
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.lookup('a')
+        cache['c'] = 3
+        self.assertEqual(sorted(cache.keys()), ['a', 'c'])
+        self.assertRaises(KeyError, cache.lookup, 'b')
+
+
+class NetblockIndexTests(unittest.TestCase):
+
+    def test_nested(self):
+        index = NetblockIndex()
+        index.add_network('10.0.0.0/8', 1)
+        index.add_network('10.1.0.0/16', 2)
+        index.add_network('10.1.2.0/24', 3)
+        index.add_network('10.2.0.0/16', 4)
+        index.add_network('2001:db8::/32', 5)
+        self.assertEqual(len(index), 5)
+
+        self.assertEqual(index.lookup('10.0.0.1'), 1)
+        self.assertEqual(index.lookup('10.1.0.1'), 2)
+        self.assertEqual(index.lookup('10.1.2.255'), 3)
+        self.assertEqual(index.lookup('10.1.3.0'), 2)
+        self.assertEqual(index.lookup('10.2.255.255'), 4)
+        self.assertEqual(index.lookup('10.3.0.0'), 1)
+        self.assertEqual(index.lookup('11.0.0.0'), None)
+        self.assertEqual(index.lookup('2001:db8::1'), 5)
+        self.assertEqual(index.lookup('2001:db9::1'), None)
+        self.assertRaises(ValueError, index.lookup, 'invalid')
+
+    def test_add_clears_cache(self):
+        index = NetblockIndex()
+        index.add_network('10.0.0.0/8', 1)
+        self.assertEqual(index.lookup('10.1.2.3'), 1)
+        index.add_network('10.1.0.0/16', 2)
+        self.assertEqual(index.lookup('10.1.2.3'), 2)
+        index.clear()
+        self.assertEqual(index.lookup('10.1.2.3'), None)
+
+    def test_random_netblocks(self):
+        rng = random.Random(1)
+        networks = []
+        for i in range(300):
+            prefixlen = rng.randint(8, 28)
+            address = '10.%d.%d.%d' % (rng.randint(0, 3), rng.randint(0, 255), rng.randint(0, 255))
+            networks.append((network_range('%s/%d' % (address, prefixlen)), i))
+
+        index = NetblockIndex()
+        for (family, first, last), registration in networks:
+            index.add(family, first, last, registration)
+
+        for i in range(2000):
+            value = (10 << 24) + rng.randint(0, 4 << 16)
+            address = '.'.join('%d' % (value >> shift & 0xff) for shift in (24, 16, 8, 0))
+            matches = sorted(
+                (last - first, registration) for (family, first, last), registration in networks
+                if first <= value <= last
+            )
+            # Identical networks are owned by the last added netblock
+            expected = None
+            if matches:
+                size = matches[0][0]
+                expected = max(registration for length, registration in matches if length == size)
+            self.assertEqual(index.lookup(address), expected, address)
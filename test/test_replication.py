@@ -0,0 +1,92 @@
+"""
+Tests for zfs send and receive relay with stand-in commands
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ultimatum.runner import CommandRunner, set_runner
+from ultimatum.zfs import ZFSError
+from ultimatum.zfs.replication import ZFSReplication
+
+
+class StandInRunner(CommandRunner):
+    """Stand-in command runner
+
+    Runs shell commands in place of the zfs commands they are registered for
+
+    """
+    def __init__(self, commands):
+        CommandRunner.__init__(self)
+        self.commands = commands
+
+    def popen(self, cmd, stdin=None, stdout=None, stderr=None, close_fds=False):
+        script = self.commands[' '.join(cmd)]
+        return CommandRunner.popen(self, ['sh', '-c', script], stdin, stdout, stderr, close_fds)
+
+
+class ReplicationStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source')
+        self.target = os.path.join(self.directory, 'target')
+        with open(self.source, 'wb') as fd:
+            fd.write(os.urandom(256 * 1024 + 123))
+        self.previous = None
+
+    def tearDown(self):
+        if self.previous is not None:
+            set_runner(self.previous)
+        shutil.rmtree(self.directory)
+
+    def replicate(self, send, receive, **kwargs):
+        self.runner = StandInRunner({
+            'zfs send tank/home@backup': send,
+            'zfs receive -d backups': receive,
+        })
+        self.previous = set_runner(self.runner)
+        replication = ZFSReplication('tank/home@backup', 'backups', block_size=4096, buffer_blocks=4, **kwargs)
+        replication.run()
+        return replication
+
+    def test_relay(self):
+        progress = []
+        replication = self.replicate(
+            'cat "%s"' % self.source,
+            'cat > "%s"' % self.target,
+            callback=progress.append,
+            callback_interval=0,
+        )
+        with open(self.source, 'rb') as fd:
+            data = fd.read()
+        with open(self.target, 'rb') as fd:
+            self.assertEqual(fd.read(), data)
+        self.assertEqual(replication.bytes, len(data))
+        self.assertTrue(progress)
+        self.assertEqual(self.runner.count, 2)
+
+    def test_receive_exits(self):
+        try:
+            self.replicate(
+                'cat "%s"' % self.source,
+                'head -c 100 > /dev/null; echo "cannot receive: stream corrupt" >&2; exit 1',
+            )
+        except ZFSError, emsg:
+            self.assertTrue('zfs receive -d backups: cannot receive: stream corrupt' in '%s' % emsg, emsg)
+        else:
+            self.fail('ZFSError not raised')
+
+    def test_send_fails(self):
+        try:
+            self.replicate(
+                'head -c 1000 "%s"; echo "cannot send: dataset is busy" >&2; exit 1' % self.source,
+                'cat > "%s"' % self.target,
+            )
+        except ZFSError, emsg:
+            self.assertTrue('zfs send tank/home@backup: cannot send: dataset is busy' in '%s' % emsg, emsg)
+        else:
+            self.fail('ZFSError not raised')
+        self.assertEqual(os.path.getsize(self.target), 1000)
@@ -0,0 +1,109 @@
+"""
+Tests for background whois resolution with an injected query function
+"""
+
+import threading
+import unittest
+
+from ultimatum.logformats.resolver import WhoisResolver
+
+
+class StubQuery(object):
+    """Stub whois query
+
+    Returns registration for queried address after release() is called, or
+    raises ValueError for addresses in failing
+
+    """
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.addresses = []
+        self.released = threading.Event()
+
+    def __call__(self, address):
+        self.addresses.append(address)
+        self.released.wait()
+        if address in self.failing:
+            raise ValueError('No whois record for %s' % address)
+        return 'registration %s' % address
+
+    def release(self):
+        self.released.set()
+
+
+class WhoisResolverTests(unittest.TestCase):
+
+    def test_coalesce(self):
+        query = StubQuery()
+        resolver = WhoisResolver(query=query, workers=2)
+        for address in ( '10.0.0.1', '10.0.0.2', '10.0.0.1', '10.0.1.1', ):
+            self.assertTrue(resolver.submit(address))
+        self.assertEqual(resolver.queries, 2)
+        self.assertEqual(resolver.coalesced, 2)
+        self.assertTrue(resolver.busy)
+
+        query.release()
+        self.assertTrue(resolver.wait(5))
+        self.assertEqual(sorted(query.addresses), ['10.0.0.1', '10.0.1.1'])
+        self.assertEqual(sorted(resolver.results()), [
+            (['10.0.0.1', '10.0.0.2'], 'registration 10.0.0.1', None),
+            (['10.0.1.1'], 'registration 10.0.1.1', None),
+        ])
+        self.assertFalse(resolver.busy)
+        self.assertEqual(resolver.results(), [])
+
+    def test_negative_ttl(self):
+        query = StubQuery(failing=( '10.0.0.1', ))
+        query.release()
+        resolver = WhoisResolver(query=query, negative_ttl=3600)
+        self.assertTrue(resolver.submit('10.0.0.1'))
+        self.assertTrue(resolver.wait(5))
+        self.assertEqual(resolver.results(), [(['10.0.0.1'], None, 'No whois record for 10.0.0.1')])
+        self.assertEqual(resolver.failures, 1)
+
+        self.assertFalse(resolver.submit('10.0.0.1'))
+        self.assertFalse(resolver.submit('10.0.0.200'))
+        self.assertTrue(resolver.submit('10.0.1.1'))
+        self.assertTrue(resolver.wait(5))
+        self.assertEqual(resolver.results(), [(['10.0.1.1'], 'registration 10.0.1.1', None)])
+        self.assertEqual(query.addresses, ['10.0.0.1', '10.0.1.1'])
+
+    def test_negative_ttl_expired(self):
+        query = StubQuery(failing=( '10.0.0.1', ))
+        query.release()
+        resolver = WhoisResolver(query=query, negative_ttl=0)
+        resolver.submit('10.0.0.1')
+        resolver.wait(5)
+        resolver.results()
+        self.assertTrue(resolver.submit('10.0.0.1'))
+        self.assertEqual(resolver.queries, 2)
+
+    def test_reject(self):
+        query = StubQuery()
+        query.release()
+        resolver = WhoisResolver(query=query, negative_ttl=3600)
+        self.assertTrue(resolver.submit('10.0.0.1'))
+        self.assertTrue(resolver.wait(5))
+        self.assertEqual(resolver.results(), [(['10.0.0.1'], 'registration 10.0.0.1', None)])
+
+        resolver.reject(['10.0.0.1', 'not an address'])
+        self.assertFalse(resolver.submit('10.0.0.1'))
+        self.assertEqual(resolver.queries, 1)
+        self.assertEqual(resolver.failures, 0)
+
+    def test_timeout(self):
+        query = StubQuery()
+        resolver = WhoisResolver(query=query)
+        resolver.submit('10.0.0.1')
+        self.assertFalse(resolver.wait(0.2))
+        self.assertEqual(resolver.results(), [])
+        self.assertTrue(resolver.busy)
+
+        query.release()
+        self.assertTrue(resolver.wait(5))
+        self.assertEqual(len(resolver.results()), 1)
+
+    def test_invalid_address(self):
+        resolver = WhoisResolver(query=StubQuery())
+        self.assertFalse(resolver.submit('not an address'))
+        self.assertEqual(resolver.queries, 0)
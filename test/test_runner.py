@@ -0,0 +1,84 @@
+"""
+Tests for command runners
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from subprocess import PIPE, CalledProcessError
+
+from ultimatum.runner import CommandRunnerError, RecordingRunner, ReplayRunner, get_runner, set_runner
+from ultimatum.zfs import execute, iter_execute, ZFSError
+
+
+class ReplayRunnerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = ReplayRunner({
+            'zpool list -H -o name': {'output': 'tank\nbackups\n'},
+            'zfs snapshot tank@a': [
+                {'output': '', 'returncode': 1},
+                {'output': '', 'returncode': 0},
+            ],
+        })
+        self.previous = set_runner(self.runner)
+
+    def tearDown(self):
+        set_runner(self.previous)
+
+    def test_set_runner(self):
+        self.assertIs(get_runner(), self.runner)
+
+    def test_output(self):
+        self.assertEqual(execute('zpool list -H -o name'), ['tank', 'backups'])
+        self.assertEqual(list(iter_execute('zpool list -H -o name')), [['tank'], ['backups']])
+        self.assertEqual(self.runner.count, 2)
+        self.assertEqual(self.runner.calls['zpool list -H -o name'], 2)
+
+    def test_repeated_outputs(self):
+        self.assertRaises(ZFSError, execute, 'zfs snapshot tank@a')
+        execute('zfs snapshot tank@a')
+        execute('zfs snapshot tank@a')
+        self.assertEqual(self.runner.calls['zfs snapshot tank@a'], 3)
+
+    def test_check_output(self):
+        self.assertEqual(self.runner.check_output(['zpool', 'list', '-H', '-o', 'name']), 'tank\nbackups\n')
+        self.assertRaises(CalledProcessError, self.runner.check_output, ['zfs', 'snapshot', 'tank@a'])
+
+    def test_missing_command(self):
+        self.assertRaises(OSError, self.runner.popen, ['zfs', 'list'])
+        self.assertRaises(ZFSError, execute, 'zfs list')
+        self.assertEqual(self.runner.count, 0)
+
+    def test_latency(self):
+        self.runner.latency = 0.05
+        process = self.runner.popen(['zpool', 'list', '-H', '-o', 'name'], stdout=PIPE)
+        self.assertEqual(process.communicate()[0], 'tank\nbackups\n')
+        self.assertEqual(process.returncode, 0)
+
+
+class RecordingRunnerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'fixtures.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record_replay(self):
+        recorder = RecordingRunner(self.path)
+        self.assertEqual(recorder.check_output(['echo', 'tank']), 'tank\n')
+        self.assertRaises(CalledProcessError, recorder.check_output, ['false'])
+        recorder.save()
+
+        replay = ReplayRunner(self.path)
+        self.assertEqual(replay.check_output(['echo', 'tank']), 'tank\n')
+        self.assertRaises(CalledProcessError, replay.check_output, ['false'])
+        self.assertEqual(replay.count, 2)
+
+    def test_missing_path(self):
+        self.assertRaises(CommandRunnerError, RecordingRunner().save)
+        self.assertRaises(CommandRunnerError, ReplayRunner, os.path.join(self.directory, 'missing.json'))
@@ -0,0 +1,234 @@
+"""
+Tests for sysctl value parsing, trees and samplers
+"""
+
+import struct
+import unittest
+
+from ultimatum.sysctl import parse_output, parse_value, format_value, decode_struct, decode_value, SysCtlError
+from ultimatum.sysctl import CTLTYPE_INT, CTLTYPE_LONG, CTLTYPE_OPAQUE, CTLTYPE_STRING, CTLTYPE_U8, CTLTYPE_U64
+from ultimatum.sysctl import FakeSysCtlBackend, SysCtlSampler, SysCtlTree
+
+MIB = {
+    'kern.ostype': 'FreeBSD',
+    'kern.maxproc': '6164',
+    'kern.cp_time': '100 0 50 5 845',
+    'hw.acpi.thermal.tz0.temperature': '27.9C',
+    'vm.loadavg': '{ 0.10 0.20 0.30 }',
+    'kern.clockrate': '{ hz = 1000, tick = 1000, profhz = 8128, stathz = 127 }',
+    'net.inet.tcp.sendspace': '32768',
+    'net.inet.tcp.recvspace': '65536',
+}
+
+
+class SysCtlParserTests(unittest.TestCase):
+
+    def test_parse_value(self):
+        self.assertEqual(parse_value('6164'), 6164)
+        self.assertEqual(parse_value('0.5'), 0.5)
+        self.assertEqual(parse_value('27.9C'), 27.9)
+        self.assertEqual(parse_value('100 0 50'), (100, 0, 50))
+        self.assertEqual(parse_value('{ 0.10 0.20 0.30 }'), (0.1, 0.2, 0.3))
+        self.assertEqual(
+            parse_value('{ hz = 1000, tick = 1000, profhz = 8128, stathz = 127 }'),
+            {'hz': 1000, 'tick': 1000, 'profhz': 8128, 'stathz': 127}
+        )
+        self.assertEqual(parse_value(' FreeBSD '), 'FreeBSD')
+        self.assertEqual(parse_value('{ a b }'), '{ a b }')
+
+    def test_format_value(self):
+        self.assertEqual(format_value((0.1, 0.2, 0.3)), '{ 0.10 0.20 0.30 }')
+        self.assertEqual(format_value({'hz': 1000, 'tick': 1}), '{ hz = 1000, tick = 1 }')
+        self.assertEqual(format_value((1, 2)), '1 2')
+
+    def test_parse_output(self):
+        self.assertEqual(
+            parse_output('kern.ostype=FreeBSD\nkern.maxproc=6164\n\n'),
+            [('kern.ostype', 'FreeBSD'), ('kern.maxproc', '6164')]
+        )
+        self.assertRaises(SysCtlError, parse_output, 'kern.ostype FreeBSD')
+
+
+class SysCtlDecoderTests(unittest.TestCase):
+
+    # CTLFLAG_RD set in OID kinds returned by the kernel
+    CTLFLAG_RD = 0x80000000
+
+    def test_integers(self):
+        self.assertEqual(decode_value(self.CTLFLAG_RD | CTLTYPE_INT, 'I', struct.pack('@i', -6164)), -6164)
+        self.assertEqual(decode_value(CTLTYPE_INT, 'IU', struct.pack('@I', 2 ** 32 - 1)), 2 ** 32 - 1)
+        self.assertEqual(decode_value(CTLTYPE_U64, 'QU', struct.pack('@Q', 2 ** 64 - 1)), 2 ** 64 - 1)
+        self.assertEqual(decode_value(CTLTYPE_U8, 'CU', struct.pack('@B', 255)), 255)
+
+    def test_integer_arrays(self):
+        cp_time = (100, 0, 50, 5, 845)
+        self.assertEqual(decode_value(CTLTYPE_LONG, 'LU', struct.pack('@5L', *cp_time)), cp_time)
+        self.assertEqual(decode_value(CTLTYPE_INT, 'I', struct.pack('@3i', 1, -2, 3)), (1, -2, 3))
+        # Trailing partial value is ignored
+        self.assertEqual(decode_value(CTLTYPE_INT, 'I', struct.pack('@2i', 1, 2) + '\0'), (1, 2))
+
+    def test_temperature(self):
+        self.assertEqual(decode_value(CTLTYPE_INT, 'IK', struct.pack('@i', 3010)), 27.9)
+        self.assertEqual(format_value(decode_value(CTLTYPE_INT, 'IK', struct.pack('@i', 3010))), '27.9C')
+
+    def test_strings(self):
+        self.assertEqual(decode_value(CTLTYPE_STRING, 'A', 'FreeBSD\0'), 'FreeBSD')
+        self.assertEqual(decode_value(CTLTYPE_STRING, 'A', 'FreeBSD\0garbage'), 'FreeBSD')
+        self.assertEqual(decode_value(CTLTYPE_STRING, 'A', ''), '')
+
+    def test_loadavg(self):
+        data = struct.pack('@3Il', 205, 410, 614, 2048)
+        self.assertEqual(decode_struct('S,loadavg', data), (205 / 2048.0, 410 / 2048.0, 614 / 2048.0))
+        self.assertEqual(format_value(decode_value(CTLTYPE_OPAQUE, 'S,loadavg', data)), '{ 0.10 0.20 0.30 }')
+
+    def test_clockinfo(self):
+        data = struct.pack('@5i', 1000, 1000, 0, 127, 8128)
+        self.assertEqual(decode_value(CTLTYPE_OPAQUE, 'S,clockinfo', data), {
+            'hz': 1000, 'tick': 1000, 'spare': 0, 'stathz': 127, 'profhz': 8128,
+        })
+
+    def test_timeval(self):
+        data = struct.pack('@ll', 1483228800, 500)
+        self.assertEqual(decode_value(CTLTYPE_OPAQUE, 'S,timeval', data), {'sec': 1483228800, 'usec': 500})
+
+    def test_unknown_struct(self):
+        data = struct.pack('@4Q', 1, 2, 3, 4)
+        self.assertEqual(decode_struct('S,ipstat', data), None)
+        self.assertEqual(decode_value(CTLTYPE_OPAQUE, 'S,ipstat', data), data)
+
+    def test_short_struct(self):
+        data = struct.pack('@2i', 1000, 1000)
+        self.assertEqual(decode_struct('S,clockinfo', data), None)
+        self.assertEqual(decode_value(CTLTYPE_OPAQUE, 'S,clockinfo', data), data)
+        self.assertEqual(decode_value(CTLTYPE_OPAQUE, 'S,loadavg', ''), '')
+
+
+class SysCtlTreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = FakeSysCtlBackend(MIB)
+
+    def test_lookup(self):
+        tree = SysCtlTree(backend=self.backend)
+        self.assertEqual(tree['kern.maxproc'], 6164)
+        self.assertEqual(tree['hw.acpi.thermal.tz0.temperature'], 27.9)
+        self.assertEqual(tree['kern.clockrate']['hz'], 1000)
+        self.assertEqual(tree.raw('kern.cp_time'), '100 0 50 5 845')
+        self.assertEqual(tree.get('kern.missing'), None)
+        self.assertTrue('vm.loadavg' in tree)
+        self.assertFalse('vm.missing' in tree)
+
+    def test_lazy_reads(self):
+        tree = SysCtlTree(backend=self.backend)
+        self.assertEqual(sorted(tree.keys('net.inet.tcp')), ['net.inet.tcp.recvspace', 'net.inet.tcp.sendspace'])
+        self.assertEqual(tree['net.inet.tcp.sendspace'], 32768)
+        self.assertEqual(dict(tree.items('net.inet.tcp'))['net.inet.tcp.recvspace'], 65536)
+        self.assertEqual(self.backend.reads, 1)
+
+    def test_path(self):
+        tree = SysCtlTree('kern', backend=self.backend)
+        self.assertEqual(sorted(tree.keys()), ['kern.clockrate', 'kern.cp_time', 'kern.maxproc', 'kern.ostype'])
+        self.assertRaises(KeyError, tree.__getitem__, 'vm.loadavg')
+
+    def test_refresh(self):
+        tree = SysCtlTree(backend=self.backend)
+        self.assertEqual(len(list(tree.keys('kern'))), 4)
+        self.assertEqual(tree['kern.maxproc'], 6164)
+        self.backend.mib['kern.maxproc'] = '8192'
+        del self.backend.mib['kern.ostype']
+        self.assertEqual(sorted(tree.refresh('kern')), ['kern.maxproc', 'kern.ostype'])
+        self.assertEqual(tree['kern.maxproc'], 8192)
+        self.assertFalse('kern.ostype' in tree)
+
+    def test_refresh_error(self):
+        tree = SysCtlTree(backend=self.backend)
+        self.assertEqual(len(list(tree.keys('kern'))), 4)
+        read = self.backend.read
+        def fail(path=None):
+            raise SysCtlError('Error reading %s' % path)
+        self.backend.read = fail
+        self.assertRaises(SysCtlError, tree.refresh, 'kern')
+        self.assertRaises(SysCtlError, tree.refresh)
+        self.assertEqual(tree['kern.maxproc'], 6164)
+        self.assertEqual(len(list(tree.keys('kern'))), 4)
+
+        self.backend.read = read
+        self.backend.mib = dict((k, v) for k, v in MIB.items() if not k.startswith('kern.'))
+        self.assertRaises(SysCtlError, tree.refresh, 'kern')
+        self.assertEqual(tree['kern.maxproc'], 6164)
+
+    def test_unknown_retry(self):
+        tree = SysCtlTree(backend=self.backend)
+        self.assertEqual(tree.get('kern.boottime'), None)
+        self.backend.mib['kern.boottime'] = '{ sec = 1483228800, usec = 0 }'
+        self.assertEqual(tree['kern.boottime']['sec'], 1483228800)
+
+
+class SysCtlSamplerTests(unittest.TestCase):
+
+    def test_rates(self):
+        backend = FakeSysCtlBackend({'kern.cp_time': '100 0 50', 'vm.stats.sys.v_syscall': '1000'})
+        sampler = SysCtlSampler(['kern.cp_time', 'vm.stats.sys.v_syscall'], backend=backend)
+        self.assertEqual(sampler.sample(10.0), None)
+        self.assertEqual(sampler.columns, ['kern.cp_time.0', 'kern.cp_time.1', 'kern.cp_time.2', 'vm.stats.sys.v_syscall'])
+
+        backend.mib.update({'kern.cp_time': '300 0 50', 'vm.stats.sys.v_syscall': '1500'})
+        rates = sampler.sample(12.0)
+        self.assertEqual(rates['kern.cp_time.0'], 100.0)
+        self.assertEqual(rates['kern.cp_time.2'], 0.0)
+        self.assertEqual(rates['vm.stats.sys.v_syscall'], 250.0)
+        self.assertEqual(sampler.history('vm.stats.sys.v_syscall'), [(12.0, 250.0)])
+        self.assertEqual(backend.reads, 2)
+
+    def test_wrap(self):
+        backend = FakeSysCtlBackend({'vm.stats.sys.v_intr': '%d' % (2**32 - 10)})
+        sampler = SysCtlSampler(['vm.stats.sys.v_intr'], backend=backend)
+        sampler.sample(0.0)
+        backend.mib['vm.stats.sys.v_intr'] = '10'
+        self.assertEqual(sampler.sample(1.0)['vm.stats.sys.v_intr'], 20.0)
+
+        backend.mib['vm.stats.sys.v_intr'] = '5'
+        self.assertEqual(sampler.sample(2.0)['vm.stats.sys.v_intr'], 5.0)
+
+    def test_uint64_precision(self):
+        backend = FakeSysCtlBackend({'net.inet.tcp.stats': struct.pack('@2Q', 2**64 - 10, 2**60)}, typed=True)
+        sampler = SysCtlSampler(['net.inet.tcp.stats'], backend=backend)
+        sampler.sample(0)
+        backend.mib['net.inet.tcp.stats'] = struct.pack('@2Q', 5, 2**60 + 3)
+        rates = sampler.sample(1)
+        self.assertEqual(rates['net.inet.tcp.stats.0'], 15.0)
+        self.assertEqual(rates['net.inet.tcp.stats.1'], 3.0)
+
+    def test_unknown(self):
+        sampler = SysCtlSampler(['kern.missing'], backend=FakeSysCtlBackend(MIB))
+        self.assertRaises(SysCtlError, sampler.sample)
+        sampler = SysCtlSampler(['kern.ostype'], backend=FakeSysCtlBackend(MIB))
+        self.assertRaises(SysCtlError, sampler.sample)
+
+    def test_empty(self):
+        sampler = SysCtlSampler([], backend=FakeSysCtlBackend(MIB))
+        self.assertEqual(sampler.sample(0.0), None)
+        self.assertEqual(sampler.sample(1.0), {})
+        self.assertEqual(sampler.columns, [])
+        self.assertEqual(sampler.history(), [(1.0, {})])
+
+    def test_counter_structs(self):
+        backend = FakeSysCtlBackend({
+            'net.inet.tcp.stats': struct.pack('@3Q', 10, 20, 30),
+            'kern.hostname': 'hostname',
+        }, typed=True)
+        sampler = SysCtlSampler(['net.inet.tcp.stats'], backend=backend)
+        sampler.sample(0.0)
+        self.assertEqual(sampler.columns, ['net.inet.tcp.stats.0', 'net.inet.tcp.stats.1', 'net.inet.tcp.stats.2'])
+        backend.mib['net.inet.tcp.stats'] = struct.pack('@3Q', 20, 20, 40)
+        rates = sampler.sample(2.0)
+        self.assertEqual(rates['net.inet.tcp.stats.0'], 5.0)
+        self.assertEqual(rates['net.inet.tcp.stats.1'], 0.0)
+
+        # Strings are not unpacked as counters even if their length fits
+        self.assertRaises(SysCtlError, SysCtlSampler(['kern.hostname'], backend=backend).sample)
+        backend.mib['net.inet.tcp.stats'] = 'short'
+        self.assertRaises(SysCtlError, SysCtlSampler(['net.inet.tcp.stats'], backend=backend).sample)
+        sampler = SysCtlSampler(['kern.hostname'], backend=backend, counter_structs=['kern.hostname'])
+        sampler.sample(0.0)
+        self.assertEqual(len(sampler.columns), 1)
@@ -0,0 +1,446 @@
+"""
+Tests for ZFS snapshot parsing and property caches
+"""
+
+import threading
+import time
+import unittest
+
+from cStringIO import StringIO
+from datetime import datetime
+from subprocess import STDOUT
+
+from ultimatum.runner import ReplayRunner, set_runner
+from ultimatum.zfs import execute, execute_async, iter_execute, wait_commands, ZFSCommand, ZFSError
+from ultimatum.zfs import COMMAND_SEMAPHORE, MAX_CONCURRENT_COMMANDS
+from ultimatum.zfs.replication import resume_token_snapshot, run_replications
+from ultimatum.zfs.snapshots import parse_tag_epoch, ZFSSnapshot, ZFSSnapshotIndex, ZFSSnapshotList
+from ultimatum.zfs.zpool import ZPool
+
+from test.fixtures import dataset_names, zfs_fixtures, zfs_pool_fixtures
+
+
+class ParseTagEpochTests(unittest.TestCase):
+
+    def test_default_format(self):
+        expected = int(time.mktime(datetime(2017, 3, 4, 5, 6, 7).timetuple()))
+        self.assertEqual(parse_tag_epoch('20170304-050607'), expected)
+        self.assertEqual(parse_tag_epoch('20170304-050607', '%Y%m%d-%H%M%S'), expected)
+
+    def test_other_format(self):
+        expected = int(time.mktime(datetime(2017, 3, 4).timetuple()))
+        self.assertEqual(parse_tag_epoch('2017-03-04', '%Y-%m-%d'), expected)
+        self.assertEqual(parse_tag_epoch('base', '%Y-%m-%d'), None)
+        self.assertEqual(parse_tag_epoch('2017-02-31', '%Y-%m-%d'), None)
+
+    def test_invalid_tags(self):
+        for tag in ( 'base', '20170304', '20170304-0506', '2017030x-050607', '20171304-050607',
+                     '20170300-050607', '20170304-250607', '20170304_050607', '20170231-000000',
+                     '20170431-120000', '20170304-056007', ):
+            self.assertEqual(parse_tag_epoch(tag), None, tag)
+
+
+class ZFSSnapshotListTests(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshots = ZFSSnapshotList('tank/home')
+        for i, tag in enumerate(( 'base', '20170101-000000', '20170201-000000', '20170301-000000', )):
+            self.snapshots.append(ZFSSnapshot('tank/home@%s' % tag, creation=1000 + i, guid=i + 1))
+
+    def test_lookup(self):
+        self.assertEqual(self.snapshots.get('base').guid, 1)
+        self.assertEqual(self.snapshots.get('tank/home@20170201-000000').guid, 3)
+        self.assertEqual(self.snapshots.get(ZFSSnapshot('tank/home@20170301-000000')).guid, 4)
+        self.assertEqual(self.snapshots.get('tank/other@base'), None)
+        self.assertEqual(self.snapshots.get('missing'), None)
+        self.assertTrue('base' in self.snapshots)
+        self.assertFalse('tank/other@base' in self.snapshots)
+
+    def test_remove(self):
+        self.snapshots.remove('20170201-000000')
+        self.assertEqual(len(self.snapshots), 3)
+        self.assertEqual(self.snapshots.get('20170201-000000'), None)
+        self.assertEqual(
+            self.snapshots.filter(datetime(2017, 1, 1), datetime(2017, 12, 31)),
+            ['20170101-000000', '20170301-000000']
+        )
+        self.assertRaises(ValueError, self.snapshots.remove, 'missing')
+
+    def test_filter(self):
+        self.assertEqual(
+            [x.tag for x in self.snapshots.filter(datetime(2017, 1, 15), datetime(2017, 3, 1))],
+            ['20170201-000000', '20170301-000000']
+        )
+        self.assertEqual(self.snapshots.filter(datetime(2016, 1, 1), datetime(2016, 12, 31)), [])
+
+    def test_latest_common(self):
+        other = ZFSSnapshotList('backups/home')
+        other.append(ZFSSnapshot('backups/home@base', guid=1))
+        other.append(ZFSSnapshot('backups/home@20170201-000000', guid=3))
+        self.assertEqual(self.snapshots.latest_common(other).tag, '20170201-000000')
+
+        other = ZFSSnapshotList('backups/home')
+        other.append(ZFSSnapshot('backups/home@base'))
+        self.assertEqual(self.snapshots.latest_common(other).tag, 'base')
+        self.assertEqual(self.snapshots.latest_common(ZFSSnapshotList('backups/home')), None)
+
+
+class ZFSSnapshotIndexTests(unittest.TestCase):
+
+    def test_process_records(self):
+        index = ZFSSnapshotIndex('tank')
+        index.process_records([
+            ['tank@base', '1000', '0', '4096', '1'],
+            ['tank/home@base', '1000', '0', '4096', '2'],
+            ['tank/home@20170101-000000', '1001', '0', '4096', '3'],
+        ])
+        self.assertEqual(len(index.snapshots('tank/home')), 2)
+        self.assertEqual(index.get_snapshot('tank/home@base').guid, 2)
+        self.assertEqual(index.get_snapshot('tank/var@base'), None)
+        self.assertRaises(ZFSError, index.get_snapshot, 'tank')
+        self.assertRaises(ZFSError, index.process_records, [['tank@base', 'now', '0', '4096', '1']])
+
+
+class PropertyCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        fixtures = zfs_fixtures(20)
+        fixtures.update({
+            'zfs set atime=on tank/group0': {'output': ''},
+            'zfs get -H -t filesystem,volume -o name,property,value all tank/group0': {
+                'output': 'tank/group0\tatime\ton\n'
+            },
+        })
+        self.runner = ReplayRunner(fixtures)
+        self.previous = set_runner(self.runner)
+        self.pool = ZPool('tank')
+
+    def tearDown(self):
+        set_runner(self.previous)
+
+    def test_one_load(self):
+        for fs in self.pool.filesystems:
+            self.assertEqual(fs.get_property('mountpoint'), '/%s' % fs.name)
+        self.assertEqual(self.runner.count, 2)
+
+    def test_invalidate_dataset(self):
+        filesystems = self.pool.filesystems
+        for fs in filesystems:
+            fs.get_property('mountpoint')
+
+        fs = filesystems[1]
+        fs.set_property('atime', True)
+        self.assertEqual(fs.get_property('atime'), True)
+        self.assertEqual(fs.get_property('atime'), True)
+        self.assertEqual(filesystems[0].get_property('mountpoint'), '/tank')
+        self.assertEqual(self.runner.count, 4)
+
+    def test_missing_dataset(self):
+        self.assertRaises(ZFSError, self.pool.filesystem_properties.lookup, 'tank/missing', 'mountpoint')
+        self.assertRaises(ZFSError, self.pool.filesystem_properties.lookup, 'tank/missing', 'mountpoint', False)
+
+    def test_new_dataset(self):
+        self.runner.fixtures['zfs get -H -t filesystem,volume -o name,property,value all tank/new'] = [
+            ('tank/new\tmountpoint\t/tank/new\n', 0)
+        ]
+        self.assertEqual(self.pool.filesystem_properties.lookup('tank/new', 'mountpoint'), '/tank/new')
+        self.assertEqual(self.pool.filesystem_properties.lookup('tank/new', 'mountpoint'), '/tank/new')
+        self.assertEqual(self.runner.count, 2)
+
+    def test_failed_reload(self):
+        properties = self.pool.filesystem_properties
+        index = self.pool.snapshot_index()
+        property_command = ' '.join(properties.command)
+        index_command = ' '.join(index.command)
+        self.runner.fixtures.update({
+            property_command: [
+                self.runner.fixtures[property_command][0],
+                ('tank\tmountpoint\t/tank\n', 1),
+            ],
+            index_command: [
+                self.runner.fixtures[index_command][0],
+                ('tank@base\t1483228800\t0\t4096\t1\n', 1),
+            ],
+        })
+        properties.load()
+        index.load()
+        self.assertEqual(len(properties), 20)
+        self.assertEqual(index.get_snapshot('tank/group0@base').tag, 'base')
+
+        self.assertRaises(ZFSError, properties.load)
+        self.assertRaises(ZFSError, index.load)
+        self.assertTrue(properties.expired)
+        self.assertFalse(index.loaded)
+        self.assertEqual(len(properties), 20)
+        self.assertEqual(len(index), 20)
+
+    def test_snapshot_invalidates_dataset(self):
+        self.runner.fixtures.update({
+            'zfs snapshot tank/group0@new': [('', 0)],
+            'zfs destroy tank/group0@base': [('', 0)],
+            'zfs get -H -t filesystem,volume -o name,property,value all tank/group0': [
+                ('tank/group0\tused\t8192\n', 0),
+                ('tank/group0\tused\t4096\n', 0),
+            ],
+        })
+        filesystems = self.pool.filesystems
+        fs = filesystems[1]
+        self.assertEqual(fs.get_property('used'), None)
+
+        fs.create_snapshot('new')
+        self.assertEqual(fs.get_property('used'), '8192')
+        self.assertEqual(filesystems[2].get_property('mountpoint'), '/%s' % filesystems[2].name)
+        fs.remove_snapshot('base')
+        self.assertEqual(fs.get_property('used'), '4096')
+        self.assertEqual(self.runner.count, 7)
+
+
+class CreateSnapshotsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = ReplayRunner(zfs_pool_fixtures('tank', 20, create_tag='new'))
+        self.previous = set_runner(self.runner)
+        self.pool = ZPool('tank')
+        self.names = ['%s@new' % fs.name for fs in self.pool.filesystems]
+
+    def tearDown(self):
+        set_runner(self.previous)
+
+    def add_fixture(self, names, returncode=0):
+        self.runner.fixtures['zfs snapshot %s' % ' '.join(names)] = [('', returncode)]
+
+    def snapshot_calls(self):
+        return sorted((key, count) for key, count in self.runner.calls.items() if key.startswith('zfs snapshot'))
+
+    def test_batch(self):
+        results = self.pool.create_snapshots('new')
+        self.assertEqual(sorted(results.succeeded), sorted(self.names))
+        self.assertEqual(self.snapshot_calls(), [('zfs snapshot %s' % ' '.join(self.names), 1)])
+        count = self.runner.count
+        for name in self.names:
+            self.assertEqual(self.pool.snapshot_index().get_snapshot(name).tag, 'new')
+        self.assertEqual(self.runner.count, count)
+
+    def test_batch_size(self):
+        for i in range(2, 20, 7):
+            self.add_fixture(self.names[i:i+7])
+        results = self.pool.create_snapshots('new', batch_size=7, filesystems=self.pool.filesystems[2:])
+        self.assertEqual(sorted(results.succeeded), sorted(self.names[2:]))
+        self.assertEqual(self.snapshot_calls(), sorted([
+            ('zfs snapshot %s' % ' '.join(self.names[2:9]), 1),
+            ('zfs snapshot %s' % ' '.join(self.names[9:16]), 1),
+            ('zfs snapshot %s' % ' '.join(self.names[16:20]), 1),
+        ]))
+
+    def test_batch_retry(self):
+        self.add_fixture(self.names[:7])
+        self.add_fixture(self.names[7:14], returncode=1)
+        self.add_fixture(self.names[14:])
+        self.add_fixture(self.names[10:11], returncode=1)
+        results = self.pool.create_snapshots('new', batch_size=7)
+
+        self.assertEqual(results.failed.keys(), [self.names[10]])
+        self.assertEqual(sorted(results.succeeded), sorted(self.names[:10] + self.names[11:]))
+        calls = dict(self.snapshot_calls())
+        for name in self.names[7:14]:
+            self.assertEqual(calls['zfs snapshot %s' % name], 1)
+        for name in self.names[:7] + self.names[14:]:
+            self.assertFalse('zfs snapshot %s' % name in calls)
+        self.assertEqual(self.pool.snapshot_index().get_snapshot(self.names[10]), None)
+
+    def test_parallel(self):
+        results = self.pool.create_snapshots('new', mode='parallel', filesystems=[fs.name for fs in self.pool.filesystems])
+        self.assertEqual(sorted(results.succeeded), sorted(self.names))
+        self.assertEqual(self.snapshot_calls(), sorted(('zfs snapshot %s' % name, 1) for name in self.names))
+
+    def test_existing(self):
+        results = self.pool.create_snapshots('base', mode='parallel', filesystems=['tank/group0'])
+        self.assertEqual(results.failed, {'tank/group0@base': 'Snapshot already exists: tank/group0@base'})
+        self.assertEqual(self.snapshot_calls(), [])
+
+    def test_recursive(self):
+        self.add_fixture(['-r', 'tank/group0@new'])
+        results = self.pool.create_snapshots('new', mode='recursive', root='tank/group0')
+        self.assertEqual(sorted(results.succeeded), sorted(name for name in self.names if name.startswith('tank/group0')))
+        self.assertEqual(len(results.succeeded), 19)
+        self.assertEqual(self.snapshot_calls(), [('zfs snapshot -r tank/group0@new', 1)])
+
+        self.add_fixture(['-r', 'tank@new'], returncode=1)
+        results = self.pool.create_snapshots('new', mode='recursive')
+        self.assertEqual(sorted(results.failed.keys()), sorted(self.names))
+
+    def test_recursive_errors(self):
+        self.add_fixture(['-r', 'tank/typo@new'], returncode=1)
+        self.assertRaises(ZFSError, self.pool.create_snapshots, 'new', mode='recursive', root='tank/typo')
+        self.assertRaises(ZFSError, self.pool.create_snapshots, 'new', mode='recursive', root='other/group0')
+        self.assertEqual(self.snapshot_calls(), [])
+
+        self.add_fixture(['-r', 'tank/group0@new'], returncode=1)
+        results = self.pool.create_snapshots('new', mode='recursive', root='tank/group0')
+        self.assertTrue('tank/group0@new' in results.failed)
+        self.assertEqual(results.succeeded, [])
+
+    def test_invalid(self):
+        self.assertRaises(ZFSError, self.pool.create_snapshots, 'new', mode='recursive', filesystems=['tank/group0'])
+        self.assertRaises(ZFSError, self.pool.create_snapshots, 'new', mode='other')
+        self.assertEqual(self.snapshot_calls(), [])
+
+
+class DatasetNamesTests(unittest.TestCase):
+
+    def test_names(self):
+        names = dataset_names('tank', 1000)
+        self.assertEqual(len(names), 1000)
+        self.assertEqual(len(set(names)), 1000)
+        self.assertTrue(all(name.count('/') <= 2 for name in names))
+
+
+class ZFSCommandTests(unittest.TestCase):
+
+    class StderrRunner(ReplayRunner):
+        """Replay runner merging recorded stderr
+
+        Appends recorded stderr to output of commands started with stderr
+        redirected to stdout
+
+        """
+        def __init__(self, fixtures, stderr):
+            ReplayRunner.__init__(self, fixtures)
+            self.stderr = stderr
+
+        def popen(self, cmd, stdin=None, stdout=None, stderr=None, close_fds=False):
+            process = ReplayRunner.popen(self, cmd, stdin, stdout, stderr, close_fds)
+            if stderr == STDOUT:
+                process.stdout = StringIO(process.output + self.stderr)
+            return process
+
+    def test_stderr(self):
+        runner = self.StderrRunner({'zfs send -nv -t 1-abc': {'output': 'stdout\n'}}, 'stderr\n')
+        previous = set_runner(runner)
+        try:
+            self.assertEqual(execute('zfs send -nv -t 1-abc'), ['stdout'])
+            self.assertEqual(execute('zfs send -nv -t 1-abc', stderr=True), ['stdout', 'stderr'])
+        finally:
+            set_runner(previous)
+
+    def test_nested_records(self):
+        runner = ReplayRunner({
+            'zfs list -Hr -o name tank': {'output': 'tank\ntank/home\n'},
+            'zfs list -H -o name -t snapshot tank': {'output': 'tank@base\n'},
+            'zfs list -H -o name -t snapshot tank/home': {'output': 'tank/home@base\n'},
+        })
+        previous = set_runner(runner)
+        snapshots = []
+
+        def iterate():
+            for record in iter_execute('zfs list -Hr -o name tank'):
+                for snapshot in iter_execute('zfs list -H -o name -t snapshot %s' % record[0]):
+                    snapshots.append(snapshot[0])
+
+        # Leave one command slot free for the nested iteration
+        for i in range(MAX_CONCURRENT_COMMANDS - 1):
+            COMMAND_SEMAPHORE.acquire()
+        try:
+            thread = threading.Thread(target=iterate)
+            thread.daemon = True
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(snapshots, ['tank@base', 'tank/home@base'])
+        finally:
+            for i in range(MAX_CONCURRENT_COMMANDS - 1):
+                COMMAND_SEMAPHORE.release()
+            set_runner(previous)
+
+    def test_callback_error(self):
+        def callback(lines):
+            raise ValueError('Invalid record: %s' % lines[0])
+
+        previous = set_runner(ReplayRunner({'zfs list -H -o name tank': {'output': 'tank\n'}}))
+        try:
+            command = execute_async('zfs list -H -o name tank', callback=callback)
+            self.assertRaises(ZFSError, command.result, 5)
+            self.assertTrue(isinstance(command.error, ZFSError))
+        finally:
+            set_runner(previous)
+
+    def test_wait_deadline(self):
+        previous = set_runner(ReplayRunner(dict(
+            ('zfs list -H tank/%d' % i, {'output': 'tank/%d\n' % i}) for i in range(4)
+        )))
+        # Each command finishes within timeout of the previous one
+        commands = [ZFSCommand('zfs list -H tank/%d' % i) for i in range(4)]
+        timers = [threading.Timer(0.15 * (i + 1), command.run) for i, command in enumerate(commands)]
+        try:
+            for timer in timers:
+                timer.start()
+            self.assertRaises(ZFSError, wait_commands, commands, 0.25)
+            self.assertTrue(commands[-1].cancelled)
+        finally:
+            for timer in timers:
+                timer.cancel()
+                if timer.is_alive():
+                    timer.join()
+            set_runner(previous)
+
+    def test_resume_token_snapshot(self):
+        runner = ReplayRunner({
+            'zfs send -nv -t 1-abc': {'output': 'send from @base to tank/home@20170101-000000 estimated size is 1M\n'},
+            'zfs send -nv -t 1-def': {'output': 'resume token contents:\nnvlist version: 0\n\ttoname = tank/home@20170101-000000\n'},
+        })
+        previous = set_runner(runner)
+        try:
+            self.assertEqual(resume_token_snapshot('1-abc'), None)
+            self.assertEqual(resume_token_snapshot('1-def'), 'tank/home@20170101-000000')
+        finally:
+            set_runner(previous)
+
+
+class ReplicationOrderTests(unittest.TestCase):
+
+    class Replication(object):
+        def __init__(self, volume, events, error=None):
+            self.snapshot = '%s@backup' % volume
+            self.volume = volume
+            self.events = events
+            self.error = error
+
+        def run(self):
+            self.events.append(('start', self.volume))
+            time.sleep(0.01)
+            self.events.append(('finish', self.volume))
+            if self.error is not None:
+                raise ZFSError(self.error)
+
+    def test_parents_first(self):
+        events = []
+        volumes = ( 'tank', 'tank/a', 'tank/a/b', 'tank/a/b/c', 'tank/d', 'tank/d/e', 'tank/f', 'other/g/h', )
+        replications = [self.Replication(volume, events) for volume in reversed(volumes)]
+        replications.append(self.Replication('tank/x', events, error='receive failed'))
+        replications.append(self.Replication('tank/x/y', events))
+        replications.append(self.Replication('tank/x/y/z', events))
+
+        results = run_replications(replications, jobs=4)
+        self.assertEqual(results.failed, {
+            'tank/x@backup': 'receive failed',
+            'tank/x/y@backup': 'Parent replication failed: tank/x@backup',
+            'tank/x/y/z@backup': 'Parent replication failed: tank/x@backup',
+        })
+        self.assertFalse(('start', 'tank/x/y') in events)
+        self.assertEqual(len(results.succeeded), len(volumes))
+
+        for volume in volumes:
+            parent = volume.rsplit('/', 1)[0]
+            if parent != volume and parent in volumes:
+                self.assertTrue(events.index(('finish', parent)) < events.index(('start', volume)), volume)
+
+    def test_parallel_subtrees(self):
+        events = []
+        replications = [self.Replication(volume, events) for volume in ( 'tank/a', 'tank/b', 'tank/c', )]
+        run_replications(replications, jobs=3)
+        self.assertEqual([event for event, volume in events[:3]], ['start', 'start', 'start'])
+
+    def test_errors(self):
+        replication = self.Replication('tank', [])
+        replication.run = lambda: [][0]
+        self.assertRaises(IndexError, run_replications, [replication])
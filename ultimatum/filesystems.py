@@ -3,11 +3,13 @@
 Implementation of FreeBSD filesystem mount point parsing
 """
 
-import os,re
-from subprocess import check_output,CalledProcessError
+import hashlib,os,re,time
+from subprocess import CalledProcessError
 
 from systematic.log import Logger,LoggerError
-from systematic.filesystems import MountPoint,FileSystemError
+from systematic.classes import MountPoint,FileSystemError
+
+from ultimatum.runner import get_runner
 
 PSEUDO_FILESYSTEM = [
     'procfs','devfs',
@@ -15,48 +17,247 @@ PSEUDO_FILESYSTEM = [
 
 RE_MOUNT = re.compile(r'([^\s]*) on ([^\s]+) \(([^\)]*)\)$')
 
+# Seconds to keep mount usage snapshots returned by MountPoints.usage
+USAGE_CACHE_TTL = 10
+
+# Linux mount table, can be used instead of /sbin/mount for testing
+PROC_MOUNTINFO = '/proc/self/mountinfo'
+
+# Events sent to MountPoints callbacks
+MOUNT_ADDED = 'added'
+MOUNT_REMOVED = 'removed'
+MOUNT_CHANGED = 'changed'
+
+def parse_mount_output(output):
+    """
+    Return list of (device, mountpoint, filesystem, flags) tuples from
+    /sbin/mount output
+    """
+    mounts = []
+    for l in [l for l in output.split('\n') if l.strip()!='']:
+        if l[:4] == 'map ':
+            continue
+        m = RE_MOUNT.match(l)
+        if not m:
+            continue
+
+        flags = map(lambda x: x.strip(), m.group(3).split(','))
+        mounts.append((m.group(1), m.group(2), flags[0], tuple(flags[1:])))
+    return mounts
+
+def parse_mountinfo(output):
+    """
+    Return list of (device, mountpoint, filesystem, flags) tuples from
+    Linux /proc/self/mountinfo contents
+    """
+    def unescape(value):
+        return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), value)
+
+    mounts = []
+    for l in [l for l in output.split('\n') if l.strip()!='']:
+        fields = l.split()
+        try:
+            separator = fields.index('-', 6)
+            filesystem, device = fields[separator+1:separator+3]
+        except ValueError:
+            continue
+        flags = tuple(fields[5].split(','))
+        mounts.append((unescape(device), unescape(fields[4]), filesystem, flags))
+    return mounts
+
+def statvfs_usage(mountpoint):
+    """
+    Return usage dictionary for mountpoint with statvfs, in same format as
+    df -k output. Raises OSError if statvfs fails.
+    """
+    stat = os.statvfs(mountpoint)
+    size = stat.f_blocks * stat.f_frsize / 1024
+    used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize / 1024
+    free = stat.f_bavail * stat.f_frsize / 1024
+    if used + free > 0:
+        percent = int(round(used * 100.0 / (used + free)))
+    else:
+        percent = 0
+    return {
+        'mountpoint': mountpoint,
+        'size': long(size),
+        'used': long(used),
+        'free': long(free),
+        'percent': percent
+    }
+
+def df_usage(mountpoints=None):
+    """
+    Return dictionary of mountpoints to usage dictionaries from one df -k
+    command, for given mountpoints or all filesystems. Mountpoints df can't
+    read, like stale network mounts, are not included.
+    """
+    cmd = ['df','-k']
+    if mountpoints is not None:
+        cmd.extend(mountpoints)
+    try:
+        output = get_runner().check_output(cmd)
+    except CalledProcessError, emsg:
+        # Exit code is non-zero if any mountpoint can't be read
+        output = emsg.output is not None and emsg.output or ''
+    except OSError, (ecode, emsg):
+        raise FileSystemError('Error running %s: %s' % (' '.join(cmd), emsg))
+
+    usage = {}
+    fields = []
+    for l in output.split('\n')[1:]:
+        # Long device names are printed on a separate line
+        fields.extend(l.split())
+        if len(fields) < 6:
+            continue
+        (fs,size,used,free,percent) = fields[:5]
+        mp = ' '.join(fields[5:])
+        fields = []
+        try:
+            usage[mp] = {
+                'mountpoint': mp,
+                'size': long(size),
+                'used': long(used),
+                'free': long(free),
+                'percent': int(percent.rstrip('%'))
+            }
+        except ValueError:
+            continue
+    return usage
+
 class MountPoints(dict):
     """
     Mount points for freeBSD filesystems
     """
-    def __init__(self):
+    def __init__(self, usage_ttl=USAGE_CACHE_TTL, mountinfo=None):
         dict.__init__(self)
+        self.usage_ttl = usage_ttl
+        self.mountinfo = mountinfo
+        self.callbacks = []
+        self.__usage = None
+        self.__usage_updated = None
+        self.__hash = None
         self.update()
 
-    def update(self):
+    def __read__(self):
         """
-        Update list of FreeBSD mountpoints based on /sbin/mount output
+        Return raw mount table, from /sbin/mount or mountinfo file
         """
+        if self.mountinfo is not None:
+            try:
+                with open(self.mountinfo, 'r') as fd:
+                    return fd.read()
+            except IOError, (ecode, emsg):
+                raise FileSystemError('Error reading %s: %s' % (self.mountinfo, emsg))
+
         try:
-            output = check_output(['/sbin/mount'])
+            return get_runner().check_output(['/sbin/mount'])
         except CalledProcessError:
             raise FileSystemError('Error running /sbin/mount')
 
-        for l in [l for l in output.split('\n') if l.strip()!='']:
-            if l[:4] == 'map ':
+    def register_callback(self, callback):
+        """
+        Register callback called with event, mountpoint entry and previous
+        entry for changed mountpoints when update() detects changes. Events
+        are MOUNT_ADDED, MOUNT_REMOVED and MOUNT_CHANGED.
+        """
+        self.callbacks.append(callback)
+
+    def update(self):
+        """
+        Update list of FreeBSD mountpoints based on /sbin/mount output, or
+        mountinfo file if given.
+
+        Entries of unchanged mountpoints are kept, and the mount table is not
+        parsed if it has not changed since previous update. Returns list of
+        (event, entry) tuples for added, removed and changed mountpoints.
+        """
+        output = self.__read__()
+        digest = hashlib.sha1(output).hexdigest()
+        if digest == self.__hash:
+            return []
+
+        if self.mountinfo is not None:
+            mounts = parse_mountinfo(output)
+        else:
+            mounts = parse_mount_output(output)
+
+        # Stacked mounts repeat the mountpoint, only the last one is visible
+        mounts = dict((mountpoint, (device, filesystem, flags)) for device, mountpoint, filesystem, flags in mounts)
+
+        events = []
+        for mountpoint, (device, filesystem, flags) in mounts.items():
+            previous = self.get(mountpoint, None)
+            if previous is not None and previous.signature == (device, filesystem, flags):
                 continue
-            m = RE_MOUNT.match(l)
-            if not m:
+
+            entry = BSDMountPoint(device,mountpoint,filesystem,flags)
+            self[mountpoint] = entry
+            if previous is None:
+                events.append((MOUNT_ADDED, entry, None))
+            else:
+                events.append((MOUNT_CHANGED, entry, previous))
+
+        for mountpoint in [mountpoint for mountpoint in self.keys() if mountpoint not in mounts]:
+            events.append((MOUNT_REMOVED, self.pop(mountpoint), None))
+
+        self.__hash = digest
+        if events:
+            self.__usage = None
+
+        for event, entry, previous in events:
+            for callback in self.callbacks:
+                callback(event, entry, previous)
+
+        return [(event, entry) for event, entry, previous in events]
+
+    def usage(self, ttl=None):
+        """
+        Return usage of all mountpoints as dictionary of mountpoints to usage
+        dictionaries. Usage is read with statvfs, and with one df command for
+        mountpoints where statvfs fails. Pseudo filesystems and mountpoints
+        neither can read are skipped. The snapshot is cached for ttl seconds,
+        by default usage_ttl.
+        """
+        if ttl is None:
+            ttl = self.usage_ttl
+        if self.__usage is not None and time.time() - self.__usage_updated < ttl:
+            return self.__usage
+
+        usage = {}
+        failed = []
+        for mountpoint, entry in self.items():
+            if entry.is_virtual:
                 continue
+            try:
+                usage[mountpoint] = statvfs_usage(mountpoint)
+            except (OSError, AttributeError):
+                failed.append(mountpoint)
 
-            device = m.group(1)
-            mountpoint = m.group(2)
-            flags = map(lambda x: x.strip(), m.group(3).split(','))
-            filesystem = flags[0]
-            flags = flags[1:]
+        if failed:
+            try:
+                for mountpoint, value in df_usage(failed).items():
+                    if mountpoint in failed:
+                        usage[mountpoint] = value
+            except FileSystemError:
+                # Usage of mountpoints df can't read is not known
+                pass
 
-            entry = BSDMountPoint(device,mountpoint,filesystem)
-            for f in flags:
-                entry.flags.set(f,True)
-            self[mountpoint] = entry
+        self.__usage = usage
+        self.__usage_updated = time.time()
+        return usage
 
 class BSDMountPoint(MountPoint):
     """
     One BSD mountpoint based on /sbin/mount output line
     Additional attributes:
+    signature   tuple of device, filesystem and flags used to detect changes
     """
-    def __init__(self,device,mountpoint,filesystem):
+    def __init__(self,device,mountpoint,filesystem,flags=()):
         MountPoint.__init__(self,device,mountpoint,filesystem)
+        self.signature = (device, filesystem, tuple(flags))
+        for f in flags:
+            self.flags.set(f,True)
 
     @property
     def is_virtual(self):
@@ -71,22 +272,11 @@ class BSDMountPoint(MountPoint):
         if self.filesystem in PSEUDO_FILESYSTEM:
             return {}
         try:
-            output = check_output(['df','-k',self.mountpoint])
-        except CalledProcessError:
-            raise FileSystemError('Error getting usage for %s' % self.mountpoint)
-
-        (header,usage) = output.split('\n',1)
-        try:
-            usage = ' '.join(usage.split('\n'))
-        except ValueError:
+            return statvfs_usage(self.mountpoint)
+        except (OSError, AttributeError):
             pass
 
-        (fs,size,used,free,percent,mp) = map(lambda x: x.strip(), usage.split())
-        percent = percent.rstrip('%')
-        return {
-            'mountpoint': self.mountpoint,
-            'size': long(size),
-            'used': long(used),
-            'free': long(free),
-            'percent': int(percent)
-        }
+        usage = df_usage([self.mountpoint])
+        if self.mountpoint not in usage:
+            raise FileSystemError('Error getting usage for %s' % self.mountpoint)
+        return usage[self.mountpoint]
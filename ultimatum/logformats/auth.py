@@ -1,28 +1,25 @@
 
 import re
 import os
+import bz2
 import glob
+import gzip
+import hashlib
+import heapq
+import time
+
+from datetime import datetime, timedelta
+from multiprocessing import Pool
 
 from seine.address import IPv4Address, IPv6Address, parse_address
-from seine.whois.arin import ARINReverseIPQuery, WhoisError
 from systematic.log import LogEntry, LogFile, LogFileCollection, LogFileError
 from systematic.sqlite import SQLiteDatabase, SQLiteError
 
-SSH_LOGINS = [
-    re.compile('^Accepted publickey for (?P<user>[^\s]+) from (?P<address>.*) ' +
-        'port (?P<port>\d+) (?P<sshversion>.*): (?P<keytype>.*) (?P<key>.*)$'
-    ),
-]
-SSH_ATTEMPTS = [
-    re.compile('^Invalid user (?P<user>[^\s]+) from (?P<address>.*)'),
-    re.compile('^Failed publickey for (?P<user>[^\s]+) from (?P<address>.*) ' +
-        'port (?P<port>\d+) (?P<sshversion>.*) (?P<keytype>.*) (?P<fingerprint>.*)$'
-    ),
-    re.compile('^error: Received disconnect from (?P<address>[^:+]):.*: Auth fail [preauth]'),
-]
-
+from ultimatum.logformats.netblocks import LRUCache, NetblockIndex, address_value, network_range, sql_range_value
+from ultimatum.logformats.resolver import WhoisResolver
 
 SSH_CONNECT = re.compile('^Connection from (?P<address>[^\s]+) port (?P<port>\d+)$')
+SSH_CONNECTION_CLOSED = re.compile('^Connection closed by (?P<address>[^\s]+) (?P<reason>.*)$')
 SSH_ACCEPT_PUBLICKEY = re.compile('^%s$' % ' '.join([
     'Accepted publickey for (?P<username>[^\s]+)',
     'from (?P<address>[^\s]+)',
@@ -31,12 +28,110 @@ SSH_ACCEPT_PUBLICKEY = re.compile('^%s$' % ' '.join([
     '(?P<keytype>[^\s]+)',
     '(?P<fingerprint>.*)'
 ]))
+SSH_FAILED_PUBLICKEY = re.compile('^Failed publickey for (?P<user>[^\s]+) from (?P<address>.*) ' +
+    'port (?P<port>\d+) (?P<sshversion>.*) (?P<keytype>.*) (?P<fingerprint>.*)$'
+)
+SSH_INVALID_USER = re.compile('^Invalid user (?P<user>.*) from (?P<address>[^\s]+)(?: port (?P<port>\d+))?$')
+SSH_LOGIN = re.compile('^User child is on pid (?P<pid>\d+)$')
+SSH_RECEIVED_DISCONNECT = re.compile('^Received disconnect from (?P<address>[^\s]+): (?P<reason>.*)$')
+
+# SSH messages classified by SSHMessageClassifier: literal message prefix,
+# message kind and regexp for message fields. Messages for formats without
+# regexp must be equal to the prefix.
+SSH_MESSAGE_FORMATS = (
+    ('Connection from ', 'connect', SSH_CONNECT),
+    ('Connection closed by ', 'connection_closed', SSH_CONNECTION_CLOSED),
+    ('Accepted publickey for ', 'accepted_publickey', SSH_ACCEPT_PUBLICKEY),
+    ('Failed publickey for ', 'failed_publickey', SSH_FAILED_PUBLICKEY),
+    ('Invalid user ', 'invalid_user', SSH_INVALID_USER),
+    ('User child is on pid ', 'user_child', SSH_LOGIN),
+    ('Received disconnect from ', 'disconnect', SSH_RECEIVED_DISCONNECT),
+    ('fatal: Read from socket failed: Connection reset by peer [preauth]', 'connection_reset', None),
+)
+
+# Message kinds returned as failed logins by AuthLogFile
+SSH_FAILURE_KINDS = (
+    'invalid_user',
+    'failed_publickey',
+)
+
+
+class SSHMessageClassifier(dict):
+    """SSH message classifier
+
+    Map of first words of SSH log messages to message formats. Messages are
+    classified by comparing the literal prefixes of formats for the first
+    word of the message, and only the regexp of the matching format is run.
+
+    """
+    def __init__(self, formats=SSH_MESSAGE_FORMATS):
+        dict.__init__(self)
+        for prefix, kind, regexp in formats:
+            word = prefix.split(' ', 1)[0]
+            if word not in self:
+                self[word] = []
+            self[word].append((prefix, kind, regexp))
+
+    def classify(self, message):
+        """Classify message
+
+        Return tuple (kind, fields) with message kind and dictionary of
+        message fields, or (None, None) for unknown messages
+
+        """
+        formats = self.get(message.partition(' ')[0], None)
+        if formats is None:
+            return None, None
+
+        for prefix, kind, regexp in formats:
+            if not message.startswith(prefix):
+                continue
+            if regexp is None:
+                if message == prefix:
+                    return kind, {}
+                return None, None
+            m = regexp.match(message)
+            if m:
+                return kind, m.groupdict()
+            return None, None
+
+        return None, None
+
+SSH_MESSAGES = SSHMessageClassifier()
 
-SSH_LOGIN = re.compile('User child is on pid (?P<pid>\d+)$')
-SSH_DISCONNECT = re.compile('Received disconnect from (?P<address>[^\s]+): .*: disconnected by user')
-SSH_INVALID_USER = re.compile('^Invalid user (?P<username>.*) from (?P<address>[^\s]+)$')
+# Maximum number of sessions kept in SSHSessionCache
+SSH_SESSION_CACHE_SIZE = 100000
+# Seconds since last log entry to keep user sessions in SSHSessionCache
+SSH_USER_SESSION_EXPIRE = 86400
 
 SSHD_VIOLATIONS_DATABASE_PATH = '/var/lib/ssh/violations.db'
+
+# Log files parsed by update() when no paths are given
+AUTH_LOG_PATTERNS = (
+    '/var/log/auth.log*',
+    '/var/log/messages*',
+)
+
+# Rotated log file names: log file name, rotation index and compression suffix
+ROTATED_LOG_FILE = re.compile('^(?P<name>.*?)(?:\.(?P<index>\d+))?(?:\.(?:bz2|gz|xz))?$')
+
+# Number of login attempts inserted per transaction by update()
+INGEST_BATCH_SIZE = 1000
+# Seconds update() waits for whois queries after parsing
+WHOIS_TIMEOUT = 60
+# Number of login attempts fetched per query by login_attempts
+LOGIN_ATTEMPTS_CHUNK_SIZE = 1000
+
+# Number of bytes from start of log files hashed to recognize rotated files
+CHECKPOINT_HEAD_BYTES = 1024
+
+# Pragmas set when opening the violations database
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -8192),
+)
 SQL_TABLES = [
 """CREATE TABLE IF NOT EXISTS registration (
     id              INTEGER PRIMARY KEY,
@@ -52,7 +147,10 @@ SQL_TABLES = [
     description     TEXT,
     network         TEXT,
     start           TEXT,
-    end             TEXT
+    end             TEXT,
+    family          INT,
+    range_start,
+    range_end
 )""",
 """CREATE UNIQUE INDEX IF NOT EXISTS netblock_registration ON netblock(registration, network)""",
 """CREATE TABLE IF NOT EXISTS login (
@@ -62,11 +160,65 @@ SQL_TABLES = [
     address         TEXT,
     username        TEXT
 )""",
-"""CREATE UNIQUE INDEX IF NOT EXISTS attempts ON login(timestamp, address, username)"""
+"""CREATE UNIQUE INDEX IF NOT EXISTS attempts ON login(timestamp, address, username)""",
+# Entries of login_timestamp are ordered by (timestamp, id), so login_attempts
+# pages without a sort step. The attempts index orders rows with the same
+# timestamp by address and username and would need a temporary sort per page.
+"""CREATE INDEX IF NOT EXISTS login_timestamp ON login(timestamp)""",
+"""CREATE INDEX IF NOT EXISTS login_address ON login(address, timestamp)""",
+"""CREATE INDEX IF NOT EXISTS login_username ON login(username, timestamp)""",
+"""CREATE INDEX IF NOT EXISTS login_unregistered ON login(address) WHERE registration IS NULL""",
+"""CREATE TABLE IF NOT EXISTS address (
+    address         TEXT PRIMARY KEY,
+    count           INT,
+    first_seen      DATETIME,
+    last_seen       DATETIME,
+    registration    INT,
+    netblocks       TEXT
+)""",
+"""CREATE INDEX IF NOT EXISTS address_count ON address(count)""",
+"""CREATE INDEX IF NOT EXISTS address_unresolved ON address(registration) WHERE registration IS NOT NULL AND netblocks IS NULL""",
+"""CREATE TRIGGER IF NOT EXISTS login_address_statistics AFTER INSERT ON login
+BEGIN
+    INSERT OR IGNORE INTO address (address, count, first_seen, last_seen)
+        VALUES (NEW.address, 0, NEW.timestamp, NEW.timestamp);
+    UPDATE address SET
+        count = count + NOT EXISTS (
+            SELECT 1 FROM login WHERE address=NEW.address AND timestamp=NEW.timestamp AND id!=NEW.id
+        ),
+        first_seen = MIN(first_seen, NEW.timestamp),
+        last_seen = MAX(last_seen, NEW.timestamp),
+        registration = COALESCE(NEW.registration, registration)
+        WHERE address=NEW.address;
+END""",
+"""CREATE TABLE IF NOT EXISTS checkpoint (
+    id              INTEGER PRIMARY KEY,
+    path            TEXT UNIQUE,
+    inode           INT,
+    size            INT,
+    offset          INT,
+    head            TEXT,
+    head_length     INT,
+    updated         DATETIME
+)"""
 ]
 
+# Netblock range columns missing from databases created by older versions
+NETBLOCK_RANGE_COLUMNS = (
+    'family',
+    'range_start',
+    'range_end',
+)
+NETBLOCK_RANGE_INDEX = """CREATE INDEX IF NOT EXISTS netblock_range ON netblock(family, range_start, range_end)"""
+
 
 class SSHSession(list):
+    """SSH session
+
+    Log entries of a sshd process. Sessions in summary session caches only
+    keep session state, info and start and last entry times, not the entries.
+
+    """
     def __init__(self, sessioncache, entry, pid=None, parent=None, timeout=60):
         self.sessioncache = sessioncache
         self.pid = pid is not None and pid or entry.pid
@@ -74,71 +226,74 @@ class SSHSession(list):
         self.parent = parent
         self.info = {}
 
+        self.keep_entries = not sessioncache.summary
+        self.state = 'init'
+        self.started = entry.time
+        self.last_seen = entry.time
+        self.entries = 0
+        self.expires = None
+
         self.append(entry)
 
     def __repr__(self):
         return self.pid
 
     def append(self, entry):
-        if len(self) == 0:
-            self.state = 'init'
-        list.append(self, entry)
+        if self.keep_entries:
+            list.append(self, entry)
+        self.entries += 1
+        if entry.time > self.last_seen:
+            self.last_seen = entry.time
+
+        kind = entry.kind
+        if kind is None:
+            return
+        fields = entry.fields
+        state = self.state
 
-        m = SSH_CONNECT.match(entry.message)
-        if m:
+        if kind == 'connect':
             self.state = 'connect'
-            self.info['src_address'] = m.groupdict()['address']
-            self.info['src_port'] = m.groupdict()['port']
-            return
+            self.info['src_address'] = fields['address']
+            self.info['src_port'] = fields['port']
 
-        m = SSH_ACCEPT_PUBLICKEY.match(entry.message)
-        if m:
+        elif kind == 'accepted_publickey':
             self.state = 'accepted_publickey'
-            details = m.groupdict()
             for k in ( 'username', 'version', 'keytype', 'fingerprint', ):
-                if k in details:
-                    self.info[k] = details[k]
-                else:
-                    self.info[k] = 'MISSING KEY INFO %s' % k
-            return
+                self.info[k] = fields[k]
 
-        m = SSH_LOGIN.match(entry.message)
-        if m:
+        elif kind == 'user_child':
             if self.parent is not None:
                 self.state = 'user_session'
                 self.info['parent_pid'] = self.parent.pid
                 self.info.update(self.parent.info.items())
             else:
                 self.state = 'login'
-                usersession_pid = m.groupdict()['pid']
+                usersession_pid = fields['pid']
                 if usersession_pid != self.pid:
                     self.sessioncache.append(SSHSession(self.sessioncache, entry, pid=usersession_pid, parent=self))
-            return
-
-        m = SSH_DISCONNECT.match(entry.message)
-        if m:
-            self.state = 'logout'
-            if len(self) > 0:
-                self.info['session_length'] = (entry.time - self[0].time).total_seconds()
-            return
 
-        m = SSH_INVALID_USER.match(entry.message)
-        if m:
+        elif kind == 'invalid_user':
             self.state = 'invalid_user'
-            self.info['username'] = m.groupdict()['username']
-            return
+            self.info['username'] = fields['user']
 
-        if entry.message == 'fatal: Read from socket failed: Connection reset by peer [preauth]':
+        elif kind == 'connection_reset':
             self.state = 'preauth_connection_reset'
 
-        elif 'src_address' in self.info:
-            if entry.message == 'Connection closed by %s [preauth]' % self.info['src_address']:
-                self.state = 'preauth_no_key'
+        elif kind == 'disconnect':
+            if ': disconnected by user' in fields['reason']:
+                self.state = 'logout'
+                self.info['session_length'] = (entry.time - self.started).total_seconds()
 
-            if entry.message == 'Received disconnect from %s: 11: Bye Bye [preauth]' % self.info['src_address']:
+            elif fields['reason'] == '11: Bye Bye [preauth]' and fields['address'] == self.info.get('src_address'):
                 if self.state != 'invalid_user':
                     self.state = 'preauth_disconnect'
 
+        elif kind == 'connection_closed':
+            if fields['reason'] == '[preauth]' and fields['address'] == self.info.get('src_address'):
+                self.state = 'preauth_no_key'
+
+        if self.state != state and self.expires is not None:
+            self.sessioncache.reschedule(self)
 
     def match(self, entry):
         if entry.pid != self.pid:
@@ -147,14 +302,125 @@ class SSHSession(list):
         if self.state == 'user_session':
             return True
 
-        if abs((entry.time - self[0].time).total_seconds()) >= self.timeout:
+        if abs((entry.time - self.started).total_seconds()) >= self.timeout:
             return False
 
         return True
 
 
 class SSHSessionCache(dict):
+    """SSH session cache
+
+    Map of sshd pids to lists of SSHSession objects. Sessions that can no
+    longer match new log entries are expired by log entry timestamps: user
+    sessions after user_session_expire seconds without log entries, other
+    sessions when their match timeout has passed. Sessions to expire are
+    found from a heap ordered by expiry time. Heap entries not matching the
+    expiry time scheduled for the session are skipped.
+
+    At most max_sessions sessions are kept, evicting sessions closest to
+    expiry first. With summary=True sessions do not keep their log entries.
+
+    """
+    def __init__(self, max_sessions=SSH_SESSION_CACHE_SIZE, user_session_expire=SSH_USER_SESSION_EXPIRE, summary=False):
+        dict.__init__(self)
+        self.max_sessions = max_sessions
+        self.user_session_expire = timedelta(seconds=user_session_expire)
+        self.summary = summary
+
+        self.clock = None
+        self.live = 0
+        self.expired = 0
+        self.evicted = 0
+        self.__heap = []
+        self.__counter = 0
+
+    def __expires__(self, session):
+        if session.state == 'user_session':
+            return session.last_seen + self.user_session_expire
+        return session.started + timedelta(seconds=session.timeout)
+
+    def __push__(self, session):
+        self.__counter += 1
+        session.expires = self.__expires__(session)
+        heapq.heappush(self.__heap, (session.expires, self.__counter, session))
+
+    def __pop__(self, before=None):
+        """Pop session
+
+        Pop session with earliest expiry time, or None if heap is empty or
+        no session expires before given time. Heap entries of sessions with
+        later expiry time since they were pushed are pushed again.
+
+        """
+        while self.__heap:
+            expires, counter, session = self.__heap[0]
+            if before is not None and expires >= before:
+                return None
+
+            heapq.heappop(self.__heap)
+            if expires != session.expires:
+                continue
+            current = self.__expires__(session)
+            if current > expires:
+                self.__push__(session)
+                continue
+            return session
+
+        return None
+
+    def __remove__(self, session):
+        # Sessions are lists and compare equal by entries, which summary
+        # sessions do not keep, so remove by identity
+        sessions = self[session.pid]
+        for index, value in enumerate(sessions):
+            if value is session:
+                del sessions[index]
+                break
+        if not sessions:
+            del self[session.pid]
+        session.expires = None
+        self.live -= 1
+
+    def reschedule(self, session):
+        """Reschedule session
+
+        Push session to the expiry heap again if its expiry time is earlier
+        than scheduled, for example after a user session was logged out.
+        Later expiry times are handled when the heap entry is popped.
+
+        """
+        if session.expires is not None and self.__expires__(session) < session.expires:
+            self.__push__(session)
+
+    def expire(self, now=None):
+        """Expire sessions
+
+        Remove sessions expiring before now, by default the latest log entry
+        timestamp seen. Returns number of removed sessions.
+
+        """
+        if now is None:
+            now = self.clock
+        if now is None:
+            return 0
+
+        removed = 0
+        while True:
+            session = self.__pop__(before=now)
+            if session is None:
+                break
+            self.__remove__(session)
+            removed += 1
+
+        self.expired += removed
+        return removed
+
     def match(self, entry):
+        if self.clock is None or entry.time > self.clock:
+            self.clock = entry.time
+            self.expire()
+
         if entry.pid not in self:
             return None
 
@@ -167,11 +433,27 @@ class SSHSessionCache(dict):
         if session.pid not in self:
             self[session.pid] = []
         self[session.pid].append(session)
+        self.live += 1
+        self.__push__(session)
+
+        while self.max_sessions is not None and self.live > self.max_sessions:
+            evicted = self.__pop__()
+            if evicted is None:
+                break
+            self.__remove__(evicted)
+            self.evicted += 1
 
 
 class AuthLogEntry(LogEntry):
+    """Auth log entry
+
+    Log entry with message classified once by SSH_MESSAGES. The message kind
+    and fields are shared by SSH sessions and the failure and login matchers.
+
+    """
     def __init__(self, *args, **kwargs):
         LogEntry.__init__(self, *args, **kwargs)
+        self.kind, self.fields = SSH_MESSAGES.classify(self.message)
 
         if self.program == 'sshd':
             session = self.logfile.sessioncache.match(self)
@@ -187,32 +469,45 @@ class AuthLogFile(LogFile):
         LogFile.__init__(self, *args, **kwargs)
 
         self.sessioncache = sessioncache
+        self.reader = None
 
         self.register_iterator('failures')
         self.register_iterator('logins')
 
     def __match_failed__(self, entry):
-        for matcher in SSH_ATTEMPTS:
-            m = matcher.match(entry.message)
-            if m:
-                details = m.groupdict()
-                entry.update_message_fields(details)
-                return True
-
-        return False
+        if entry.kind not in SSH_FAILURE_KINDS:
+            return False
+        entry.update_message_fields(entry.fields)
+        return True
 
     def __match_login__(self, entry):
-        for matcher in SSH_LOGINS:
-            m = matcher.match(entry.message)
-            if m:
-                details = m.groupdict()
-                if 'port' in details:
-                    details['port'] = int(details['port'])
-                details['address'] = parse_address(details['address'])
-                entry.update_message_fields(details)
-                return True
+        if entry.kind != 'accepted_publickey':
+            return False
+        entry.update_message_fields({
+            'user': entry.fields['username'],
+            'address': parse_address(entry.fields['address']),
+            'port': int(entry.fields['port']),
+            'sshversion': entry.fields['version'],
+            'keytype': entry.fields['keytype'],
+            'key': entry.fields['fingerprint'],
+        })
+        return True
+
+    def parse_line(self, line, year):
+        """Parse log line
 
-        return False
+        Parse line read outside of the log file iterators to AuthLogEntry,
+        without caching the entry in the log file. Raises LogFileError for
+        invalid lines.
+
+        """
+        return self.lineloader(self, line, year=year, source_formats=self.source_formats)
+
+    def match_failure(self, entry):
+        return self.__match_failed__(entry)
+
+    def match_login(self, entry):
+        return self.__match_login__(entry)
 
     def next_failed(self):
         return self.next_iterator_match('failures', callback=self.__match_failed__)
@@ -235,44 +530,331 @@ class AuthLogCollection(LogFileCollection):
         LogFileCollection.__init__(self, *args, **kwargs)
         self.sessioncache = SSHSessionCache()
 
-class SSHViolationsDatabase(SQLiteDatabase):
-    def __init__(self, path=SSHD_VIOLATIONS_DATABASE_PATH):
-        SQLiteDatabase.__init__(self, path, SQL_TABLES)
+class AuthLogReader(object):
+    """Log file reader
+
+    File object wrapper returning only complete lines from offset of the
+    wrapped file. The offset is updated to the start of next unread line, so
+    a partially written last line is read again on next update.
+
+    """
+    def __init__(self, fd, offset=0):
+        self.fd = fd
+        self.offset = offset
+        fd.seek(offset)
+
+    def readline(self):
+        line = self.fd.readline()
+        if not line.endswith('\n'):
+            # Read the partial line again when the rest of it is written
+            if line:
+                self.fd.seek(self.offset)
+            return ''
+        self.offset += len(line)
+        return line
+
+    def read_head(self, length):
+        """Read start of file
+
+        Return first length bytes of file without changing read position
+
+        """
+        position = self.fd.tell()
+        self.fd.seek(0)
+        data = self.fd.read(length)
+        self.fd.seek(position)
+        return data
+
+    def close(self):
+        self.fd.close()
+
+
+class LogCheckpoint(object):
+    """Log file checkpoint
+
+    Offset of the next unparsed line in a log file. Offsets are counted in
+    uncompressed file content. Files are identified by inode and a hash of
+    the first head_length bytes of content, so logs moved or compressed by
+    log rotation are recognized by content.
+
+    """
+    def __init__(self, path, inode=None, size=0, offset=0, head=None, head_length=0):
+        self.path = path
+        self.inode = inode
+        self.size = size
+        self.offset = offset
+        self.head = head
+        self.head_length = head_length
 
-    def lookup_registration_id(self, address):
+    def __repr__(self):
+        return '%s offset %d' % (self.path, self.offset)
+
+
+def rotated_log_order(path):
+    """Rotated log file sort key
+
+    Sort key ordering rotated log files oldest first: files with same name
+    by descending rotation index and the current file without rotation index
+    last, for example auth.log.1.bz2, auth.log.0.bz2 and auth.log
+
+    """
+    m = ROTATED_LOG_FILE.match(path)
+    if m.group('index') is None:
+        return (m.group('name'), 1, 0)
+    return (m.group('name'), 0, -int(m.group('index')))
+
+def open_log_file(path):
+    """Open log file
+
+    Open gzip, bzip2 or plain text log file for reading. Raises LogFileError
+    if the file can't be read.
+
+    """
+    if not os.path.isfile(path):
+        raise LogFileError('No such file: %s' % path)
+
+    for opener in (gzip.GzipFile, bz2.BZ2File, open):
         try:
-            address = IPv4Address(address)
-        except ValueError:
+            fd = opener(path)
+            fd.readline()
+            fd.seek(0)
+            return fd
+        except IOError:
+            pass
+
+    raise LogFileError('Error opening log file %s' % path)
+
+def open_auth_log(sessioncache, path, checkpoints):
+    """Open log file from checkpoint
+
+    Return AuthLogFile with AuthLogReader for path at offset of the matching
+    checkpoint in checkpoints dictionary and new LogCheckpoint for the file.
+    Lines are read with log.reader and parsed with log.parse_line.
+
+    The checkpoint for path is used if the file has the same inode, head and
+    is not smaller than before. Otherwise the file was rotated or truncated,
+    and a checkpoint with same head for another path is used for rotated
+    files. Files without matching checkpoint are read from start.
+
+    """
+    log = AuthLogFile(sessioncache, path)
+    fd = open_log_file(path)
+    try:
+        stat = os.stat(path)
+    except OSError, (ecode, emsg):
+        raise LogFileError('Error opening %s: %s' % (path, emsg))
+
+    heads = {}
+    def head(length):
+        if length not in heads:
+            fd.seek(0)
+            heads[length] = hashlib.sha1(fd.read(length)).hexdigest()
+        return heads[length]
+
+    data = fd.read(CHECKPOINT_HEAD_BYTES)
+    heads[len(data)] = hashlib.sha1(data).hexdigest()
+    checkpoint = LogCheckpoint(path, stat.st_ino, stat.st_size, 0, heads[len(data)], len(data))
+
+    previous = checkpoints.get(path, None)
+    if previous is not None and previous.inode == stat.st_ino and previous.size <= stat.st_size \
+       and previous.head == head(previous.head_length):
+        checkpoint.offset = previous.offset
+
+    else:
+        for previous in checkpoints.values():
+            if previous.head_length > 0 and previous.head == head(previous.head_length):
+                checkpoint.offset = previous.offset
+                break
+
+    log.reader = AuthLogReader(fd, checkpoint.offset)
+    log.mtime = datetime.fromtimestamp(stat.st_mtime)
+    return log, checkpoint
+
+def read_failures(path, checkpoints=None, sessioncache=None):
+    """Read failed logins
+
+    Parse failed logins from log file. Returns tuple (checkpoint, failures),
+    where failures is list of (timestamp, address, username) tuples. The file
+    is read from the matching checkpoint in checkpoints dictionary and the
+    new LogCheckpoint is returned, or from start with checkpoint None if
+    checkpoints is None. Lines that can't be parsed are skipped.
+
+    """
+    if sessioncache is None:
+        sessioncache = SSHSessionCache()
+
+    log, checkpoint = open_auth_log(sessioncache, path, checkpoints is not None and checkpoints or {})
+    failures = []
+    try:
+        while True:
+            line = log.reader.readline()
+            if line == '':
+                break
             try:
-                address = IPv6Address(address)
-            except ValueError:
-                raise ValueError('ERROR parsing address %s' % address)
+                entry = log.parse_line(line, year=log.mtime.year)
+            except LogFileError:
+                continue
+            if log.match_failure(entry):
+                failures.append((entry.time, entry.message_fields['address'], entry.message_fields['user']))
+    finally:
+        log.reader.close()
+
+    if checkpoints is None:
+        return None, failures
+    checkpoint.offset = log.reader.offset
+    return checkpoint, failures
+
+def read_failures_worker(args):
+    """Read failed logins in process pool
+
+    Process pool wrapper for read_failures called with (path, checkpoints)
+
+    """
+    return read_failures(*args)
+
+
+class IngestStatistics(object):
+    """Ingest statistics
+
+    Counters for login attempts parsed and inserted by update(). The
+    elapsed time does not include waiting for whois queries.
+
+    """
+    def __init__(self):
+        self.parsed = 0
+        self.inserted = 0
+        self.backfilled = 0
+        self.started = time.time()
+        self.finished = None
+
+    def __repr__(self):
+        return '%d login attempts parsed, %d inserted in %.1f seconds (%d rows/sec), %d registrations backfilled' % (
+            self.parsed, self.inserted, self.elapsed, self.rate, self.backfilled
+        )
+
+    @property
+    def elapsed(self):
+        if self.finished is not None:
+            return self.finished - self.started
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        """Insert rate
+
+        Rows inserted per second
+
+        """
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0
+        return self.inserted / elapsed
+
+    def finish(self):
+        self.finished = time.time()
+
+
+class SSHViolationsDatabase(SQLiteDatabase):
+    """SSH violations database
+
+    SQLite database of failed SSH logins and ARIN registrations of their
+    source addresses. The pragmas are set when the database is opened; by
+    default the database uses WAL journal with relaxed syncing, so batched
+    inserts do not wait for a fsync per row.
+
+    """
+    def __init__(self, path=SSHD_VIOLATIONS_DATABASE_PATH, pragmas=SQLITE_PRAGMAS, resolver=None):
+        SQLiteDatabase.__init__(self, path, SQL_TABLES)
+        self.__netblock_index = None
+        self.__resolver = resolver
 
         c = self.cursor
-        c.execute("""SELECT registration,network FROM netblock""")
-        for entry in c.fetchall():
-            try:
-                network = IPv4Address(entry[1])
-            except ValueError:
+        for name, value in pragmas:
+            c.execute("""PRAGMA %s=%s""" % (name, value))
+            c.fetchall()
+
+        self.__upgrade_netblocks__()
+        self.__upgrade_addresses__()
+
+    def __upgrade_netblocks__(self):
+        """Add netblock ranges
+
+        Add range columns to netblock tables created by older versions and fill
+        them from the netblock network
+
+        """
+        c = self.cursor
+        c.execute("""PRAGMA table_info(netblock)""")
+        columns = [r[1] for r in c.fetchall()]
+        missing = [column for column in NETBLOCK_RANGE_COLUMNS if column not in columns]
+        if missing:
+            for column in missing:
+                c.execute("""ALTER TABLE netblock ADD COLUMN %s""" % column)
+
+            c.execute("""SELECT id,network FROM netblock""")
+            for netblock_id, network in c.fetchall():
                 try:
-                    network = IPv6Address(enrty[1])
+                    family, first, last = network_range(network)
                 except ValueError:
+                    self.log.debug('Error parsing netblock %s' % network)
                     continue
+                c.execute("""UPDATE netblock SET family=?, range_start=?, range_end=? WHERE id=?""",
+                    (family, sql_range_value(family, first), sql_range_value(family, last), netblock_id, )
+                )
 
-            if type(network) != type(address):
-                continue
+        c.execute(NETBLOCK_RANGE_INDEX)
+        self.commit()
 
-            if network.hostInNetwork('%s' % address):
-                return entry[0]
+    def __upgrade_addresses__(self):
+        """Fill address statistics
 
-        return None
+        Build address statistics for login attempts inserted by older versions,
+        which did not have the address table
+
+        """
+        c = self.cursor
+        c.execute("""SELECT EXISTS (SELECT 1 FROM address), EXISTS (SELECT 1 FROM login)""")
+        addresses, logins = c.fetchone()
+        if logins and not addresses:
+            self.rebuild_address_statistics()
+
+    @property
+    def netblock_index(self):
+        """Netblock index
+
+        NetblockIndex of all netblocks, loaded on first use
+
+        """
+        if self.__netblock_index is None:
+            index = NetblockIndex()
+            c = self.cursor
+            c.execute("""SELECT registration,network FROM netblock WHERE family IS NOT NULL""")
+            for registration, network in c.fetchall():
+                try:
+                    index.add_network(network, registration)
+                except ValueError:
+                    continue
+            self.__netblock_index = index
+        return self.__netblock_index
+
+    def lookup_registration_id(self, address):
+        """Lookup registration
+
+        Return registration ID of the most specific netblock containing address,
+        or None if address is not in any known netblock
+
+        """
+        try:
+            return self.netblock_index.lookup(address)
+        except ValueError:
+            raise ValueError('ERROR parsing address %s' % address)
 
     def add_netblock(self, ref):
         c = self.cursor
         c.execute("""SELECT id FROM registration WHERE handle=?""", (ref.handle,))
         r = c.fetchone()
         if r is not None:
-            return None
+            return r[0]
 
         c.execute("""INSERT INTO registration (version, handle, comment, registered, updated) """ +
             """VALUES (?,?,?,?,?)""",
@@ -285,126 +867,497 @@ class SSHViolationsDatabase(SQLiteDatabase):
 
         for netblock in ref:
             if isinstance(netblock.network, IPv4Address):
-                c.execute("""INSERT INTO netblock (registration, description, network, start, end) """ +
-                    """VALUES (?,?,?,?,?)""",
-                    (
-                        ref_id,
-                        netblock.description,
-                        netblock.network.cidr_address,
-                        netblock.start.cidr_address,
-                        netblock.end.cidr_address,
-                    )
-                )
+                network = netblock.network.cidr_address
+                start = netblock.start.cidr_address
+                end = netblock.end.cidr_address
             elif isinstance(netblock.network, IPv6Address):
-                    (
-                        ref_id,
-                        netblock.description,
-                        '%s' % netblock.network,
-                        '%s' % netblock.start,
-                        '%s' % netblock.end,
-                    )
+                network = '%s' % netblock.network
+                start = '%s' % netblock.start
+                end = '%s' % netblock.end
+            else:
+                continue
+
+            try:
+                family, first, last = network_range(network)
+            except ValueError:
+                self.log.debug('Error parsing netblock %s' % network)
+                continue
+
+            c.execute("""INSERT OR IGNORE INTO netblock """ +
+                """(registration, description, network, start, end, family, range_start, range_end) """ +
+                """VALUES (?,?,?,?,?,?,?,?)""",
+                (
+                    ref_id,
+                    netblock.description,
+                    network,
+                    start,
+                    end,
+                    family,
+                    sql_range_value(family, first),
+                    sql_range_value(family, last),
+                )
+            )
+            if self.__netblock_index is not None:
+                self.__netblock_index.add(family, first, last, ref_id)
 
         self.commit()
 
         return ref_id
 
-    def add(self, timestamp, address, username, registration):
+    def add(self, timestamp, address, username, registration, fetch=True):
+        """Add login attempt
+
+        Insert login attempt unless it already exists. With fetch=True the
+        inserted row is returned as dictionary, otherwise True. Returns None
+        if the login attempt already existed.
+
+        """
         c = self.cursor
+        c.execute("""INSERT OR IGNORE INTO login (timestamp, registration, address, username) VALUES (?,?,?,?)""",
+            ( timestamp, registration, address, username, )
+        )
+        inserted = c.rowcount > 0
+        self.commit()
+
+        if not inserted:
+            return None
+        if not fetch:
+            return True
+
         c.execute("""SELECT * FROM login WHERE timestamp=? AND address=? AND username=?""",
             ( timestamp, address, username, )
         )
         r = c.fetchone()
-        if r is not None:
+        return self.as_dict(c, r)
+
+    def add_batch(self, attempts):
+        """Add login attempts
+
+        Insert list of (timestamp, registration, address, username) tuples in
+        one transaction, ignoring existing login attempts. Returns number of
+        inserted rows.
+
+        """
+        if not attempts:
+            return 0
+
+        c = self.cursor
+        try:
+            c.executemany("""INSERT OR IGNORE INTO login (timestamp, registration, address, username) VALUES (?,?,?,?)""",
+                attempts
+            )
+            inserted = c.rowcount
+            self.commit()
+        except:
+            self.rollback()
+            raise
+        return inserted
+
+    @property
+    def resolver(self):
+        """Whois resolver
+
+        WhoisResolver for addresses not in known netblocks, created on first
+        use unless given when opening the database
+
+        """
+        if self.__resolver is None:
+            self.__resolver = WhoisResolver()
+        return self.__resolver
+
+    def lookup_registration(self, address):
+        """Registration for address
+
+        Return registration ID for address from known netblocks, or None if
+        the address is not in known netblocks. Unknown IPv4 addresses are
+        submitted to the whois resolver, and login attempts inserted without
+        registration are updated by backfill_registrations().
+
+        """
+        try:
+            registration = self.lookup_registration_id(address)
+            family = address_value(address)[0]
+        except ValueError:
+            self.log.debug('Error parsing address %s' % address)
             return None
 
-        c.execute("""INSERT INTO login (timestamp, registration, address, username) VALUES (?,?,?,?)""",
-            ( timestamp, registration, address, username, )
+        if registration is None and family == 4:
+            self.resolver.submit(address)
+
+        return registration
+
+    def process_whois_results(self):
+        """Process whois results
+
+        Add registrations of finished whois queries to the database. Returns
+        list of addresses resolved. Addresses not covered by the registration
+        returned for their query are rejected by the resolver, so they are
+        not queried again until its negative cache expires.
+
+        """
+        if self.__resolver is None:
+            return []
+
+        addresses = []
+        for submitted, ref, error in self.__resolver.results():
+            if ref is None:
+                self.log.debug('Error looking up %s: %s' % (' '.join(submitted), error))
+                continue
+            self.add_netblock(ref)
+
+            uncovered = []
+            for address in submitted:
+                if self.lookup_registration_id(address) is not None:
+                    addresses.append(address)
+                else:
+                    uncovered.append(address)
+            if uncovered:
+                self.log.debug('Registration does not cover %s' % ' '.join(uncovered))
+                self.__resolver.reject(uncovered)
+        return addresses
+
+    def backfill_registrations(self, addresses=None):
+        """Backfill registrations
+
+        Set registration of login attempts without registration from known
+        netblocks, for given addresses or all addresses without registration.
+        Returns number of updated login attempts.
+
+        """
+        c = self.cursor
+        if addresses is None:
+            c.execute("""SELECT DISTINCT address FROM login WHERE registration IS NULL""")
+            addresses = [r[0] for r in c.fetchall()]
+
+        registrations = []
+        for address in set(addresses):
+            try:
+                registration = self.lookup_registration_id(address)
+            except ValueError:
+                continue
+            if registration is not None:
+                registrations.append((address, registration))
+
+        if not registrations:
+            return 0
+
+        c.execute("""CREATE TEMP TABLE IF NOT EXISTS backfill (address TEXT PRIMARY KEY, registration INT)""")
+        c.execute("""DELETE FROM backfill""")
+        c.executemany("""INSERT INTO backfill (address, registration) VALUES (?,?)""", registrations)
+        c.execute("""UPDATE login SET registration=""" +
+            """(SELECT registration FROM backfill WHERE backfill.address=login.address) """ +
+            """WHERE registration IS NULL AND address IN (SELECT address FROM backfill)"""
+        )
+        updated = c.rowcount
+        c.execute("""UPDATE address SET netblocks=NULL, registration=""" +
+            """(SELECT registration FROM backfill WHERE backfill.address=address.address) """ +
+            """WHERE registration IS NULL AND address IN (SELECT address FROM backfill)"""
         )
         self.commit()
+        self.update_address_netblocks()
+        return updated
 
-        c.execute("""SELECT * FROM login WHERE timestamp=? AND address=? AND username=?""",
-            ( timestamp, address, username, )
+    def checkpoints(self):
+        """Log checkpoints
+
+        Return dictionary of log file paths to LogCheckpoint objects
+
+        """
+        c = self.cursor
+        c.execute("""SELECT path, inode, size, offset, head, head_length FROM checkpoint""")
+        return dict((r[0], LogCheckpoint(*r)) for r in c.fetchall())
+
+    def save_checkpoint(self, checkpoint):
+        c = self.cursor
+        c.execute("""INSERT OR REPLACE INTO checkpoint """ +
+            """(path, inode, size, offset, head, head_length, updated) VALUES (?,?,?,?,?,?,?)""",
+            (
+                checkpoint.path,
+                checkpoint.inode,
+                checkpoint.size,
+                checkpoint.offset,
+                checkpoint.head,
+                checkpoint.head_length,
+                datetime.now(),
+            )
         )
-        r = c.fetchone()
-        return self.as_dict(c, r)
+        self.commit()
 
-    def update(self, paths=None):
-        matcher = re.compile('^Invalid user (?P<user>[^\s]+) from (?P<address>.*)')
+    def remove_checkpoints(self, paths):
         if not paths:
-            auth_paths = glob.glob('/var/log/auth.log*') + glob.glob('/var/log/messages*')
+            return
+        c = self.cursor
+        c.executemany("""DELETE FROM checkpoint WHERE path=?""", [(path,) for path in paths])
+        self.commit()
 
-        sessioncache = SSHSessionCache()
-        for path in paths:
-            log = AuthLogFile(sessioncache, path)
-            for entry in log.failures:
-                details = {
-                    'timestamp': entry.time,
-                    'address': entry.message_fields['address'],
-                    'username': entry.message_fields['user'],
-                }
-
-                ref = self.lookup_registration_id(details['address'])
-                if ref is not None:
-                    details['registration'] = ref
-
-                elif isinstance(details['address'], IPv4Address):
-                    self.log.debug('ARIN LOOKUP %s' % details['address'])
-                    ref = ARINReverseIPQuery(details['address'])
-                    details['registration'] = self.add_netblock(ref)
+    def open_log(self, sessioncache, path, checkpoints=None):
+        """Open log file from checkpoint
 
-                else:
-                    details['registration'] = None
+        Open log file with open_auth_log, using saved checkpoints if
+        checkpoints is None
 
-                self.add(**details)
+        """
+        if checkpoints is None:
+            checkpoints = self.checkpoints()
+        return open_auth_log(sessioncache, path, checkpoints)
 
-    def map_netblocks(self, values):
+    def update(self, paths=None, batch_size=INGEST_BATCH_SIZE, incremental=True, jobs=1, whois_timeout=WHOIS_TIMEOUT):
+        """Update login attempts
+
+        Parse failed logins from log files, by default files matching
+        AUTH_LOG_PATTERNS with rotated files oldest first, and insert them in
+        batches of batch_size rows with one commit per batch. Returns
+        IngestStatistics.
+
+        With incremental=True only lines added after previous update are
+        parsed, and a checkpoint is saved for each file after its login
+        attempts are inserted.
+
+        With jobs > 1 files are parsed and decompressed by a pool of jobs
+        processes, and the parsed login attempts are inserted in the order
+        of paths as files are finished. Failed logins are parsed from single
+        lines, so sessions crossing file boundaries do not affect the result.
+        SSH sessions are tracked only within each file in this mode.
+
+        Login attempts from unknown addresses are inserted without
+        registration while whois queries run in background. After parsing,
+        update waits for the queries for at most whois_timeout seconds and
+        backfills registrations of all login attempts without registration.
+
+        """
+        if not paths:
+            paths = []
+            for pattern in AUTH_LOG_PATTERNS:
+                paths.extend(sorted(glob.glob(pattern), key=rotated_log_order))
+
+        statistics = IngestStatistics()
+        if incremental:
+            checkpoints = self.checkpoints()
+        else:
+            checkpoints = None
+
+        if jobs > 1 and len(paths) > 1:
+            pool = Pool(min(jobs, len(paths)))
+            results = pool.imap(read_failures_worker, [(path, checkpoints) for path in paths])
+        else:
+            pool = None
+            sessioncache = SSHSessionCache()
+            results = (read_failures(path, checkpoints, sessioncache) for path in paths)
+
+        batch = []
+        try:
+            for checkpoint, failures in results:
+                for timestamp, address, username in failures:
+                    batch.append((timestamp, self.lookup_registration(address), address, username))
+                    if len(batch) >= batch_size:
+                        statistics.parsed += len(batch)
+                        statistics.inserted += self.add_batch(batch)
+                        batch = []
+                        self.process_whois_results()
+
+                if checkpoint is not None:
+                    statistics.parsed += len(batch)
+                    statistics.inserted += self.add_batch(batch)
+                    batch = []
+                    self.save_checkpoint(checkpoint)
+
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        statistics.parsed += len(batch)
+        statistics.inserted += self.add_batch(batch)
+        statistics.finish()
+
+        if self.__resolver is not None:
+            self.__resolver.wait(whois_timeout)
+            self.process_whois_results()
+        statistics.backfilled = self.backfill_registrations()
+        self.update_address_netblocks()
+
+        if checkpoints is not None:
+            self.remove_checkpoints([
+                path for path in checkpoints if path not in paths and not os.path.exists(path)
+            ])
+
+        self.log.debug('%s' % statistics)
+        return statistics
+
+    def rebuild_address_statistics(self):
+        """Rebuild address statistics
+
+        Replace address statistics with aggregates of all login attempts. The
+        statistics are maintained by a trigger when login attempts are
+        inserted, so this is only needed for databases from older versions.
+
+        """
+        c = self.cursor
+        c.execute("""DELETE FROM address""")
+        c.execute("""INSERT INTO address (address, count, first_seen, last_seen, registration) """ +
+            """SELECT address, COUNT(DISTINCT timestamp), MIN(timestamp), MAX(timestamp), MAX(registration) """ +
+            """FROM login GROUP BY address"""
+        )
+        self.commit()
+        self.update_address_netblocks()
+
+    def update_address_netblocks(self):
+        """Resolve address netblocks
+
+        Store netblocks of registration containing the address for address
+        statistics with registration but no resolved netblocks. Returns number
+        of updated addresses.
+
+        """
         c = self.cursor
-        c.execute("""SELECT registration,network FROM netblock ORDER BY registration""")
+        c.execute("""SELECT address, registration FROM address WHERE registration IS NOT NULL AND netblocks IS NULL""")
+        addresses = c.fetchall()
 
-        registration_netblock_map = {}
-        for nb in c.fetchall():
-            if nb[0] not in registration_netblock_map:
-                registration_netblock_map[nb[0]] = []
+        updates = []
+        for address, registration in addresses:
             try:
-                address = IPv4Address(nb[1])
+                family, value = address_value(address)
             except ValueError:
-                try:
-                    address = IPv6Address(nb[1])
-                except ValueError:
-                    continue
+                continue
+            value = sql_range_value(family, value)
+            c.execute("""SELECT network FROM netblock """ +
+                """WHERE registration=? AND family=? AND range_start<=? AND range_end>=? """ +
+                """ORDER BY range_start, range_end DESC""",
+                (registration, family, value, value, )
+            )
+            updates.append((' '.join(r[0] for r in c.fetchall()), address))
 
-            if address not in registration_netblock_map[nb[0]]:
-                registration_netblock_map[nb[0]].append(address)
+        if updates:
+            c.executemany("""UPDATE address SET netblocks=? WHERE address=?""", updates)
+            self.commit()
+        return len(updates)
 
-        for reg in registration_netblock_map:
-            registration_netblock_map[reg].sort()
+    def address_netblocks(self, address):
+        """Address netblocks
 
-        for value in values:
-            value['netblocks'] = []
-            if value['registration'] in registration_netblock_map:
-                for nb in registration_netblock_map[value['registration']]:
-                    if nb.hostInNetwork(value['address']):
-                        value['netblocks'].append(nb)
+        Return list of resolved netblocks for source address
 
+        """
+        c = self.cursor
+        c.execute("""SELECT netblocks FROM address WHERE address=?""", (address,))
+        r = c.fetchone()
+        if r is None or r[0] is None:
+            return []
+        return r[0].split()
+
+    def map_netblocks(self, values):
+        """Map netblocks
+
+        Set netblocks of values with address field to list of networks from
+        address statistics
+
+        """
+        netblocks = {}
+        for value in values:
+            address = value['address']
+            if address not in netblocks:
+                netblocks[address] = self.address_netblocks(address)
+            value['netblocks'] = list(netblocks[address])
         return values
 
+    def address_statistics(self):
+        """Address statistics
+
+        Return list of (address, count, first_seen, last_seen, registration)
+        tuples for source addresses of login attempts, where count is number
+        of distinct attempt timestamps
+
+        """
+        c = self.cursor
+        c.execute("""SELECT address, count, first_seen, last_seen, registration FROM address""")
+        return c.fetchall()
+
     def source_address_counts(self):
+        """Source address counts
+
+        Return address statistics as dictionaries with resolved netblocks,
+        sorted by number of login attempts
+
+        """
         c = self.cursor
-        c.execute("""SELECT COUNT(DISTINCT timestamp) AS count, registration, address """ +
-            """FROM login GROUP BY address ORDER BY -count"""
+        c.execute("""SELECT count, registration, address, first_seen, last_seen, netblocks """ +
+            """FROM address ORDER BY count DESC"""
         )
-        return self.map_netblocks([self.as_dict(c,r) for r in c.fetchall()])
+        values = []
+        for r in c.fetchall():
+            value = self.as_dict(c, r)
+            value['netblocks'] = value['netblocks'] is not None and value['netblocks'].split() or []
+            values.append(value)
+        return values
 
-    def login_attempts(self, start=None):
-        c = self.cursor
+    def login_attempts(self, start=None, end=None, address=None, username=None, after=None,
+                       limit=None, netblocks=True, chunk_size=LOGIN_ATTEMPTS_CHUNK_SIZE):
+        """Login attempts
 
-        if start is not None:
-            c.execute("""SELECT * FROM login WHERE timestamp >= Datetime(?) """ +
-                """ORDER BY timestamp""",
-                (start,)
-            )
-        else:
-            c.execute("""SELECT * FROM login ORDER BY timestamp""")
+        Iterate login attempts as dictionaries ordered by timestamp and id.
+        Attempts can be filtered by start (inclusive) and end (exclusive)
+        time, source address and username.
 
-        return self.map_netblocks([self.as_dict(c, r) for r in c.fetchall()])
+        Rows are fetched in chunks of chunk_size rows, continuing each query
+        after the last returned row, so memory use does not depend on number
+        of rows. For pagination, pass the (timestamp, id) of last row of the
+        previous page as after, and the page size as limit.
 
+        With netblocks=True the resolved netblocks are added to each row,
+        looked up once per address.
+
+        """
+        filters = []
+        values = []
+        if start is not None:
+            filters.append('timestamp >= Datetime(?)')
+            values.append(start)
+        if end is not None:
+            filters.append('timestamp < Datetime(?)')
+            values.append(end)
+        if address is not None:
+            filters.append('address=?')
+            values.append(address)
+        if username is not None:
+            filters.append('username=?')
+            values.append(username)
+
+        netblock_cache = LRUCache()
+        c = self.cursor
+        while limit is None or limit > 0:
+            query_filters = list(filters)
+            query_values = list(values)
+            if after is not None:
+                query_filters.append('timestamp >= ? AND (timestamp > ? OR id > ?)')
+                query_values.extend([after[0], after[0], after[1]])
+
+            size = limit is not None and min(limit, chunk_size) or chunk_size
+            query = """SELECT * FROM login"""
+            if query_filters:
+                query += """ WHERE %s""" % ' AND '.join(query_filters)
+            query += """ ORDER BY timestamp, id LIMIT %d""" % size
+
+            c.execute(query, query_values)
+            rows = [self.as_dict(c, r) for r in c.fetchall()]
+            if not rows:
+                break
+
+            for row in rows:
+                if netblocks:
+                    try:
+                        row['netblocks'] = list(netblock_cache.lookup(row['address']))
+                    except KeyError:
+                        netblock_cache[row['address']] = self.address_netblocks(row['address'])
+                        row['netblocks'] = list(netblock_cache[row['address']])
+                yield row
+
+            if len(rows) < size:
+                break
+            if limit is not None:
+                limit -= len(rows)
+            after = (rows[-1]['timestamp'], rows[-1]['id'])
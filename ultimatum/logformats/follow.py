@@ -0,0 +1,322 @@
+"""
+Follow auth.log for SSH violations
+
+Long running follower tailing auth.log across log rotations, inserting failed
+logins to the violations database and keeping per-address counters in memory.
+Counters can be read by other processes from a local unix socket.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+from systematic.log import LogFileError
+
+from ultimatum.logformats.auth import SSHSessionCache, CHECKPOINT_HEAD_BYTES, INGEST_BATCH_SIZE
+
+DEFAULT_AUTH_LOG = '/var/log/auth.log'
+SSHD_VIOLATIONS_SOCKET_PATH = '/var/run/sshd-violations.sock'
+
+# Seconds to wait for new lines when the log file has no unread lines
+FOLLOW_POLL_INTERVAL = 1.0
+
+
+class AddressCounter(object):
+    """Address counter
+
+    Number of failed logins from a source address. Like the database
+    summary, attempts with same timestamp are counted once.
+
+    """
+    def __init__(self, address, count=0, first_seen=None, last_seen=None, registration=None):
+        self.address = address
+        self.count = count
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.registration = registration
+
+    def __repr__(self):
+        return '%s %d' % (self.address, self.count)
+
+    def as_dict(self):
+        return {
+            'address': self.address,
+            'count': self.count,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+            'registration': self.registration,
+        }
+
+
+class AddressCounters(dict):
+    """Address counters
+
+    Map of source addresses to AddressCounter objects, safe to read from
+    other threads while the follower updates it
+
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.lock = threading.Lock()
+
+    @property
+    def total(self):
+        with self.lock:
+            return sum(counter.count for counter in self.values())
+
+    def load(self, database):
+        """Load counters
+
+        Replace counters with address statistics from database
+
+        """
+        with self.lock:
+            self.clear()
+            for address, count, first_seen, last_seen, registration in database.address_statistics():
+                self[address] = AddressCounter(address, count, first_seen, last_seen, registration)
+
+    def add(self, timestamp, address, registration=None):
+        """Count login attempt
+
+        Count a failed login and return tuple (counter, new) where new is
+        True for addresses not seen before
+
+        """
+        timestamp = '%s' % timestamp
+        with self.lock:
+            new = address not in self
+            if new:
+                self[address] = AddressCounter(address, first_seen=timestamp, registration=registration)
+
+            counter = self[address]
+            if counter.last_seen != timestamp:
+                counter.count += 1
+                counter.last_seen = timestamp
+            if registration is not None:
+                counter.registration = registration
+
+        return counter, new
+
+    def update_registrations(self, database, addresses):
+        """Update registrations
+
+        Update counter registrations for addresses from database netblocks
+
+        """
+        for address in addresses:
+            registration = database.lookup_registration_id(address)
+            with self.lock:
+                if address in self:
+                    self[address].registration = registration
+
+    def summary(self):
+        """Counter summary
+
+        Return counters as list of dictionaries sorted by count
+
+        """
+        with self.lock:
+            counters = [counter.as_dict() for counter in self.values()]
+        return sorted(counters, key=lambda x: (-x['count'], x['address']))
+
+
+class CountersRequestHandler(StreamRequestHandler):
+    def handle(self):
+        for counter in self.server.counters.summary():
+            self.wfile.write('%s\n' % json.dumps(counter))
+
+
+class CountersSocketServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, counters):
+        self.counters = counters
+        if os.path.exists(path):
+            os.unlink(path)
+        UnixStreamServer.__init__(self, path, CountersRequestHandler)
+
+
+class CountersSocketThread(threading.Thread):
+    """Counters socket
+
+    Thread serving address counters on a unix socket. Each client connection
+    receives the counter summary as JSON lines.
+
+    """
+    def __init__(self, counters, path=SSHD_VIOLATIONS_SOCKET_PATH):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.server = CountersSocketServer(path, counters)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def read_counters(path=SSHD_VIOLATIONS_SOCKET_PATH, timeout=5):
+    """Read counters from socket
+
+    Return counter summary served by a follower on unix socket path as list
+    of dictionaries. Raises socket.error if the follower is not running.
+
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        fd = client.makefile('r')
+        return [json.loads(line) for line in fd if line.strip() != '']
+    finally:
+        client.close()
+
+
+class SSHViolationsFollower(object):
+    """SSH violations follower
+
+    Follows auth.log from the last saved checkpoint, reopening the file when
+    it is rotated or truncated. Failed logins are parsed as lines are written
+    and inserted with the batched database path: at most batch_size rows are
+    collected while lines are available, and collected rows are inserted
+    whenever the follower catches up with the file. The file checkpoint is
+    saved after each insert.
+
+    Registered callbacks are called with the AddressCounter and a flag for
+    addresses not seen before for each failed login. Registrations of new
+    addresses are resolved in background and set on next insert after the
+    whois query finished.
+
+    """
+    def __init__(self, database, path=DEFAULT_AUTH_LOG, batch_size=INGEST_BATCH_SIZE,
+                 poll_interval=FOLLOW_POLL_INTERVAL):
+        self.database = database
+        self.path = path
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+        self.counters = AddressCounters()
+        self.sessioncache = SSHSessionCache(summary=True)
+        self.callbacks = []
+        self.log = None
+        self.checkpoint = None
+        self.batch = []
+        self.__stopped = threading.Event()
+
+    def __repr__(self):
+        return 'follow %s' % self.path
+
+    def __open__(self):
+        self.log, self.checkpoint = self.database.open_log(self.sessioncache, self.path)
+
+    def __rotated__(self):
+        """Check for rotation
+
+        Return True if log path was replaced or truncated
+
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_ino != self.checkpoint.inode or stat.st_size < self.log.reader.offset
+
+    def register_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def process_line(self, line):
+        """Process log line
+
+        Parse a log line and count and queue failed logins for insert
+
+        """
+        try:
+            entry = self.log.parse_line(line, year=time.localtime().tm_year)
+        except LogFileError:
+            return
+
+        if not self.log.match_failure(entry):
+            return
+
+        address = entry.message_fields['address']
+        registration = self.database.lookup_registration(address)
+        self.batch.append((entry.time, registration, address, entry.message_fields['user']))
+
+        counter, new = self.counters.add(entry.time, address, registration)
+        for callback in self.callbacks:
+            callback(counter, new)
+
+    def flush(self):
+        """Insert queued login attempts
+
+        Insert queued failed logins and save file checkpoint
+
+        """
+        if self.log is None:
+            return
+        self.database.add_batch(self.batch)
+        self.batch = []
+
+        addresses = self.database.process_whois_results()
+        if addresses:
+            self.database.backfill_registrations(addresses)
+            self.counters.update_registrations(self.database, addresses)
+        else:
+            self.database.update_address_netblocks()
+
+        # Files followed from start are hashed when they have enough content
+        offset = self.log.reader.offset
+        if self.checkpoint.head_length < min(offset, CHECKPOINT_HEAD_BYTES):
+            data = self.log.reader.read_head(CHECKPOINT_HEAD_BYTES)
+            self.checkpoint.head = hashlib.sha1(data).hexdigest()
+            self.checkpoint.head_length = len(data)
+
+        self.checkpoint.offset = offset
+        self.database.save_checkpoint(self.checkpoint)
+
+    def run(self):
+        """Follow log
+
+        Load address counters from database and follow the log until stop()
+        is called
+
+        """
+        self.__stopped.clear()
+        self.counters.load(self.database)
+        self.__open__()
+        try:
+            while not self.__stopped.is_set():
+                line = self.log.reader.readline()
+                if line != '':
+                    self.process_line(line)
+                    if len(self.batch) >= self.batch_size:
+                        self.flush()
+                    continue
+
+                if self.batch:
+                    self.flush()
+
+                if self.__rotated__():
+                    self.flush()
+                    self.log.reader.close()
+                    self.__open__()
+                    continue
+
+                self.__stopped.wait(self.poll_interval)
+        finally:
+            self.flush()
+            self.log.reader.close()
+
+    def stop(self):
+        self.__stopped.set()
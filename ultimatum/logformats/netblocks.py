@@ -0,0 +1,222 @@
+"""
+Netblock interval index for address lookups
+
+Netblocks are stored as integer address ranges per address family. The
+NetblockIndex flattens nested netblocks to sorted non-overlapping ranges, so
+each address is looked up with a single bisect.
+"""
+
+import socket
+
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Number of recently looked up addresses cached by NetblockIndex
+NETBLOCK_LOOKUP_CACHE_SIZE = 4096
+
+ADDRESS_FAMILY_BITS = {
+    4: 32,
+    6: 128,
+}
+ADDRESS_FAMILY_SOCKET = {
+    4: socket.AF_INET,
+    6: socket.AF_INET6,
+}
+
+
+def address_value(address):
+    """Parse address
+
+    Return tuple (family, value) for IPv4 or IPv6 address, where family is 4
+    or 6 and value is the address as integer. Prefix length is ignored.
+    Raises ValueError for invalid addresses.
+
+    """
+    address = ('%s' % address).split('/', 1)[0].strip()
+    family = ':' in address and 6 or 4
+    try:
+        packed = socket.inet_pton(ADDRESS_FAMILY_SOCKET[family], address)
+    except (socket.error, ValueError):
+        raise ValueError('Invalid address %s' % address)
+    return family, int(packed.encode('hex'), 16)
+
+def network_range(network):
+    """Parse network
+
+    Return tuple (family, first, last) with integer bounds of IPv4 or IPv6
+    network in address/prefixlen format. Addresses without prefix length
+    are parsed as host networks. Raises ValueError for invalid networks.
+
+    """
+    network = '%s' % network
+    family, value = address_value(network)
+    bits = ADDRESS_FAMILY_BITS[family]
+
+    if '/' in network:
+        try:
+            prefixlen = int(network.split('/', 1)[1])
+        except ValueError:
+            raise ValueError('Invalid network %s' % network)
+        if not 0 <= prefixlen <= bits:
+            raise ValueError('Invalid network %s' % network)
+    else:
+        prefixlen = bits
+
+    hostmask = (1 << (bits - prefixlen)) - 1
+    first = value & ~hostmask
+    return family, first, first | hostmask
+
+def sql_range_value(family, value):
+    """Range value for SQL
+
+    Return address value for netblock range columns. IPv4 values are stored as
+    integers. IPv6 values do not fit SQLite integers and are stored as fixed
+    width hex strings, which sort in numeric order. The range columns have no
+    type affinity, so hex strings of digits are not converted to numbers.
+
+    """
+    if family == 4:
+        return value
+    return '%032x' % value
+
+
+class LRUCache(OrderedDict):
+    """LRU cache
+
+    Dictionary keeping at most size most recently used items
+
+    """
+    def __init__(self, size=NETBLOCK_LOOKUP_CACHE_SIZE):
+        OrderedDict.__init__(self)
+        self.size = size
+
+    def lookup(self, key):
+        """Lookup item
+
+        Return cached item and mark it recently used. Raises KeyError if key
+        is not cached.
+
+        """
+        value = OrderedDict.pop(self, key)
+        OrderedDict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self:
+            OrderedDict.__delitem__(self, key)
+        OrderedDict.__setitem__(self, key, value)
+        while len(self) > self.size:
+            self.popitem(last=False)
+
+
+class NetblockIndex(object):
+    """Netblock interval index
+
+    In-memory index of netblock ranges mapping addresses to registration IDs.
+    Netblocks are CIDR networks, so any two netblocks are either disjoint or
+    nested. Nested netblocks are flattened to non-overlapping ranges owned by
+    the most specific netblock when the index is next used, and addresses are
+    looked up with bisect.
+
+    Results for recently looked up addresses are cached in a LRU cache of
+    cache_size addresses.
+
+    """
+    def __init__(self, cache_size=NETBLOCK_LOOKUP_CACHE_SIZE):
+        self.cache = LRUCache(cache_size)
+        self.__netblocks = {}
+        self.__ranges = {}
+
+    def __len__(self):
+        return sum(len(netblocks) for netblocks in self.__netblocks.values())
+
+    def __flatten__(self, netblocks):
+        """Flatten netblocks
+
+        Return sorted lists of range starts and (end, registration) tuples
+        for non-overlapping ranges covered by netblocks
+
+        """
+        starts = []
+        ranges = []
+
+        def add_range(first, last, registration):
+            if first > last:
+                return
+            if ranges and ranges[-1][1] == registration and ranges[-1][0] == first - 1:
+                ranges[-1] = (last, registration)
+            else:
+                starts.append(first)
+                ranges.append((last, registration))
+
+        # Outer netblocks sort before netblocks nested in them
+        stack = []
+        position = None
+        for first, last, registration in sorted(netblocks, key=lambda x: (x[0], -x[1])):
+            while stack and stack[-1][0] < first:
+                end, owner = stack.pop()
+                add_range(position, end, owner)
+                position = end + 1
+            if stack:
+                add_range(position, first - 1, stack[-1][1])
+            stack.append((last, registration))
+            position = first
+
+        while stack:
+            end, owner = stack.pop()
+            add_range(position, end, owner)
+            position = end + 1
+
+        return starts, ranges
+
+    def add(self, family, first, last, registration):
+        """Add netblock
+
+        Add netblock range for registration ID to the index
+
+        """
+        if family not in self.__netblocks:
+            self.__netblocks[family] = []
+        self.__netblocks[family].append((first, last, registration))
+        self.__ranges.pop(family, None)
+        self.cache.clear()
+
+    def add_network(self, network, registration):
+        """Add network
+
+        Add netblock in address/prefixlen format for registration ID
+
+        """
+        family, first, last = network_range(network)
+        self.add(family, first, last, registration)
+
+    def clear(self):
+        self.__netblocks.clear()
+        self.__ranges.clear()
+        self.cache.clear()
+
+    def lookup(self, address):
+        """Lookup address
+
+        Return registration ID of the most specific netblock containing
+        address, or None. Raises ValueError for invalid addresses.
+
+        """
+        key = '%s' % address
+        try:
+            return self.cache.lookup(key)
+        except KeyError:
+            pass
+
+        family, value = address_value(key)
+        if family not in self.__ranges:
+            self.__ranges[family] = self.__flatten__(self.__netblocks.get(family, []))
+        starts, ranges = self.__ranges[family]
+
+        registration = None
+        index = bisect_right(starts, value) - 1
+        if index >= 0 and ranges[index][0] >= value:
+            registration = ranges[index][1]
+
+        self.cache[key] = registration
+        return registration
@@ -0,0 +1,192 @@
+"""
+Background whois resolution of login attempt source addresses
+
+Addresses are resolved with ARIN whois queries by a pool of worker threads.
+Queries for addresses in same prefix are coalesced while a query is in
+flight, and failed queries or queries returning registrations not covering
+the address are not repeated for a while.
+"""
+
+import threading
+import time
+
+from Queue import Queue, Empty
+
+from seine.whois.arin import ARINReverseIPQuery
+
+from ultimatum.logformats.netblocks import address_value, ADDRESS_FAMILY_BITS
+
+# Number of whois worker threads
+WHOIS_WORKERS = 4
+# Seconds to skip queries for prefixes with failed queries
+WHOIS_NEGATIVE_TTL = 3600
+# Prefix length of addresses coalesced to a single query
+WHOIS_COALESCE_PREFIXLEN = 24
+
+# Seconds between checks for finished queries in wait()
+WHOIS_POLL_INTERVAL = 0.1
+
+
+class WhoisResolver(object):
+    """Whois resolver
+
+    Resolves addresses with query in workers background threads. Addresses
+    in same prefixlen prefix as an address with query in flight are added
+    to the pending query. Prefixes with failed queries or addresses passed
+    to reject() are skipped for negative_ttl seconds.
+
+    The query is called with the address and must return a registration
+    object for SSHViolationsDatabase.add_netblock, by default with
+    ARINReverseIPQuery. Replace it for example to test with a local whois
+    server.
+
+    Results are returned by results(), which must be called by the thread
+    adding the registrations to the database.
+
+    """
+    def __init__(self, query=ARINReverseIPQuery, workers=WHOIS_WORKERS,
+                 negative_ttl=WHOIS_NEGATIVE_TTL, prefixlen=WHOIS_COALESCE_PREFIXLEN):
+        self.query = query
+        self.workers = workers
+        self.negative_ttl = negative_ttl
+        self.prefixlen = prefixlen
+
+        self.queries = 0
+        self.coalesced = 0
+        self.failures = 0
+
+        self.__lock = threading.Lock()
+        self.__pending = Queue()
+        self.__completed = Queue()
+        self.__inflight = {}
+        self.__failed = {}
+        self.__threads = []
+
+    def __repr__(self):
+        return 'whois resolver %d queries %d coalesced %d failed' % (self.queries, self.coalesced, self.failures)
+
+    def __key__(self, address):
+        family, value = address_value(address)
+        bits = ADDRESS_FAMILY_BITS[family]
+        return (family, value >> (bits - min(self.prefixlen, bits)))
+
+    def __start__(self):
+        with self.__lock:
+            while len(self.__threads) < self.workers:
+                thread = threading.Thread(target=self.__worker__)
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+
+    def __worker__(self):
+        while True:
+            key, address = self.__pending.get()
+            try:
+                ref = self.query(address)
+                error = None
+            except Exception, emsg:
+                # Network errors from the query are failures like whois errors
+                ref = None
+                error = '%s' % emsg
+            self.__completed.put((key, ref, error))
+
+    @property
+    def busy(self):
+        """Queries pending
+
+        True if queries are in flight or their results were not returned yet
+
+        """
+        with self.__lock:
+            return len(self.__inflight) > 0
+
+    def submit(self, address):
+        """Submit address
+
+        Queue address for resolving. Returns False if address is invalid or
+        its prefix is in the negative cache.
+
+        """
+        try:
+            key = self.__key__(address)
+        except ValueError:
+            return False
+
+        with self.__lock:
+            expires = self.__failed.get(key, None)
+            if expires is not None:
+                if expires > time.time():
+                    return False
+                del self.__failed[key]
+
+            if key in self.__inflight:
+                if address not in self.__inflight[key]:
+                    self.__inflight[key].append(address)
+                self.coalesced += 1
+                return True
+
+            self.__inflight[key] = [address]
+            self.queries += 1
+
+        self.__start__()
+        self.__pending.put((key, address))
+        return True
+
+    def results(self):
+        """Finished queries
+
+        Return list of (addresses, ref, error) tuples for finished queries,
+        where addresses is list of addresses submitted for the query prefix,
+        ref the query result or None and error the error message for failed
+        queries. Addresses of a prefix are coalesced until its result is
+        returned here.
+
+        """
+        results = []
+        while True:
+            try:
+                key, ref, error = self.__completed.get_nowait()
+            except Empty:
+                break
+
+            with self.__lock:
+                addresses = self.__inflight.pop(key, [])
+                if ref is None:
+                    self.failures += 1
+                    self.__failed[key] = time.time() + self.negative_ttl
+            results.append((addresses, ref, error))
+
+        return results
+
+    def reject(self, addresses):
+        """Reject addresses
+
+        Add prefixes of addresses not covered by the registration returned
+        for their query to the negative cache, like prefixes of failed
+        queries, so they are not queried again for negative_ttl seconds.
+
+        """
+        expires = time.time() + self.negative_ttl
+        with self.__lock:
+            for address in addresses:
+                try:
+                    self.__failed[self.__key__(address)] = expires
+                except ValueError:
+                    pass
+
+    def wait(self, timeout=None):
+        """Wait for queries
+
+        Wait until all submitted queries are finished, or for timeout
+        seconds. Returns True if all queries finished.
+
+        """
+        started = time.time()
+        while True:
+            with self.__lock:
+                inflight = len(self.__inflight)
+            if self.__completed.qsize() >= inflight:
+                return True
+            if timeout is not None and time.time() - started >= timeout:
+                return False
+            time.sleep(WHOIS_POLL_INTERVAL)
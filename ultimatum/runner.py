@@ -0,0 +1,218 @@
+"""
+Pluggable runners for external commands
+
+All commands run by ultimatum modules go through the runner returned by
+get_runner(). The default runner starts subprocesses. RecordingRunner saves
+command output to a fixture file and ReplayRunner serves saved output
+without running any commands, for example to benchmark parsing on hosts
+without ZFS.
+"""
+
+import errno
+import json
+import threading
+import time
+
+from cStringIO import StringIO
+from subprocess import Popen, PIPE, CalledProcessError
+
+class CommandRunnerError(Exception):
+    pass
+
+
+class CommandRunner(object):
+    """Subprocess command runner
+
+    Runs commands with subprocess.Popen and counts started commands
+
+    """
+    def __init__(self):
+        self.count = 0
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s %d commands' % (self.__class__.__name__, self.count)
+
+    def __register__(self, cmd):
+        with self.__lock:
+            self.count += 1
+
+    def popen(self, cmd, stdin=None, stdout=None, stderr=None, close_fds=False):
+        """Start command
+
+        Start command and return Popen compatible process object
+
+        """
+        self.__register__(cmd)
+        return Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr, close_fds=close_fds)
+
+    def check_output(self, cmd):
+        """Run command
+
+        Run command and return output. Raises CalledProcessError if command
+        returns non-zero exit code.
+
+        """
+        process = self.popen(cmd, stdout=PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise CalledProcessError(process.returncode, cmd, output)
+        return output
+
+
+class ReplayProcess(object):
+    """Replayed process
+
+    Popen compatible object returning saved output of a command
+
+    """
+    def __init__(self, output, returncode, stdin=None, stdout=None):
+        self.output = output
+        self.returncode = None
+        self.pid = None
+        self.stdin = stdin == PIPE and StringIO() or None
+        self.stdout = stdout == PIPE and StringIO(output) or None
+        self.stderr = None
+        self.__returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = self.__returncode
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+
+    def terminate(self):
+        self.returncode = -15
+
+    def communicate(self, input=None):
+        self.wait()
+        if self.stdout is not None:
+            return (self.stdout.read(), None)
+        return (None, None)
+
+
+class RecordingRunner(CommandRunner):
+    """Recording command runner
+
+    Runs commands with subprocess and records their output and exit codes
+    by command line. Use save() to write recorded commands to a fixture file
+    for ReplayRunner.
+
+    Commands reading standard input are run but not recorded.
+
+    """
+    def __init__(self, path=None):
+        CommandRunner.__init__(self)
+        self.path = path
+        self.fixtures = {}
+
+    def popen(self, cmd, stdin=None, stdout=None, stderr=None, close_fds=False):
+        if stdin == PIPE:
+            return CommandRunner.popen(self, cmd, stdin, stdout, stderr, close_fds)
+
+        process = CommandRunner.popen(self, cmd, stdout=PIPE, stderr=stderr, close_fds=close_fds)
+        output = process.communicate()[0]
+
+        key = ' '.join(str(x) for x in cmd)
+        if key not in self.fixtures:
+            self.fixtures[key] = []
+        self.fixtures[key].append({'output': output, 'returncode': process.returncode})
+
+        return ReplayProcess(output, process.returncode, stdout=stdout)
+
+    def save(self, path=None):
+        """Save fixtures
+
+        Write recorded commands to JSON fixture file
+
+        """
+        path = path is not None and path or self.path
+        if path is None:
+            raise CommandRunnerError('Fixture path not defined')
+
+        try:
+            with open(path, 'w') as fd:
+                json.dump(self.fixtures, fd, indent=2, sort_keys=True)
+        except IOError, (ecode, emsg):
+            raise CommandRunnerError('Error writing %s: %s' % (path, emsg))
+
+
+class ReplayRunner(CommandRunner):
+    """Replay command runner
+
+    Serves command output recorded by RecordingRunner without running any
+    commands. Fixtures can be a path to a fixture file or a dictionary of
+    command lines to lists of output and returncode dictionaries. Commands
+    recorded several times return the recorded outputs in order, repeating
+    the last one.
+
+    Each started command sleeps latency seconds to simulate process startup
+    cost. Commands not found in fixtures raise OSError like missing commands.
+
+    """
+    def __init__(self, fixtures, latency=0.0):
+        CommandRunner.__init__(self)
+        self.latency = latency
+        self.calls = {}
+
+        if isinstance(fixtures, basestring):
+            try:
+                with open(fixtures, 'r') as fd:
+                    fixtures = json.load(fd)
+            except IOError, (ecode, emsg):
+                raise CommandRunnerError('Error reading %s: %s' % (fixtures, emsg))
+            except ValueError, emsg:
+                raise CommandRunnerError('Error parsing %s: %s' % (fixtures, emsg))
+
+        self.fixtures = {}
+        for key, responses in fixtures.items():
+            if isinstance(responses, dict):
+                responses = [responses]
+            self.fixtures[str(key)] = []
+            for response in responses:
+                output = response['output']
+                if isinstance(output, unicode):
+                    output = output.encode('utf-8')
+                self.fixtures[str(key)].append((output, int(response.get('returncode', 0))))
+
+    def popen(self, cmd, stdin=None, stdout=None, stderr=None, close_fds=False):
+        key = ' '.join(str(x) for x in cmd)
+        if key not in self.fixtures:
+            raise OSError(errno.ENOENT, 'No recorded output for command %s' % key)
+
+        self.__register__(cmd)
+        index = self.calls.get(key, 0)
+        self.calls[key] = index + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        output, returncode = self.fixtures[key][min(index, len(self.fixtures[key]) - 1)]
+        return ReplayProcess(output, returncode, stdin=stdin, stdout=stdout)
+
+
+__runner = CommandRunner()
+
+def get_runner():
+    """Return command runner
+
+    Return the runner used for external commands
+
+    """
+    return __runner
+
+def set_runner(runner):
+    """Set command runner
+
+    Set the runner used for external commands and return previous runner
+
+    """
+    global __runner
+    previous = __runner
+    __runner = runner
+    return previous
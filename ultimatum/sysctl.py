@@ -1,30 +1,1044 @@
 """
 Reading and writing of sysctl variables as dictionaries
+
+Values are read with a pluggable backend returned by get_backend(). On hosts
+where libc provides sysctl(3) and sysctlbyname(3), the default backend reads
+values directly with ctypes without starting processes. Otherwise values are
+read with the sysctl command. FakeSysCtlBackend serves a recorded MIB, for
+example to test on hosts without sysctl.
 """
 
-from subprocess import check_output,CalledProcessError
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+import threading
+import time
+
+from array import array
+
+from subprocess import CalledProcessError
+
+from ultimatum.runner import get_runner
+
+# sysctl(3) OID kinds, masked with CTLTYPE from the oidfmt kind
+CTLTYPE = 0xf
+CTLTYPE_NODE = 1
+CTLTYPE_INT = 2
+CTLTYPE_STRING = 3
+CTLTYPE_S64 = 4
+CTLTYPE_OPAQUE = 5
+CTLTYPE_UINT = 6
+CTLTYPE_LONG = 7
+CTLTYPE_ULONG = 8
+CTLTYPE_U64 = 9
+CTLTYPE_U8 = 0xa
+CTLTYPE_U16 = 0xb
+CTLTYPE_S8 = 0xc
+CTLTYPE_S16 = 0xd
+CTLTYPE_S32 = 0xe
+CTLTYPE_U32 = 0xf
+
+# OIDs with this flag are not listed by sysctl -a
+CTLFLAG_SKIP = 0x01000000
+
+# Native struct module formats for integer OID kinds
+CTLTYPE_INTEGER_FORMATS = {
+    CTLTYPE_INT:    'i',
+    CTLTYPE_S64:    'q',
+    CTLTYPE_UINT:   'I',
+    CTLTYPE_LONG:   'l',
+    CTLTYPE_ULONG:  'L',
+    CTLTYPE_U64:    'Q',
+    CTLTYPE_U8:     'B',
+    CTLTYPE_U16:    'H',
+    CTLTYPE_S8:     'b',
+    CTLTYPE_S16:    'h',
+    CTLTYPE_S32:    'i',
+    CTLTYPE_U32:    'I',
+}
+
+# Internal sysctl OIDs used to walk the MIB
+SYSCTL_OID_NAME = (0, 1)
+SYSCTL_OID_NEXT = (0, 2)
+SYSCTL_OID_NAME2OID = (0, 3)
+SYSCTL_OID_OIDFMT = (0, 4)
+
+# Maximum number of components in a MIB OID
+CTL_MAXNAME = 24
+
+# Default seconds between SysCtlSampler samples
+SAMPLER_INTERVAL = 10
+# Default number of rate samples kept by SysCtlSampler
+SAMPLER_HISTORY_SIZE = 60
+# Opaque statistics structs of uint64 counters sampled by SysCtlSampler
+SAMPLER_COUNTER_STRUCTS = (
+    'net.inet.ip.stats',
+    'net.inet.icmp.stats',
+    'net.inet.tcp.stats',
+    'net.inet.udp.stats',
+    'net.inet6.ip6.stats',
+    'net.inet6.icmp6.stats',
+)
 
 class SysCtlError(Exception):
     def _str__(self):
         return self.args[0]
 
-class SysCtlTree(dict):
-    def __init__(self,path=None):
+
+def decode_struct(fmt, data):
+    """Decode opaque struct
+
+    Decode known opaque structs by oidfmt format name. Returns None for
+    unknown structs and data too short for the struct.
+
+    """
+    if fmt == 'S,clockinfo':
+        names = ( 'hz', 'tick', 'spare', 'stathz', 'profhz', )
+        size = struct.calcsize('@5i')
+        if len(data) < size:
+            return None
+        values = struct.unpack('@5i', data[:size])
+        return dict(zip(names, values))
+
+    if fmt == 'S,loadavg':
+        size = struct.calcsize('@3Il')
+        if len(data) < size:
+            return None
+        loads = struct.unpack('@3Il', data[:size])
+        return tuple(float(x) / loads[3] for x in loads[:3])
+
+    if fmt == 'S,timeval':
+        size = struct.calcsize('@ll')
+        if len(data) < size:
+            return None
+        seconds, useconds = struct.unpack('@ll', data[:size])
+        return { 'sec': seconds, 'usec': useconds }
+
+    return None
+
+def decode_value(kind, fmt, data):
+    """Decode sysctl value
+
+    Decode raw sysctl value data by OID kind and format. Integers are
+    returned as int, arrays of integers like kern.cp_time as tuples, strings
+    as str and known opaque structs as dictionaries or tuples. Unknown opaque
+    values are returned as raw data.
+
+    """
+    kind = kind & CTLTYPE
+    if kind == CTLTYPE_STRING:
+        return data.split('\0', 1)[0]
+
+    if kind in CTLTYPE_INTEGER_FORMATS:
+        code = CTLTYPE_INTEGER_FORMATS[kind]
+        # Older systems use INT and LONG kinds with U suffix for unsigned
+        if fmt[-1:] == 'U' and code in ( 'i', 'l', 'q', ):
+            code = code.upper()
+        size = struct.calcsize('@%s' % code)
+        count = len(data) / size
+        values = struct.unpack('@%d%s' % (count, code), data[:count*size])
+        if fmt == 'IK':
+            values = tuple(round(x / 10.0 - 273.15, 1) for x in values)
+        if count == 1:
+            return values[0]
+        return values
+
+    if kind == CTLTYPE_OPAQUE:
+        value = decode_struct(fmt, data)
+        if value is not None:
+            return value
+
+    return data
+
+def format_value(value):
+    """Format value
+
+    Format a decoded value like the sysctl command prints it
+
+    """
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, float):
+        return '%.1fC' % value
+    if isinstance(value, tuple):
+        if value and isinstance(value[0], float):
+            return '{ %s }' % ' '.join('%.2f' % x for x in value)
+        return ' '.join(format_value(x) for x in value)
+    if isinstance(value, dict):
+        return '{ %s }' % ', '.join('%s = %s' % (k, value[k]) for k in sorted(value))
+    return '%s' % value
+
+def parse_value(value):
+    """Parse value
+
+    Convert value printed by the sysctl command to int, float, tuple of
+    numbers or dictionary of struct fields. Other values are returned as
+    strings.
+
+    """
+    value = value.strip()
+    if value[:1] == '{' and '}' in value:
+        fields = value[1:value.index('}')].strip()
+        if '=' in fields:
+            struct_fields = {}
+            for field in fields.split(','):
+                try:
+                    k,v = field.split('=',1)
+                except ValueError:
+                    return value
+                struct_fields[k.strip()] = parse_value(v)
+            return struct_fields
+        values = tuple(parse_value(x) for x in fields.split())
+        if all(not isinstance(x, basestring) for x in values):
+            return values
+        return value
+
+    if value[-1:] == 'C':
+        try:
+            return float(value[:-1])
+        except ValueError:
+            return value
+
+    values = []
+    for field in value.split():
+        for convert in ( int, float, ):
+            try:
+                values.append(convert(field))
+                break
+            except ValueError:
+                pass
+        else:
+            return value
+
+    if len(values) == 1:
+        return values[0]
+    if values:
+        return tuple(values)
+    return value
+
+def parse_output(output):
+    """Parse sysctl output
+
+    Return list of (name, value) tuples from sysctl -e output
+
+    """
+    values = []
+    for l in [l.strip() for l in output.split('\n') if l.strip()!='']:
+        try:
+            k,v = l.split('=',1)
+        except ValueError:
+            raise SysCtlError('Error parsing line: %s' % l)
+        values.append((k,v))
+    return values
+
+
+class CommandSysCtlBackend(object):
+    """Command sysctl backend
+
+    Reads values with the sysctl command. Values are returned as strings.
+
+    """
+    typed = False
+
+    def __repr__(self):
+        return 'sysctl command'
+
+    def read(self, path=None):
+        """Read values
+
+        Return list of (name, value) tuples for OIDs in path, or all OIDs if
+        path is None
+
+        """
         cmd = path is not None and ['sysctl','-e',path] or ['sysctl','-ea']
         try:
-            output = check_output(cmd)
+            output = get_runner().check_output(cmd)
         except CalledProcessError:
             raise SysCtlError('Error running command %s' % ' '.join(cmd))
-        for l in [l.strip() for l in output.split('\n') if l.strip()!='']:
+        except OSError, (ecode, emsg):
+            raise SysCtlError('Error running command %s: %s' % (' '.join(cmd), emsg))
+        return parse_output(output)
+
+    def read_values(self, names):
+        """Read leaf values
+
+        Return dictionary of values for list of leaf OID names, read with
+        one sysctl command. Unknown names are not included.
+
+        """
+        cmd = ['sysctl','-e'] + list(names)
+        try:
+            output = get_runner().check_output(cmd)
+        except CalledProcessError, emsg:
+            # Exit code is non-zero if any name is unknown
+            output = emsg.output is not None and emsg.output or ''
+        except OSError, (ecode, emsg):
+            raise SysCtlError('Error running command %s: %s' % (' '.join(cmd), emsg))
+        return dict(parse_output(output))
+
+
+class NativeSysCtlBackend(object):
+    """Native sysctl backend
+
+    Reads values with sysctl(3) through ctypes. Subtrees are walked with the
+    internal next OID like the sysctl command does, and values are decoded
+    by the OID format.
+
+    Names resolved to MIB OIDs and formats of OIDs are cached, so repeated
+    reads of same names only cost one sysctl(3) call per value.
+
+    """
+    typed = True
+
+    def __init__(self, libc=None):
+        if libc is None:
+            libc = NativeSysCtlBackend.load_libc()
+            if libc is None:
+                raise SysCtlError('sysctl(3) is not available')
+
+        self.libc = libc
+        self.mibs = {}
+        self.names = {}
+        self.formats = {}
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return 'sysctl(3)'
+
+    @staticmethod
+    def load_libc():
+        """Load libc
+
+        Return libc with sysctl(3) and sysctlbyname(3), or None if not
+        available on this host
+
+        """
+        if not sys.platform.startswith(('freebsd', 'darwin')):
+            return None
+        path = ctypes.util.find_library('c')
+        if path is None:
+            return None
+        try:
+            libc = ctypes.CDLL(path, use_errno=True)
+        except OSError:
+            return None
+        if not hasattr(libc, 'sysctl') or not hasattr(libc, 'sysctlbyname'):
+            return None
+
+        # Without prototypes ctypes passes size_t arguments as int
+        libc.sysctl.argtypes = [
+            ctypes.POINTER(ctypes.c_int), ctypes.c_uint,
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_size_t),
+            ctypes.c_void_p, ctypes.c_size_t,
+        ]
+        libc.sysctl.restype = ctypes.c_int
+        libc.sysctlbyname.argtypes = [
+            ctypes.c_char_p,
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_size_t),
+            ctypes.c_void_p, ctypes.c_size_t,
+        ]
+        libc.sysctlbyname.restype = ctypes.c_int
+        return libc
+
+    def __sysctl__(self, mib, size=None):
+        """Call sysctl(3)
+
+        Return raw value of mib. Raises OSError with errno if the call fails.
+
+        """
+        oid = (ctypes.c_int * len(mib))(*mib)
+        while True:
+            length = ctypes.c_size_t(0)
+            if size is None:
+                if self.libc.sysctl(oid, len(mib), None, ctypes.byref(length), None, 0) != 0:
+                    ecode = ctypes.get_errno()
+                    raise OSError(ecode, os.strerror(ecode))
+            else:
+                length.value = size
+
+            buf = ctypes.create_string_buffer(length.value + 1)
+            if self.libc.sysctl(oid, len(mib), buf, ctypes.byref(length), None, 0) == 0:
+                return buf.raw[:length.value]
+
+            ecode = ctypes.get_errno()
+            if ecode != errno.ENOMEM:
+                raise OSError(ecode, os.strerror(ecode))
+            # Value grew between the size query and read
+            size = length.value * 2 + 64
+
+    def __mib_value__(self, data):
+        count = len(data) / struct.calcsize('@i')
+        return struct.unpack('@%di' % count, data[:count*struct.calcsize('@i')])
+
+    def mib(self, name):
+        """Resolve name
+
+        Return MIB OID tuple for sysctl name. Raises SysCtlError for unknown
+        names.
+
+        """
+        with self.__lock:
+            if name in self.mibs:
+                return self.mibs[name]
+
+        try:
+            mib = self.__mib_value__(self.__name2oid__(name))
+        except OSError, (ecode, emsg):
+            raise SysCtlError('Error resolving %s: %s' % (name, emsg))
+
+        with self.__lock:
+            self.mibs[name] = mib
+            self.names[mib] = name
+        return mib
+
+    def __name2oid__(self, name):
+        # The name is passed as new value of the internal name2oid OID
+        oid = (ctypes.c_int * len(SYSCTL_OID_NAME2OID))(*SYSCTL_OID_NAME2OID)
+        buf = ctypes.create_string_buffer(CTL_MAXNAME * struct.calcsize('@i'))
+        length = ctypes.c_size_t(len(buf))
+        if self.libc.sysctl(oid, len(SYSCTL_OID_NAME2OID), buf, ctypes.byref(length), name, len(name)) != 0:
+            ecode = ctypes.get_errno()
+            raise OSError(ecode, os.strerror(ecode))
+        return buf.raw[:length.value]
+
+    def name(self, mib):
+        """OID name
+
+        Return sysctl name for MIB OID tuple
+
+        """
+        with self.__lock:
+            if mib in self.names:
+                return self.names[mib]
+
+        name = self.__sysctl__(SYSCTL_OID_NAME + mib).split('\0', 1)[0]
+        with self.__lock:
+            self.names[mib] = name
+            self.mibs[name] = mib
+        return name
+
+    def format(self, mib):
+        """OID format
+
+        Return tuple (kind, format) for MIB OID tuple
+
+        """
+        with self.__lock:
+            if mib in self.formats:
+                return self.formats[mib]
+
+        data = self.__sysctl__(SYSCTL_OID_OIDFMT + mib)
+        size = struct.calcsize('@I')
+        kind = struct.unpack('@I', data[:size])[0]
+        value = (kind, data[size:].split('\0', 1)[0])
+        with self.__lock:
+            self.formats[mib] = value
+        return value
+
+    def next(self, mib):
+        """Next OID
+
+        Return MIB OID tuple of the leaf following mib, or None at end of MIB
+
+        """
+        try:
+            return self.__mib_value__(self.__sysctl__(SYSCTL_OID_NEXT + mib))
+        except OSError, (ecode, emsg):
+            if ecode == errno.ENOENT:
+                return None
+            raise SysCtlError('Error walking MIB: %s' % emsg)
+
+    def value(self, mib):
+        """Read value
+
+        Return decoded value of leaf MIB OID tuple
+
+        """
+        kind, fmt = self.format(mib)
+        return decode_value(kind, fmt, self.__sysctl__(mib))
+
+    def read_values(self, names):
+        """Read leaf values
+
+        Return dictionary of values for list of leaf OID names. Unknown or
+        unreadable names are not included.
+
+        """
+        values = {}
+        for name in names:
             try:
-                k,v = l.split('=',1)
-                self[k] = v
-            except ValueError:
-                raise SysCtlError('Error parsing line: %s' % l)
+                values[name] = self.value(self.mib(name))
+            except (SysCtlError, OSError):
+                continue
+        return values
+
+    def read(self, path=None):
+        """Read values
+
+        Return list of (name, value) tuples for leaf OIDs in path, or all
+        OIDs if path is None. Opaque values without known format are skipped
+        when listing subtrees, like the sysctl command does.
+
+        """
+        if path is not None:
+            mib = self.mib(path)
+            try:
+                kind, fmt = self.format(mib)
+            except OSError, (ecode, emsg):
+                raise SysCtlError('Error reading %s: %s' % (path, emsg))
+            if kind & CTLTYPE != CTLTYPE_NODE:
+                try:
+                    return [(path, self.value(mib))]
+                except OSError, (ecode, emsg):
+                    raise SysCtlError('Error reading %s: %s' % (path, emsg))
+        else:
+            mib = (1,)
+
+        values = []
+        prefix = path is not None and '%s.' % path or ''
+        current = mib
+        while True:
+            current = self.next(current)
+            if current is None:
+                break
+            if path is not None and current[:len(mib)] != mib:
+                break
+
+            try:
+                kind, fmt = self.format(current)
+                if kind & CTLFLAG_SKIP or kind & CTLTYPE == CTLTYPE_NODE:
+                    continue
+                name = self.name(current)
+                value = self.value(current)
+            except OSError:
+                # Values not readable by this user or removed while walking
+                continue
+
+            if not name.startswith(prefix):
+                continue
+            if kind & CTLTYPE == CTLTYPE_OPAQUE and isinstance(value, str):
+                continue
+            values.append((name, value))
+
+        return values
+
+
+class FakeSysCtlBackend(object):
+    """Fake sysctl backend
+
+    Serves a recorded MIB without reading sysctl values from the host. The
+    MIB can be a dictionary of names to values or a path to a file with
+    recorded sysctl -ea output. Counts reads for benchmarks and tests.
+
+    Values are served as strings like sysctl command output unless typed is
+    True, when a dictionary of decoded values is served like the native
+    backend returns them.
+
+    """
+    def __init__(self, mib, typed=False):
+        self.typed = typed
+        self.reads = 0
+        if isinstance(mib, basestring):
+            try:
+                with open(mib, 'r') as fd:
+                    mib = parse_output(fd.read())
+            except IOError, (ecode, emsg):
+                raise SysCtlError('Error reading %s: %s' % (mib, emsg))
+        self.mib = dict(mib)
+
+    def __repr__(self):
+        return 'fake sysctl %d OIDs' % len(self.mib)
+
+    def read(self, path=None):
+        self.reads += 1
+        if path is None:
+            return sorted(self.mib.items())
+        if path in self.mib:
+            return [(path, self.mib[path])]
+
+        prefix = '%s.' % path
+        values = sorted((k, v) for k, v in self.mib.items() if k.startswith(prefix))
+        if not values:
+            raise SysCtlError('Unknown oid %s' % path)
+        return values
+
+    def read_values(self, names):
+        self.reads += 1
+        return dict((name, self.mib[name]) for name in names if name in self.mib)
+
+
+__backend = None
+
+def get_backend():
+    """Return sysctl backend
+
+    Return the backend used to read sysctl values. By default values are
+    read natively if sysctl(3) is available and with the sysctl command
+    otherwise.
+
+    """
+    global __backend
+    if __backend is None:
+        if NativeSysCtlBackend.load_libc() is not None:
+            __backend = NativeSysCtlBackend()
+        else:
+            __backend = CommandSysCtlBackend()
+    return __backend
+
+def set_backend(backend):
+    """Set sysctl backend
+
+    Set the backend used to read sysctl values and return previous backend
+
+    """
+    global __backend
+    previous = __backend
+    __backend = backend
+    return previous
+
+
+class SysCtlNode(dict):
+    """Sysctl tree node
+
+    Node in SysCtlTree mapping name components to child nodes. Leaf nodes
+    have the raw value read by the backend, converted to value on first
+    access.
+
+    """
+    __slots__ = ( 'name', 'raw', 'typed', 'converted', 'cached', )
+
+    def __init__(self, name):
+        dict.__init__(self)
+        self.name = name
+        self.raw = None
+        self.typed = False
+        self.converted = None
+        self.cached = False
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def is_leaf(self):
+        return self.raw is not None
+
+    @property
+    def value(self):
+        if not self.cached:
+            if self.typed:
+                self.converted = self.raw
+            else:
+                self.converted = parse_value(self.raw)
+            self.cached = True
+        return self.converted
+
+    def set(self, raw, typed):
+        """Set raw value
+
+        Set raw value and return True if the value changed
+
+        """
+        if self.raw == raw and self.typed == typed:
+            return False
+        self.raw = raw
+        self.typed = typed
+        self.converted = None
+        self.cached = False
+        return True
+
+    def leaves(self):
+        """Iterate leaves
+
+        Yield leaf nodes in and below this node sorted by name
+
+        """
+        if self.is_leaf:
+            yield self
+        for key in sorted(self):
+            for node in self[key].leaves():
+                yield node
+
+
+class SysCtlTree(object):
+    """Sysctl tree
+
+    Trie of sysctl names populated lazily from the backend. Only names and
+    subtrees accessed are read, each with one backend read, and loaded
+    subtrees are not read again until refreshed. Tree of path only contains
+    names in path.
+
+    Leaf values are converted to int, float, tuple or dictionary on first
+    access. Looking up a name with children returns its SysCtlNode, and
+    items(prefix) iterates names and values in a subtree.
+
+    """
+    def __init__(self,path=None,backend=None):
+        self.path = path
+        self.backend = backend is not None and backend or get_backend()
+        self.root = SysCtlNode('')
+        self.loaded = set()
+
+    def __repr__(self):
+        return 'sysctl %s' % (self.path is not None and self.path or '')
+
+    def __in_prefix__(self, name, prefix):
+        return prefix is None or name == prefix or name.startswith('%s.' % prefix)
+
+    def __scope__(self, name):
+        if name is None:
+            return self.path
+        if self.path is not None and not self.__in_prefix__(name, self.path):
+            raise KeyError(name)
+        return name
+
+    def __node__(self, name, create=False):
+        node = self.root
+        if name is None:
+            return node
+        for component in name.split('.'):
+            if component not in node:
+                if not create:
+                    return None
+                node[component] = SysCtlNode(node.name and '%s.%s' % (node.name, component) or component)
+            node = node[component]
+        return node
+
+    def __load__(self, name):
+        """Load subtree
+
+        Read name or subtree from the backend unless it was already loaded
+
+        """
+        name = self.__scope__(name)
+        if None in self.loaded:
+            return
+        if name is not None:
+            components = name.split('.')
+            for i in range(1, len(components) + 1):
+                if '.'.join(components[:i]) in self.loaded:
+                    return
+        try:
+            self.__read__(name)
+        except SysCtlError:
+            # Unknown names are missing, and read again on next lookup
+            return
+        self.loaded.add(name)
+
+    def __read__(self, name):
+        """Read subtree
+
+        Read name or subtree from the backend and return list of names
+        added, changed or removed. Raises SysCtlError without changing the
+        tree if the backend read fails.
+
+        """
+        values = self.backend.read(name)
+
+        changed = []
+        seen = set()
+        for k,v in values:
+            seen.add(k)
+            if self.__node__(k, create=True).set(v, self.backend.typed):
+                changed.append(k)
+
+        node = self.__node__(name)
+        if node is not None:
+            for leaf in list(node.leaves()):
+                if leaf.name not in seen:
+                    self.__remove__(leaf.name)
+                    changed.append(leaf.name)
+        return changed
+
+    def __remove__(self, name):
+        components = name.split('.')
+        path = [self.root]
+        for component in components:
+            path.append(path[-1][component])
+        path[-1].raw = None
+        for parent, component, node in reversed(zip(path[:-1], components, path[1:])):
+            if node or node.is_leaf:
+                break
+            del parent[component]
+
+    def __getitem__(self, name):
+        self.__load__(name)
+        node = self.__node__(name)
+        if node is None:
+            raise KeyError(name)
+        if node.is_leaf and not node:
+            return node.value
+        return node
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return self.keys()
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def raw(self, name):
+        """Raw value
+
+        Return value of name as read from the backend
+
+        """
+        self.__load__(name)
+        node = self.__node__(name)
+        if node is None or not node.is_leaf:
+            raise KeyError(name)
+        return node.raw
+
+    def keys(self, prefix=None):
+        for name, value in self.items(prefix):
+            yield name
+
+    def items(self, prefix=None):
+        """Iterate values
+
+        Yield (name, value) tuples for names in prefix, or whole tree if
+        prefix is None
+
+        """
+        self.__load__(prefix)
+        node = self.__node__(self.__scope__(prefix))
+        if node is None:
+            return
+        for leaf in node.leaves():
+            yield leaf.name, leaf.value
+
+    def refresh(self, prefix=None):
+        """Refresh values
+
+        Read prefix again, or all loaded subtrees if prefix is None, and
+        return list of names added, changed or removed. Converted values of
+        unchanged names are kept.
+
+        Raises SysCtlError if a subtree can't be read, for example if it was
+        removed or the read failed temporarily. Previous values of the
+        subtree are kept.
+
+        """
+        if prefix is not None:
+            prefix = self.__scope__(prefix)
+            changed = self.__read__(prefix)
+            self.loaded = set(x for x in self.loaded if not self.__in_prefix__(x or '', prefix))
+            self.loaded.add(prefix)
+            return changed
+
+        changed = []
+        for name in sorted(self.loaded):
+            changed.extend(self.__read__(name))
+        return changed
+
+class SysCtlSampler(object):
+    """Sysctl counter sampler
+
+    Samples counter OIDs every interval seconds and computes per second
+    rates. Each sample reads all names with one backend read. Values with
+    several counters, like kern.cp_time arrays, struct fields or opaque
+    counter structs, are sampled as one column per counter, listed in
+    columns.
+
+    Opaque values read by typed backends are sampled as uint64 counters
+    only for names in counter_structs.
+
+    Previous raw counter values are kept as integers, so uint64 counters
+    above 2**53 keep full precision, and a ring of the last history rate
+    samples is kept in a flat array of doubles. Counters smaller than previous value are handled as 32 or
+    64 bit wraps when the previous value was close to the limit and as
+    counter resets otherwise.
+
+    """
+    def __init__(self, names, interval=SAMPLER_INTERVAL, history=SAMPLER_HISTORY_SIZE, backend=None,
+                 counter_structs=SAMPLER_COUNTER_STRUCTS):
+        self.names = list(names)
+        self.interval = interval
+        self.size = history
+        self.backend = backend is not None and backend or get_backend()
+        self.counter_structs = set(counter_structs)
+
+        self.columns = []
+        self.samples = 0
+        self.__previous = None
+        self.__timestamp = None
+        self.__ring = None
+        self.__times = array('d', [0.0]) * history
+        self.__position = 0
+        self.__count = 0
+
+    def __repr__(self):
+        return 'sysctl sampler %d columns' % len(self.columns)
+
+    def __counters__(self, name, value):
+        """Counter columns
+
+        Return list of (column, counter) tuples for value of name
+
+        """
+        if not self.backend.typed and isinstance(value, basestring):
+            value = parse_value(value)
+
+        if isinstance(value, bool):
+            raise SysCtlError('Value of %s is not a counter' % name)
+        if isinstance(value, (int, long, float)):
+            return [(name, value)]
+        if isinstance(value, tuple):
+            return [('%s.%d' % (name, i), x) for i, x in enumerate(value)]
+        if isinstance(value, dict):
+            return [('%s.%s' % (name, k), value[k]) for k in sorted(value)]
+        if isinstance(value, str) and self.backend.typed and name in self.counter_structs:
+            if len(value) % 8 != 0:
+                raise SysCtlError('Value of %s is not a struct of uint64 counters' % name)
+            counters = struct.unpack('@%dQ' % (len(value) / 8), value)
+            return [('%s.%d' % (name, i), x) for i, x in enumerate(counters)]
+        raise SysCtlError('Value of %s is not a counter' % name)
+
+    def __read__(self):
+        """Read counters
+
+        Return lists of column names and counter values from one backend read
+
+        """
+        values = self.backend.read_values(self.names)
+        columns = []
+        counters = []
+        for name in self.names:
+            if name not in values:
+                raise SysCtlError('Unknown oid %s' % name)
+            for column, counter in self.__counters__(name, values[name]):
+                columns.append(column)
+                counters.append(counter)
+        return columns, counters
+
+    def __delta__(self, previous, current):
+        if current >= previous:
+            return current - previous
+        for limit in ( 2**32, 2**64, ):
+            if previous < limit:
+                if previous > limit // 2:
+                    return current + limit - previous
+                break
+        # Counter was reset
+        return current
+
+    def reset(self):
+        """Reset sampler
+
+        Forget previous values and history
+
+        """
+        self.columns = []
+        self.__previous = None
+        self.__timestamp = None
+        self.__ring = None
+        self.__position = 0
+        self.__count = 0
+
+    def sample(self, timestamp=None):
+        """Sample counters
+
+        Read counters and return dictionary of column names to per second
+        rates since previous sample, or None for the first sample and when
+        the counter columns changed. Samples without names are empty.
+
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        columns, counters = self.__read__()
+        self.samples += 1
+
+        if columns != self.columns or self.__previous is None:
+            self.reset()
+            self.columns = columns
+            self.__previous = counters
+            self.__timestamp = timestamp
+            self.__ring = array('d', [0.0]) * (self.size * len(columns))
+            return None
+
+        elapsed = timestamp - self.__timestamp
+        width = len(columns)
+        offset = self.__position * width
+        previous = self.__previous
+        ring = self.__ring
+        for i in xrange(width):
+            delta = self.__delta__(previous[i], counters[i])
+            ring[offset + i] = elapsed > 0 and float(delta) / elapsed or 0.0
+            previous[i] = counters[i]
+
+        self.__times[self.__position] = timestamp
+        self.__position = (self.__position + 1) % self.size
+        self.__count = min(self.__count + 1, self.size)
+        self.__timestamp = timestamp
+
+        return dict(zip(columns, ring[offset:offset + width]))
+
+    def history(self, column=None):
+        """Rate history
+
+        Return list of (timestamp, rates) tuples for kept samples from oldest
+        to newest, where rates is dictionary of columns to rates, or rate of
+        column if given
+
+        """
+        if self.__ring is None:
+            return []
+
+        width = len(self.columns)
+        if column is not None:
+            index = self.columns.index(column)
+
+        values = []
+        for i in xrange(self.__count):
+            position = (self.__position - self.__count + i) % self.size
+            offset = position * width
+            if column is not None:
+                rates = self.__ring[offset + index]
+            else:
+                rates = dict(zip(self.columns, self.__ring[offset:offset + width]))
+            values.append((self.__times[position], rates))
+        return values
+
+    def run(self, count=None):
+        """Sample periodically
+
+        Sample every interval seconds and yield (timestamp, rates) tuples,
+        starting from the second sample. Stops after count rate samples if
+        count is given.
+
+        """
+        next_sample = time.time()
+        while count is None or count > 0:
+            timestamp = time.time()
+            rates = self.sample(timestamp)
+            if rates is not None:
+                yield timestamp, rates
+                if count is not None:
+                    count -= 1
+                    if count == 0:
+                        break
+
+            next_sample += self.interval
+            delay = next_sample - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Skip missed samples instead of sampling in a burst
+                next_sample = time.time()
 
 if __name__ == '__main__':
-    import sys
     for t in sys.argv[1:]:
         t = SysCtlTree(t)
         for k,v in t.items():
-            print k,v
+            print '%s: %s' % (k, format_value(v))
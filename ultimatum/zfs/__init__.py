@@ -2,22 +2,268 @@
 Classes to process ZFS filesystems
 """
 
-from subprocess import check_output, CalledProcessError
+import threading
+import time
 
-__all__ = [ 'snapshots', 'zpool' 'zfs' ]
+from multiprocessing.pool import ThreadPool
+from subprocess import PIPE, STDOUT
+
+from ultimatum.runner import get_runner
+
+__all__ = [ 'properties', 'replication', 'snapshots', 'zpool', 'zfs' ]
 
 SNAPSHOT_DATE_FORMAT = '%Y%m%d-%H%M%S'
 
+# Seconds to keep cached zfs and zpool properties
+PROPERTY_CACHE_TTL = 60
+
+# Maximum number of zfs commands run in parallel by execute_parallel
+COMMAND_WORKERS = 4
+
+# Maximum number of zfs and zpool processes running at same time
+MAX_CONCURRENT_COMMANDS = 8
+COMMAND_SEMAPHORE = threading.BoundedSemaphore(MAX_CONCURRENT_COMMANDS)
+
 class ZFSError(Exception):
     pass
 
-def execute(cmd):
-    if isinstance(cmd,basestring):
-        cmd = cmd.split(' ')
+class ZFSCommand(threading.Thread):
+    """ZFS command
+
+    Command running zfs or zpool. Call run() to execute the command in the
+    calling thread, or start() to execute it in background and result() to
+    wait for output.
+
+    Use records() to iterate output while the command runs.
+
+    At most MAX_CONCURRENT_COMMANDS commands run at same time with run() or
+    start(). Commands are killed after timeout seconds. The callback is
+    called with output lines when the command succeeds, and errors raised
+    by the callback are returned by result() as ZFSError. With stderr=True
+    standard error is included in the output.
+
+    """
+    def __init__(self, cmd, timeout=None, callback=None, stderr=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        if isinstance(cmd,basestring):
+            cmd = cmd.split(' ')
+
+        self.cmd = cmd
+        self.timeout = timeout
+        self.callback = callback
+        self.stderr = stderr
+
+        self.process = None
+        self.output = None
+        self.error = None
+        self.cancelled = False
+        self.timed_out = False
+
+        self.__lock = threading.Lock()
+        self.__finished = threading.Event()
+        self.__timer = None
+
+    def __repr__(self):
+        return ' '.join(str(x) for x in self.cmd)
+
+    def __kill__(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+
+    def __timeout__(self):
+        with self.__lock:
+            self.timed_out = True
+            self.__kill__()
+
+    def __start__(self):
+        with self.__lock:
+            if self.cancelled:
+                raise ZFSError('Command cancelled: %s' % self)
+            try:
+                self.process = get_runner().popen(self.cmd, stdout=PIPE, stderr=self.stderr and STDOUT or None)
+            except OSError, (ecode, emsg):
+                raise ZFSError('Error running command %s: %s' % (self, emsg))
+
+        if self.timeout is not None:
+            self.__timer = threading.Timer(self.timeout, self.__timeout__)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def __stop__(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+        if self.cancelled:
+            raise ZFSError('Command cancelled: %s' % self)
+        if self.timed_out:
+            raise ZFSError('Timeout running command %s' % self)
+        if self.process.returncode != 0:
+            raise ZFSError('Error running command %s' % self)
+
+    def __execute__(self):
+        self.__start__()
+        try:
+            output = self.process.communicate()[0]
+        finally:
+            self.__stop__()
+
+        return [x.rstrip() for x in output.rstrip('\n').split('\n')]
+
+    @property
+    def finished(self):
+        return self.__finished.is_set()
+
+    def run(self):
+        try:
+            with COMMAND_SEMAPHORE:
+                self.output = self.__execute__()
+            if self.callback is not None:
+                try:
+                    self.callback(self.output)
+                except ZFSError:
+                    raise
+                except Exception, emsg:
+                    raise ZFSError('Error processing output of %s: %s' % (self, emsg))
+        except ZFSError, emsg:
+            self.error = emsg
+        finally:
+            self.__finished.set()
+
+    def records(self, separator='\t', maxsplit=-1):
+        """Iterate output records
 
+        Run command in the calling thread and yield non-empty output lines
+        split to fields by separator as the command writes them, or lines as
+        strings if separator is None. Raises ZFSError after the last line if
+        the command failed. Closing the iterator early kills the command.
+
+        The command slot is only held while the command is started, because
+        the caller may run other commands while iterating, for example look
+        up snapshots of each listed filesystem.
+
+        """
+        with COMMAND_SEMAPHORE:
+            self.__start__()
+
+        # File iteration reads ahead in blocks, readline() on the unbuffered
+        # pipe would read output one byte at a time
+        completed = False
+        try:
+            for line in self.process.stdout:
+                line = line.rstrip('\n')
+                if line == '':
+                    continue
+                if separator is not None:
+                    yield line.split(separator, maxsplit)
+                else:
+                    yield line
+            completed = True
+        finally:
+            if not completed:
+                self.__kill__()
+            self.process.stdout.close()
+            self.process.wait()
+            if completed:
+                self.__stop__()
+            elif self.__timer is not None:
+                self.__timer.cancel()
+
+    def cancel(self):
+        """Cancel command
+
+        Kill the command if it is running, or prevent it from starting
+
+        """
+        with self.__lock:
+            self.cancelled = True
+            self.__kill__()
+
+    def result(self, timeout=None):
+        """Command result
+
+        Wait for command to finish and return output lines. Raises ZFSError if
+        command failed or did not finish in timeout seconds.
+
+        """
+        if not self.__finished.wait(timeout):
+            raise ZFSError('Timeout waiting for command %s' % self)
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+def execute(cmd, timeout=None, stderr=False):
+    command = ZFSCommand(cmd, timeout, stderr=stderr)
+    command.run()
+    return command.result()
+
+def iter_execute(cmd, separator='\t', maxsplit=-1, timeout=None):
+    """Iterate command output
+
+    Run command and yield output lines split to fields by separator while
+    the command runs, without reading all output to memory
+
+    """
+    return ZFSCommand(cmd, timeout).records(separator, maxsplit)
+
+def execute_async(cmd, timeout=None, callback=None):
+    """Run command in background
+
+    Start command in background and return the ZFSCommand. Use result() to
+    wait for the output lines.
+
+    """
+    command = ZFSCommand(cmd, timeout, callback)
+    command.start()
+    return command
+
+def wait_commands(commands, timeout=None):
+    """Wait for commands
+
+    Wait for background commands to finish and return their output lines.
+    Cancels remaining commands and raises ZFSError if any command fails or
+    all commands did not finish in timeout seconds.
+
+    """
+    deadline = timeout is not None and time.time() + timeout or None
     try:
-        output = check_output(cmd)
-    except CalledProcessError:
-        raise ZFSError('Error running command %s' % ' '.join(str(x) for x in cmd))
+        results = []
+        for command in commands:
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            results.append(command.result(timeout))
+        return results
+    except ZFSError:
+        for command in commands:
+            command.cancel()
+        raise
+
+def execute_parallel(commands, workers=COMMAND_WORKERS):
+    """Run commands in parallel
+
+    Run commands with a bounded pool of worker threads. Returns list with
+    ZFSError for failed and None for successful commands, in same order as
+    the commands.
 
-    return [x.rstrip() for x in output.rstrip('\n').split('\n')]
+    """
+    def run(cmd):
+        try:
+            execute(cmd)
+        except ZFSError, emsg:
+            return emsg
+        return None
+
+    if not commands:
+        return []
+
+    pool = ThreadPool(max(1, min(workers, len(commands))))
+    try:
+        return pool.map(run, commands)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,192 @@
+"""
+Cached ZFS and zpool properties
+"""
+
+import time
+
+from ultimatum.zfs import execute_async, iter_execute, ZFSError, PROPERTY_CACHE_TTL
+
+class PropertyCache(dict):
+    """Property cache
+
+    Map of object names to dictionaries of raw property values, loaded with
+    a single command and reloaded on lookup after ttl seconds or after the
+    cache was invalidated. Objects invalidated by name and objects created
+    after the cache was loaded are loaded alone with object_command when
+    next looked up.
+
+    Subclasses must define the command property.
+
+    """
+    def __init__(self, ttl=PROPERTY_CACHE_TTL):
+        dict.__init__(self)
+        self.ttl = ttl
+        self.updated = None
+        self.stale = set()
+
+    @property
+    def command(self):
+        raise NotImplementedError('Command must be implemented in child class')
+
+    @property
+    def expired(self):
+        """Check if cache is expired
+
+        Returns True if cache has not been loaded, was invalidated or is older
+        than ttl seconds
+
+        """
+        if self.updated is None:
+            return True
+        return self.ttl is not None and time.time() - self.updated > self.ttl
+
+    def object_command(self, name):
+        """Command for one object
+
+        Return command to load properties of named object, or None if only
+        the whole cache can be loaded
+
+        """
+        return None
+
+    def invalidate(self, name=None, children=True):
+        """Invalidate cache
+
+        Force reloading of properties on next lookup. If name is given, only
+        properties of named object and, if children is True, its children
+        are dropped.
+
+        """
+        if name is None or self.object_command(name) is None:
+            self.updated = None
+            return
+
+        prefix = '%s/' % name
+        for key in [key for key in self if key == name or (children and key.startswith(prefix))]:
+            del self[key]
+            self.stale.add(key)
+        self.stale.add(name)
+
+    def load(self):
+        """Load properties
+
+        Load properties for all objects with one command, parsing the output
+        while it is read
+
+        """
+        self.process_records(iter_execute(self.command, maxsplit=2))
+
+    def load_async(self, timeout=None):
+        """Load properties in background
+
+        Start loading properties and return the running ZFSCommand
+
+        """
+        def process_output(lines):
+            self.process_records(line.split('\t', 2) for line in lines if line != '')
+        return execute_async(self.command, timeout, callback=process_output)
+
+    def process_records(self, records, replace=True):
+        """Process command output
+
+        Replace cached properties with values in command output records, or
+        update properties of objects in records if replace is False. The
+        cache is changed only after all records were read, and replaced
+        cache is left expired if reading or parsing the records fails.
+
+        """
+        if replace:
+            self.updated = None
+        properties = {}
+        for record in records:
+            try:
+                name, key, value = record
+            except ValueError:
+                raise ZFSError('Error parsing property line: %s' % '\t'.join(record))
+
+            if name not in properties:
+                properties[name] = {}
+            properties[name][key] = value
+
+        if replace:
+            self.clear()
+            self.stale.clear()
+            self.update(properties)
+            self.updated = time.time()
+        else:
+            for name, values in properties.items():
+                self.setdefault(name, {}).update(values)
+
+    def lookup(self, name, key, load_missing=True):
+        """Lookup property
+
+        Return raw property value for named object, or None if property is
+        not defined. Objects not in the cache are loaded with object_command,
+        unless load_missing is False and the object was not invalidated.
+        Raises ZFSError if object is not found.
+
+        """
+        if self.expired:
+            self.load()
+
+        if name not in self and (load_missing or name in self.stale):
+            command = self.object_command(name)
+            if command is not None:
+                self.stale.discard(name)
+                try:
+                    self.process_records(iter_execute(command, maxsplit=2), replace=False)
+                except ZFSError:
+                    # Object does not exist
+                    pass
+
+        if name not in self:
+            raise ZFSError('No properties found for %s' % name)
+
+        return self[name].get(key, None)
+
+
+class ZFSPropertyCache(PropertyCache):
+    """ZFS dataset properties
+
+    Properties of filesystems and volumes in target dataset. With
+    recursive=False only properties of the target itself are loaded.
+
+    """
+    def __init__(self, target, recursive=True, ttl=PROPERTY_CACHE_TTL):
+        PropertyCache.__init__(self, ttl)
+        self.target = target
+        self.recursive = recursive
+
+    def __repr__(self):
+        return 'zfs properties %s' % self.target
+
+    @property
+    def command(self):
+        cmd = ['zfs', 'get', '-H', '-t', 'filesystem,volume', '-o', 'name,property,value']
+        if self.recursive:
+            cmd.append('-r')
+        cmd.extend(['all', self.target])
+        return cmd
+
+    def object_command(self, name):
+        if not self.recursive:
+            return None
+        return ['zfs', 'get', '-H', '-t', 'filesystem,volume', '-o', 'name,property,value', 'all', name]
+
+
+class ZPoolPropertyCache(PropertyCache):
+    """Zpool properties
+
+    Properties of one zpool
+
+    """
+    def __init__(self, name, ttl=PROPERTY_CACHE_TTL):
+        PropertyCache.__init__(self, ttl)
+        self.name = name
+
+    def __repr__(self):
+        return 'zpool properties %s' % self.name
+
+    @property
+    def command(self):
+        return ['zpool', 'get', '-H', '-o', 'name,property,value', 'all', self.name]
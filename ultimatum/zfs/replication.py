@@ -0,0 +1,335 @@
+"""
+Replication of ZFS snapshots with zfs send and zfs receive
+"""
+
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+from subprocess import PIPE
+from tempfile import TemporaryFile
+
+from ultimatum.runner import get_runner
+from ultimatum.zfs import execute, ZFSError
+from ultimatum.zfs.snapshots import ZFSSnapshotResults
+
+# Size of blocks relayed from zfs send to zfs receive
+REPLICATION_BLOCK_SIZE = 128 * 1024
+# Number of blocks buffered between zfs send and zfs receive
+REPLICATION_BUFFER_BLOCKS = 256
+# Maximum number of replication streams run in parallel
+REPLICATION_JOBS = 2
+# Seconds between progress callbacks
+REPLICATION_CALLBACK_INTERVAL = 1.0
+
+# Seconds to wait for buffer space before checking if replication was aborted
+QUEUE_POLL_INTERVAL = 0.5
+
+
+class ZFSReplication(object):
+    """Replication pipeline
+
+    Streams zfs send output for snapshot to zfs receive for target dataset
+    or pool. The stream is relayed in block_size blocks through a buffer of
+    buffer_blocks blocks, so a slow receiver does not stall the sender until
+    the buffer is full.
+
+    If incremental is given, an incremental stream from that snapshot is
+    sent, including intermediate snapshots if intermediate is True. Send
+    flags -c, -L and -e are enabled with compressed, large_blocks and
+    embedded.
+
+    With resumable=True, interrupted streams leave a receive_resume_token on
+    the target. If resume_token is given, the interrupted stream is resumed
+    with zfs send -t before sending the snapshot.
+
+    The callback is called with the replication object every
+    callback_interval seconds while streaming and once when finished.
+
+    """
+    def __init__(self, snapshot, target, incremental=None, intermediate=False,
+                 force=False, resumable=False, resume_token=None,
+                 compressed=False, large_blocks=False, embedded=False,
+                 block_size=REPLICATION_BLOCK_SIZE, buffer_blocks=REPLICATION_BUFFER_BLOCKS,
+                 callback=None, callback_interval=REPLICATION_CALLBACK_INTERVAL):
+
+        self.snapshot = '%s' % snapshot
+        self.target = target
+        self.incremental = incremental is not None and '%s' % incremental or None
+        self.intermediate = intermediate
+        self.force = force
+        self.resumable = resumable
+        self.resume_token = resume_token
+        self.compressed = compressed
+        self.large_blocks = large_blocks
+        self.embedded = embedded
+        self.block_size = block_size
+        self.buffer_blocks = max(1, buffer_blocks)
+        self.callback = callback
+        self.callback_interval = callback_interval
+
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return 'replication %s -> %s' % (self.snapshot, self.target)
+
+    @property
+    def send_command(self):
+        cmd = ['zfs', 'send']
+        if self.compressed:
+            cmd.append('-c')
+        if self.large_blocks:
+            cmd.append('-L')
+        if self.embedded:
+            cmd.append('-e')
+        if self.incremental is not None:
+            cmd.extend([self.intermediate and '-I' or '-i', self.incremental])
+        cmd.append(self.snapshot)
+        return cmd
+
+    @property
+    def resume_command(self):
+        if self.resume_token is None:
+            return None
+        cmd = ['zfs', 'send']
+        if self.embedded:
+            cmd.append('-e')
+        cmd.extend(['-t', self.resume_token])
+        return cmd
+
+    @property
+    def receive_command(self):
+        flags = '-%s%sd' % (self.force and 'F' or '', self.resumable and 's' or '')
+        return ['zfs', 'receive', flags, self.target]
+
+    @property
+    def elapsed(self):
+        """Elapsed time
+
+        Seconds spent streaming, or 0 if replication was not started
+
+        """
+        if self.started is None:
+            return 0
+        if self.finished is not None:
+            return self.finished - self.started
+        return time.time() - self.started
+
+    @property
+    def throughput(self):
+        """Throughput
+
+        Average bytes per second transferred
+
+        """
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0
+        return self.bytes / elapsed
+
+    def __read_stream__(self, stream, queue, aborted):
+        """Read send stream
+
+        Read blocks from zfs send output to queue until EOF or until the
+        replication is aborted. None is queued at EOF.
+
+        """
+        while not aborted.is_set():
+            block = stream.read(self.block_size)
+            while not aborted.is_set():
+                try:
+                    queue.put(block or None, timeout=QUEUE_POLL_INTERVAL)
+                    break
+                except Full:
+                    continue
+
+            if not block:
+                break
+
+    def __process_error__(self, process, stderr, cmd):
+        stderr.seek(0)
+        message = stderr.read().strip()
+        return ZFSError('Error running command %s: %s' % (
+            ' '.join(cmd),
+            message and message or 'returned %s' % process.returncode,
+        ))
+
+    def __stream__(self, send_command, receive_command):
+        """Stream from send to receive
+
+        Relay output of send_command to receive_command. Raises ZFSError if
+        either command fails.
+
+        """
+        send_stderr = TemporaryFile()
+        receive_stderr = TemporaryFile()
+        queue = Queue(self.buffer_blocks)
+        aborted = threading.Event()
+
+        try:
+            send = get_runner().popen(send_command, stdout=PIPE, stderr=send_stderr, close_fds=True)
+        except OSError, (ecode, emsg):
+            raise ZFSError('Error running %s: %s' % (' '.join(send_command), emsg))
+        try:
+            receive = get_runner().popen(receive_command, stdin=PIPE, stderr=receive_stderr, close_fds=True)
+        except OSError, (ecode, emsg):
+            send.kill()
+            send.wait()
+            raise ZFSError('Error running %s: %s' % (' '.join(receive_command), emsg))
+
+        reader = threading.Thread(target=self.__read_stream__, args=(send.stdout, queue, aborted))
+        reader.daemon = True
+        reader.start()
+
+        last_callback = time.time()
+        completed = False
+        killed = False
+        try:
+            while True:
+                try:
+                    block = queue.get(timeout=QUEUE_POLL_INTERVAL)
+                except Empty:
+                    if not reader.is_alive():
+                        break
+                    continue
+
+                if block is None:
+                    completed = True
+                    break
+
+                try:
+                    receive.stdin.write(block)
+                except IOError:
+                    # zfs receive exited, error is reported from return code
+                    break
+
+                self.bytes += len(block)
+                if self.callback is not None and time.time() - last_callback >= self.callback_interval:
+                    self.callback(self)
+                    last_callback = time.time()
+
+        finally:
+            aborted.set()
+            try:
+                receive.stdin.close()
+            except IOError:
+                pass
+            receive.wait()
+
+            if not completed and send.poll() is None:
+                send.kill()
+                killed = True
+            reader.join()
+            send.stdout.close()
+            send.wait()
+
+        if send.returncode != 0 and not killed:
+            raise self.__process_error__(send, send_stderr, send_command)
+        if receive.returncode != 0:
+            raise self.__process_error__(receive, receive_stderr, receive_command)
+
+    def run(self):
+        """Run replication
+
+        Resume interrupted stream if resume_token is set and stream snapshot to
+        target. Raises ZFSError if zfs send or zfs receive fails.
+
+        """
+        self.bytes = 0
+        self.started = time.time()
+        self.finished = None
+
+        try:
+            if self.resume_token is not None:
+                self.__stream__(self.resume_command, self.receive_command)
+                self.resume_token = None
+            self.__stream__(self.send_command, self.receive_command)
+        finally:
+            self.finished = time.time()
+
+        if self.callback is not None:
+            self.callback(self)
+
+
+def run_replications(replications, jobs=REPLICATION_JOBS):
+    """Run replications
+
+    Run list of ZFSReplication objects with at most jobs streams in parallel.
+    Replications of datasets nested in other replicated datasets start only
+    after the parent replication has finished, because zfs receive needs the
+    parent dataset in target. Separate subtrees are replicated in parallel.
+    Replications nested in a failed replication are not started.
+
+    Returns ZFSSnapshotResults with error for each failed snapshot.
+
+    """
+    finished = Queue()
+
+    def run(replication):
+        try:
+            replication.run()
+        except ZFSError, emsg:
+            return '%s' % emsg
+        finally:
+            finished.put(replication)
+        return None
+
+    results = ZFSSnapshotResults()
+    if not replications:
+        return results
+
+    volumes = dict((replication.snapshot.split('@', 1)[0], replication) for replication in replications)
+    children = dict((id(replication), []) for replication in replications)
+    ready = []
+    for replication in replications:
+        parent = replication.snapshot.split('@', 1)[0]
+        while '/' in parent:
+            parent = parent.rsplit('/', 1)[0]
+            if parent in volumes:
+                children[id(volumes[parent])].append(replication)
+                break
+        else:
+            ready.append(replication)
+
+    pool = ThreadPool(max(1, min(jobs, len(replications))))
+    running = {}
+    try:
+        while ready or running:
+            for replication in ready:
+                running[id(replication)] = pool.apply_async(run, (replication,))
+            replication = finished.get()
+            error = running.pop(id(replication)).get()
+            results[replication.snapshot] = error
+            if error is None:
+                ready = children[id(replication)]
+                continue
+
+            # Nested datasets can't be received without the parent
+            ready = []
+            skipped = list(children[id(replication)])
+            while skipped:
+                child = skipped.pop()
+                results[child.snapshot] = 'Parent replication failed: %s' % replication.snapshot
+                skipped.extend(children[id(child)])
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def resume_token_snapshot(token):
+    """Snapshot for resume token
+
+    Return name of the snapshot an interrupted stream with given
+    receive_resume_token was sending, or None if not known
+
+    """
+    # zfs send prints dry run details to stderr
+    for line in execute(['zfs', 'send', '-nv', '-t', token], stderr=True):
+        if line.strip().startswith('toname = '):
+            return line.split('=', 1)[1].strip()
+    return None
@@ -2,41 +2,122 @@
 ZFS snapshots
 """
 
-from ultimatum.zfs import execute, ZFSError, SNAPSHOT_DATE_FORMAT
+import time
 
-class ZFSSnapshot(list):
-    def __init__(self, name):
-        self.name = name
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+
+from ultimatum.zfs import execute, execute_async, iter_execute, ZFSError, SNAPSHOT_DATE_FORMAT
+
+SNAPSHOT_LIST_PROPERTIES = (
+    'name',
+    'creation',
+    'used',
+    'referenced',
+    'guid',
+)
+
+def parse_tag_epoch(tag, date_format=SNAPSHOT_DATE_FORMAT):
+    """Parse snapshot tag date
+
+    Return snapshot tag in date_format as integer epoch timestamp, or None if
+    the tag does not match date_format
+
+    """
+    try:
+        if date_format == SNAPSHOT_DATE_FORMAT:
+            # Avoid strptime for tags in the default format. The datetime
+            # fields are validated like strptime validates them.
+            if len(tag) != 15 or tag[8] != '-' or not tag[:8].isdigit() or not tag[9:].isdigit():
+                return None
+            date = datetime(
+                int(tag[0:4]), int(tag[4:6]), int(tag[6:8]),
+                int(tag[9:11]), int(tag[11:13]), int(tag[13:15]),
+            )
+        else:
+            date = datetime.strptime(tag, date_format)
+        return int(time.mktime(date.timetuple()))
+    except (ValueError, OverflowError):
+        return None
+
+
+class ZFSSnapshot(object):
+    """ZFS snapshot
+
+    Immutable snapshot record. The tag is parsed to epoch timestamp once when
+    the snapshot is created. Snapshots are sorted and hashed by volume, epoch
+    and tag, where epoch is the tag date or snapshot creation time for tags
+    not in SNAPSHOT_DATE_FORMAT.
+
+    Snapshots compare equal to strings matching their tag or full name and
+    sort by full name against strings.
+
+    """
+    __slots__ = ( 'volume', 'tag', 'tag_epoch', 'epoch', 'creation', 'used', 'referenced', 'guid', )
+
+    def __init__(self, name, creation=None, used=None, referenced=None, guid=None):
         try:
-            self.volume, self.tag = name.split('@')
+            volume, tag = name.split('@')
         except ValueError:
             raise ZFSError('Invalid snapshot name: %s' % name)
 
+        set_attribute = super(ZFSSnapshot, self).__setattr__
+        set_attribute('volume', intern(volume))
+        set_attribute('tag', tag)
+        set_attribute('tag_epoch', parse_tag_epoch(tag))
+        set_attribute('epoch', self.tag_epoch if self.tag_epoch is not None else creation)
+        set_attribute('creation', creation)
+        set_attribute('used', used)
+        set_attribute('referenced', referenced)
+        set_attribute('guid', guid)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('ZFSSnapshot is immutable')
+
+    def __delattr__(self, attr):
+        raise AttributeError('ZFSSnapshot is immutable')
+
+    def __reduce__(self):
+        return (ZFSSnapshot, (self.name, self.creation, self.used, self.referenced, self.guid))
+
+    @property
+    def name(self):
+        return '%s@%s' % (self.volume, self.tag)
+
+    @property
+    def sort_key(self):
+        return (self.volume, self.epoch, self.tag)
+
+    def __hash__(self):
+        return hash((self.volume, self.epoch, self.tag))
+
     def __cmp__(self, other):
         if isinstance(other, basestring):
-            try:
-                tag = self.name.split('@')[1]
-                if tag == other:
-                    return 0
-            except IndexError:
-                pass
-
+            if other == self.tag:
+                return 0
             return cmp(self.name, other)
 
-        elif not isinstance(other,ZFSSnapshot):
+        elif not isinstance(other, ZFSSnapshot):
             raise ZFSError("Can't compare ZFSSnapshot to %s object" % type(other))
 
-        if self.volume != other.volume:
-            return cmp(self.volume, other.volume)
+        return cmp(
+            (self.volume, self.epoch, self.tag),
+            (other.volume, other.epoch, other.tag)
+        )
 
-        try:
-            my_date = time.strptime(self.tag, SNAPSHOT_DATE_FORMAT)
-            other_date = time.strptime(other.tag, SNAPSHOT_DATE_FORMAT)
-            return cmp(my_date, other_date)
-        except ValueError:
-            pass
+    def __lt__(self, other):
+        if isinstance(other, ZFSSnapshot):
+            return (self.volume, self.epoch, self.tag) < (other.volume, other.epoch, other.tag)
+        return self.__cmp__(other) < 0
+
+    def __le__(self, other):
+        return self.__cmp__(other) <= 0
 
-        return cmp(self.tag, other.tag)
+    def __gt__(self, other):
+        return self.__cmp__(other) > 0
+
+    def __ge__(self, other):
+        return self.__cmp__(other) >= 0
 
     def __eq__(self,other):
         return self.__cmp__(other) == 0
@@ -51,3 +132,261 @@ class ZFSSnapshot(list):
         if name.count('@')==0:
             name = '%s@%s' % (self.volume, name)
         execute('zfs rename %s %s' % (self.name, name))
+
+
+class ZFSSnapshotList(list):
+    """Snapshots of one dataset
+
+    List of ZFSSnapshot objects in creation order, with hashed lookup by tag
+    or full snapshot name and a date sorted index of snapshots with tags in
+    date_format for bisect lookups by date range.
+
+    Add and remove snapshots only with append() and remove() to keep the
+    lookup indexes up to date.
+
+    """
+    def __init__(self, volume, date_format=SNAPSHOT_DATE_FORMAT):
+        list.__init__(self)
+        self.volume = volume
+        self.date_format = date_format
+        self.__tags = {}
+        self.__dates = []
+
+    def __contains__(self, value):
+        return self.get(value) is not None
+
+    def __tag_epoch__(self, snapshot):
+        if self.date_format == SNAPSHOT_DATE_FORMAT:
+            return snapshot.tag_epoch
+        return parse_tag_epoch(snapshot.tag, self.date_format)
+
+    def get(self, value):
+        """Lookup snapshot
+
+        Return snapshot matching a ZFSSnapshot, full snapshot name or tag, or
+        None if snapshot is not in this list
+
+        """
+        if isinstance(value, ZFSSnapshot):
+            volume, tag = value.volume, value.tag
+        elif '@' in value:
+            volume, tag = value.split('@', 1)
+        else:
+            volume, tag = self.volume, value
+
+        if volume != self.volume:
+            return None
+        return self.__tags.get(tag, None)
+
+    def append(self, snapshot):
+        """Append snapshot
+
+        Append a snapshot to the list and lookup indexes
+
+        """
+        list.append(self, snapshot)
+        self.__tags[snapshot.tag] = snapshot
+
+        epoch = self.__tag_epoch__(snapshot)
+        if epoch is not None:
+            insort(self.__dates, (epoch, snapshot.tag))
+
+    def remove(self, value):
+        """Remove snapshot
+
+        Remove snapshot matching a ZFSSnapshot, full snapshot name or tag
+
+        """
+        snapshot = self.get(value)
+        if snapshot is None:
+            raise ValueError('Snapshot not in list: %s' % value)
+
+        list.remove(self, snapshot)
+        del self.__tags[snapshot.tag]
+
+        epoch = self.__tag_epoch__(snapshot)
+        if epoch is not None:
+            self.__dates.pop(bisect_left(self.__dates, (epoch, snapshot.tag)))
+
+    def latest_common(self, other):
+        """Latest common snapshot
+
+        Return newest snapshot in this list that also exists in other
+        ZFSSnapshotList, or None. Snapshots are matched by guid, or by tag if
+        guid is not known.
+
+        """
+        guids = set(snapshot.guid for snapshot in other if snapshot.guid is not None)
+        for snapshot in reversed(self):
+            if snapshot.guid is not None and guids:
+                if snapshot.guid in guids:
+                    return snapshot
+            elif snapshot.tag in other:
+                return snapshot
+        return None
+
+    def filter(self, start, stop):
+        """Filter by date
+
+        Return snapshots with tag dates between start and stop datetimes,
+        sorted by tag date
+
+        """
+        start = int(time.mktime(start.timetuple()))
+        stop = int(time.mktime(stop.timetuple()))
+        first = bisect_left(self.__dates, (start,))
+        last = bisect_right(self.__dates, (stop, chr(255)))
+        return [self.__tags[tag] for epoch, tag in self.__dates[first:last]]
+
+
+class ZFSSnapshotIndex(dict):
+    """Snapshot inventory
+
+    Map of dataset names to ZFSSnapshotList objects sorted by creation time,
+    loaded with a single zfs list command for the whole target.
+
+    With recursive=False only snapshots of the target dataset itself are
+    loaded.
+
+    """
+    def __init__(self, target, recursive=True):
+        dict.__init__(self)
+        self.target = target
+        self.recursive = recursive
+        self.loaded = False
+
+    def __repr__(self):
+        return 'snapshot index %s' % self.target
+
+    @property
+    def command(self):
+        cmd = [
+            'zfs', 'list', '-Hp', '-t', 'snapshot', '-s', 'creation',
+            '-o', ','.join(SNAPSHOT_LIST_PROPERTIES),
+        ]
+        if self.recursive:
+            cmd.append('-r')
+        else:
+            cmd.extend(['-d', '1'])
+        cmd.append(self.target)
+        return cmd
+
+    def load(self):
+        """Load snapshots
+
+        Reload all snapshots for target with one zfs list command, parsing
+        the output while it is read
+
+        """
+        self.process_records(iter_execute(self.command))
+
+    def load_async(self, timeout=None):
+        """Load snapshots in background
+
+        Start loading snapshots and return the running ZFSCommand
+
+        """
+        def process_output(lines):
+            self.process_records(line.split('\t') for line in lines if line != '')
+        return execute_async(self.command, timeout, callback=process_output)
+
+    def process_records(self, records):
+        """Process command output
+
+        Replace indexed snapshots with snapshots in zfs list output records.
+        The index is replaced only after all records were read, and is left
+        unloaded if reading or parsing the records fails.
+
+        """
+        self.loaded = False
+        snapshots = {}
+        for record in records:
+            try:
+                name, creation, used, referenced, guid = record
+                snapshot = ZFSSnapshot(name,
+                    creation=int(creation),
+                    used=int(used),
+                    referenced=int(referenced),
+                    guid=int(guid),
+                )
+            except ValueError:
+                raise ZFSError('Error parsing snapshot list line: %s' % '\t'.join(record))
+
+            if snapshot.volume not in snapshots:
+                snapshots[snapshot.volume] = ZFSSnapshotList(snapshot.volume)
+            snapshots[snapshot.volume].append(snapshot)
+
+        self.clear()
+        self.update(snapshots)
+        self.loaded = True
+
+    def invalidate(self):
+        """Invalidate index
+
+        Force reloading of the index on next lookup
+
+        """
+        self.loaded = False
+
+    def snapshots(self, volume):
+        """Snapshots for dataset
+
+        Return ZFSSnapshotList for given dataset name, loading the index
+        if it was not yet loaded. The returned list is shared with the index.
+
+        """
+        if not self.loaded:
+            self.load()
+        if volume not in self:
+            return ZFSSnapshotList(volume)
+        return self[volume]
+
+    def get_snapshot(self, name):
+        """Lookup snapshot by name
+
+        Return snapshot by full snapshot name, or None if not found
+
+        """
+        try:
+            volume, tag = name.split('@', 1)
+        except ValueError:
+            raise ZFSError('Invalid snapshot name: %s' % name)
+        return self.snapshots(volume).get(tag)
+
+    def add(self, snapshot):
+        """Add snapshot
+
+        Register a newly created snapshot to the index
+
+        """
+        if not self.loaded:
+            return
+        if snapshot.volume not in self:
+            self[snapshot.volume] = ZFSSnapshotList(snapshot.volume)
+        self[snapshot.volume].append(snapshot)
+
+    def remove(self, snapshot):
+        """Remove snapshot
+
+        Unregister a destroyed snapshot from the index
+
+        """
+        if not self.loaded or snapshot not in self.get(snapshot.volume, ()):
+            return
+        self[snapshot.volume].remove(snapshot)
+
+
+class ZFSSnapshotResults(dict):
+    """Snapshot command results
+
+    Map of snapshot names to None for successful commands or error message
+    for failed commands
+
+    """
+    @property
+    def succeeded(self):
+        return sorted(name for name, error in self.items() if error is None)
+
+    @property
+    def failed(self):
+        return dict((name, error) for name, error in self.items() if error is not None)
@@ -3,11 +3,13 @@ ZFS API for python
 """
 
 import logging
+import time
 from datetime import datetime, timedelta
-from subprocess import Popen, PIPE
 
-from ultimatum.zfs import execute, ZFSError, SNAPSHOT_DATE_FORMAT
-from ultimatum.zfs.snapshots import ZFSSnapshot
+from ultimatum.zfs import execute, ZFSError, SNAPSHOT_DATE_FORMAT, PROPERTY_CACHE_TTL
+from ultimatum.zfs.properties import ZFSPropertyCache
+from ultimatum.zfs.replication import ZFSReplication, resume_token_snapshot
+from ultimatum.zfs.snapshots import ZFSSnapshot, ZFSSnapshotIndex
 
 ZFS_BOOLEAN_PROPERTIES = (
     'atime',
@@ -31,6 +33,7 @@ ZFS_BOOLEAN_PROPERTIES = (
 ZFS_READONLY_PROPERTIES = (
     'available',
     'creation',
+    'receive_resume_token',
     'refcompressratio',
     'referenced',
     'type',
@@ -86,6 +89,11 @@ sync standard
 version 4
 """
 
+ZFS_OPTIONAL_PROPERTIES = (
+    'mlslabel',
+    'receive_resume_token',
+)
+
 ZFS_PROPERTY_VALIDATORS = {
 
 }
@@ -97,13 +105,40 @@ class ZFS(object):
 
     Wrapper to manipulate a ZFS filesystem object
 
+    If pool is given, snapshots and properties are looked up from the
+    snapshot index and property cache of the pool instead of listing them
+    separately for each filesystem.
+
     """
-    def __init__(self, name):
+    def __init__(self, name, pool=None, property_ttl=PROPERTY_CACHE_TTL):
         self.name = name
+        self.pool = pool
+        self._snapshot_index = None
+
+        if pool is not None:
+            self.property_cache = pool.filesystem_properties
+        else:
+            self.property_cache = ZFSPropertyCache(name, recursive=False, ttl=property_ttl)
 
     def __repr__(self):
         return 'zfs %s' % self.name
 
+    def snapshot_index(self, refresh=False):
+        """Snapshot index
+
+        Return the ZFSSnapshotIndex containing snapshots of this filesystem:
+        the shared pool index or an index loaded only for this filesystem.
+
+        """
+        if self.pool is not None:
+            return self.pool.snapshot_index(refresh)
+
+        if self._snapshot_index is None:
+            self._snapshot_index = ZFSSnapshotIndex(self.name, recursive=False)
+        if refresh:
+            self._snapshot_index.load()
+        return self._snapshot_index
+
     @property
     def snapshots(self):
         """List of snapshots
@@ -111,16 +146,7 @@ class ZFS(object):
         Returns list of existing snapshots as ZFSSnapshot objects
 
         """
-        snapshots = []
-        for name in execute('zfs list -Hrt snapshot -o name %s' % self.name):
-            if name == '':
-                continue
-
-            snapshot = ZFSSnapshot(name)
-            if snapshot.volume == self.name:
-                snapshots.append(snapshot)
-
-        return snapshots
+        return self.snapshot_index().snapshots(self.name)
 
     def get_property(self, key):
         """Return property value
@@ -131,18 +157,7 @@ class ZFS(object):
         if key not in ZFS_PROPERTIES:
             raise ZFSError('Invalid property name')
 
-        value = None
-        cmd = 'zfs get -H %s %s' % (key, self.name)
-        for line in execute(cmd):
-            try:
-                volume, field, value, flags = line.split(None, 3)
-                if volume == self.name and field == key:
-                    break
-            except ValueError:
-                continue
-
-            value = None
-
+        value = self.property_cache.lookup(self.name, key)
         if value in (None, 'none',):
             return None
 
@@ -178,10 +193,31 @@ class ZFS(object):
         elif value == None:
             value = 'none'
 
-        if skip_quotes:
-            execute(['zfs', 'set', '%s=%s' % (key, value), self.name])
-        else:
-            execute(['zfs', 'set', '%s="%s"' % (key, value), self.name])
+        try:
+            if skip_quotes:
+                execute(['zfs', 'set', '%s=%s' % (key, value), self.name])
+            else:
+                execute(['zfs', 'set', '%s="%s"' % (key, value), self.name])
+        finally:
+            # Children may inherit the property
+            self.property_cache.invalidate(self.name)
+
+    def rename(self, name):
+        """Rename filesystem
+
+        Rename this filesystem to given name
+
+        """
+        try:
+            execute(['zfs', 'rename', self.name, name])
+        finally:
+            self.property_cache.invalidate(self.name)
+            self.snapshot_index().invalidate()
+
+        self.name = name
+        if self.pool is None:
+            self.property_cache.target = name
+            self.snapshot_index().target = name
 
     def create_snapshot(self, tag=None):
         """Create named snapshots
@@ -197,7 +233,12 @@ class ZFS(object):
         if name in self.snapshots:
             raise ZFSError('Snapshot already exists: %s' % name)
 
-        execute('zfs snapshot %s' % name)
+        try:
+            execute('zfs snapshot %s' % name)
+        finally:
+            # Space used by snapshots changed, children are not affected
+            self.property_cache.invalidate(self.name, children=False)
+        self.snapshot_index().add(ZFSSnapshot(name, creation=int(time.time())))
         return tag
 
     def remove_snapshot(self, value):
@@ -214,7 +255,30 @@ class ZFS(object):
         elif isinstance(value, ZFSSnapshot):
             name = value.name
 
-        execute('zfs destroy %s' % name)
+        try:
+            execute('zfs destroy %s' % name)
+        finally:
+            self.property_cache.invalidate(self.name, children=False)
+        self.snapshot_index().remove(ZFSSnapshot(name))
+
+    def rename_snapshot(self, value, name):
+        """Rename existing snapshot
+
+        Rename snapshot matching provided tag or ZFSSnapshot to new tag
+
+        Raises ZFSError if provided snapshot did not exist
+        """
+        if isinstance(value, basestring):
+            snapshot = self.get_snapshot(value)
+            if snapshot is None:
+                raise ZFSError('No such snapshot: %s@%s' % (self.name, value))
+        else:
+            snapshot = value
+
+        try:
+            snapshot.rename(name)
+        finally:
+            self.snapshot_index().invalidate()
 
     def get_snapshot(self, name):
         """Lookup snapshot by name
@@ -222,10 +286,7 @@ class ZFS(object):
         Return snapshot by name, or None if snapshot was not defined
 
         """
-        for snapshot in self.snapshots:
-            if snapshot.name == name:
-                return snapshot
-        return None
+        return self.snapshots.get(name)
 
     def filter_snapshots(self, start, stop, date_format=SNAPSHOT_DATE_FORMAT):
         """Filter snapshots by date
@@ -245,8 +306,12 @@ class ZFS(object):
         if start > stop:
             raise ZFSError('Invalid date range: start is after stop')
 
-        snapshots = []
-        for snapshot in self.snapshots:
+        snapshots = self.snapshots
+        if date_format == snapshots.date_format:
+            return snapshots.filter(start, stop)
+
+        matches = []
+        for snapshot in snapshots:
             try:
                 ss_date = datetime.strptime(snapshot.tag, date_format)
             except ValueError:
@@ -254,29 +319,96 @@ class ZFS(object):
                 continue
 
             if ss_date >= start and ss_date <= stop:
-                snapshots.append(snapshot)
+                matches.append(snapshot)
 
-        return snapshots
+        return matches
 
-    def clone_to_pool(self, pool, tag, force=False):
-        """Clone filesystem to other pool
+    def target_name(self, pool):
+        """Target filesystem name
+
+        Return name of this filesystem when received to pool with
+        zfs receive -d
 
-        Clone this filesystem to target zpool
         """
+        source_pool = self.pool is not None and self.pool.name or self.name.split('/')[0]
+        return '%s%s' % (pool.name, self.name[len(source_pool):])
 
-        if self.snapshots:
-            latest = '%s' % self.snapshots[-1]
-            self.create_snapshot(tag)
-            src_args = ['zfs', 'send', '-i', latest, '%s@%s' % (self.name, tag)]
-        else:
-            self.create_snapshot(tag)
-            src_args = ['zfs', 'send', '%s@%s' % (self.name, tag)]
+    def resume_token(self, pool):
+        """Receive resume token
 
-        if force:
-            dst_args = ['zfs', 'receive', '-Fd', pool.name]
-        else:
-            dst_args = ['zfs', 'receive', '-d', pool.name]
+        Return receive_resume_token of this filesystem in target pool, or None
+        if there is no interrupted stream or target does not exist
+
+        """
+        try:
+            # Targets not in the loaded cache have no interrupted streams,
+            # unless they were invalidated by clone_to_pool
+            value = pool.filesystem_properties.lookup(
+                self.target_name(pool), 'receive_resume_token', load_missing=False
+            )
+        except ZFSError:
+            return None
+
+        if value in (None, '', '-'):
+            return None
+        return value
+
+    def latest_common_snapshot(self, pool):
+        """Latest common snapshot
+
+        Return newest snapshot of this filesystem that also exists in target
+        pool, or None. Uses the snapshot indexes of both pools.
+
+        """
+        target = pool.snapshot_index().snapshots(self.target_name(pool))
+        return self.snapshots.latest_common(target)
+
+    def replication(self, pool, tag, force=False, intermediate=False, resumable=True, **kwargs):
+        """Prepare replication to other pool
+
+        Create snapshot with tag and return ZFSReplication to send it to target
+        zpool, incrementally from the newest snapshot already in target. With
+        intermediate=True snapshots between the common snapshot and tag are
+        sent as well.
 
-        src = Popen(src_args, stdout=PIPE)
-        dst = Popen(dst_args, stdin= src.stdout, stdout=PIPE)
-        output = dst.communicate()[0]
+        If target has a receive_resume_token from an interrupted stream, that
+        stream is resumed first and used as the incremental base.
+
+        Other keyword arguments are passed to ZFSReplication.
+
+        """
+        base = self.latest_common_snapshot(pool)
+        base = base is not None and base.name or None
+
+        token = self.resume_token(pool)
+        if token is not None:
+            resumed = resume_token_snapshot(token)
+            if resumed is not None and self.snapshots.get(resumed) is not None:
+                base = resumed
+
+        self.create_snapshot(tag)
+
+        return ZFSReplication('%s@%s' % (self.name, tag), pool.name,
+            incremental=base,
+            intermediate=intermediate,
+            force=force,
+            resumable=resumable,
+            resume_token=token,
+            **kwargs
+        )
+
+    def clone_to_pool(self, pool, tag, force=False, **kwargs):
+        """Clone filesystem to other pool
+
+        Clone this filesystem to target zpool. Returns the finished
+        ZFSReplication with transfer counters.
+
+        Raises ZFSError if zfs send or zfs receive fails.
+        """
+        replication = self.replication(pool, tag, force=force, **kwargs)
+        try:
+            replication.run()
+        finally:
+            pool.filesystem_properties.invalidate(self.target_name(pool))
+            pool.snapshot_index().invalidate()
+        return replication
@@ -3,10 +3,14 @@ Zpool API
 """
 
 import logging
+import time
 from datetime import datetime, timedelta
 
-from ultimatum.zfs import execute, ZFSError, SNAPSHOT_DATE_FORMAT
+from ultimatum.zfs import execute, execute_parallel, iter_execute, wait_commands, ZFSError
+from ultimatum.zfs import SNAPSHOT_DATE_FORMAT, PROPERTY_CACHE_TTL, COMMAND_WORKERS
 from ultimatum.zfs.zfs import execute, ZFS
+from ultimatum.zfs.properties import ZFSPropertyCache, ZPoolPropertyCache
+from ultimatum.zfs.snapshots import ZFSSnapshot, ZFSSnapshotIndex, ZFSSnapshotResults
 
 ZPOOL_READONLY_PROPERTIES = (
     'allocated',
@@ -56,6 +60,14 @@ ZPOOL_PROPERTY_VALIDATORS = {
 }
 ZPOOL_PROPERTIES = ZPOOL_READONLY_PROPERTIES + ZPOOL_BOOLEAN_PROPERTIES + ZPOOL_STRING_PROPERTIES
 
+SNAPSHOT_MODES = (
+    'recursive',
+    'batch',
+    'parallel',
+)
+# Maximum number of snapshot names given to one zfs snapshot command
+SNAPSHOT_BATCH_SIZE = 256
+
 logger = logging.getLogger(__name__)
 
 def poolnames():
@@ -64,23 +76,71 @@ def poolnames():
     Return list of ZPool names
 
     """
-    names = []
-    for line in execute('zpool list -H'):
-        names.append(line.split()[0])
-    return names
+    return [record[0] for record in iter_execute('zpool list -H -o name')]
+
+def load_pools(names=None, timeout=None):
+    """Load pools in parallel
+
+    Return list of ZPool objects for given pool names, by default all pools,
+    with properties and snapshot indexes loaded with background commands
+
+    """
+    if names is None:
+        names = poolnames()
+
+    pools = [ZPool(name) for name in names]
+    commands = []
+    for pool in pools:
+        commands.extend(pool.load_async(timeout))
+    wait_commands(commands, timeout)
+
+    return pools
 
 class ZPool(object):
     """ZPool object
 
     Abstraction of zpool commands for python
 
+    Pool and filesystem properties are cached for property_ttl seconds.
+
     """
-    def __init__(self, name):
+    def __init__(self, name, property_ttl=PROPERTY_CACHE_TTL):
         self.name = name
+        self._snapshot_index = None
+        self.properties = ZPoolPropertyCache(name, ttl=property_ttl)
+        self.filesystem_properties = ZFSPropertyCache(name, ttl=property_ttl)
 
     def __repr__(self):
         return 'zpool %s' % self.name
 
+    def snapshot_index(self, refresh=False):
+        """Snapshot index
+
+        Return ZFSSnapshotIndex for all filesystems in this pool. The index is
+        loaded with one recursive zfs list command on first access and kept
+        until refreshed.
+
+        """
+        if self._snapshot_index is None:
+            self._snapshot_index = ZFSSnapshotIndex(self.name)
+        if refresh:
+            self._snapshot_index.load()
+        return self._snapshot_index
+
+    def load_async(self, timeout=None):
+        """Load pool data in background
+
+        Start loading pool properties, filesystem properties and snapshot
+        index with background commands. Returns list of running ZFSCommand
+        objects.
+
+        """
+        return [
+            self.properties.load_async(timeout),
+            self.filesystem_properties.load_async(timeout),
+            self.snapshot_index().load_async(timeout),
+        ]
+
     def get_property(self, property):
         """Return property value
 
@@ -90,7 +150,7 @@ class ZPool(object):
         if property not in ZPOOL_PROPERTIES:
             raise ZFSError('Invalid property name')
 
-        value = ' '.join(execute('zpool list -H -o %s %s' % (property, self.name)))
+        value = self.properties.lookup(self.name, property)
 
         if value == '-' and property in ZPOOL_OPTIONAL_PROPERTIES:
             return None
@@ -125,7 +185,10 @@ class ZPool(object):
         elif value == None:
             value = 'none'
 
-        execute(['zpool', 'set', '%s="%s"' % (property, value), self.name])
+        try:
+            execute(['zpool', 'set', '%s="%s"' % (property, value), self.name])
+        finally:
+            self.properties.invalidate()
 
     @property
     def is_available(self):
@@ -146,7 +209,16 @@ class ZPool(object):
         Return list of ZFS objects for filesystems in this pool
 
         """
-        return [ZFS(fs) for fs in execute('zfs list -Hr -o name %s' % self.name) if fs!='']
+        return list(self.iter_filesystems())
+
+    def iter_filesystems(self):
+        """Iterate filesystems
+
+        Yield ZFS objects for filesystems in this pool while zfs list runs
+
+        """
+        for record in iter_execute('zfs list -Hr -o name %s' % self.name):
+            yield ZFS(record[0], pool=self)
 
     def import_pool(self):
         """Import zpool
@@ -155,6 +227,7 @@ class ZPool(object):
 
         """
         execute('zpool import %s' % self.name)
+        self.invalidate()
 
     def export_pool(self):
         """Export zpool
@@ -163,19 +236,106 @@ class ZPool(object):
 
         """
         execute('zpool export %s' % self.name)
+        self.invalidate()
+
+    def invalidate(self):
+        """Invalidate cached data
+
+        Force reloading of cached properties and snapshots on next lookup
 
-    def create_snapshots(self, tag=None):
+        """
+        self.properties.invalidate()
+        self.filesystem_properties.invalidate()
+        if self._snapshot_index is not None:
+            self._snapshot_index.invalidate()
+
+    def create_snapshots(self, tag=None, mode='batch', filesystems=None, root=None,
+                         batch_size=SNAPSHOT_BATCH_SIZE, workers=COMMAND_WORKERS):
         """Create snapshots
 
-        Attempt to create named snapshots for all filesystems in this pool
+        Attempt to create named snapshots for filesystems in this pool. Returns
+        ZFSSnapshotResults with error for each failed snapshot name.
+
+        Supported modes are:
+        recursive   one atomic zfs snapshot -r command for root dataset (by
+                    default the pool) and all its descendants
+        batch       snapshots of filesystems created with batch_size names
+                    per zfs snapshot command, each batch created atomically
+        parallel    one zfs snapshot command per filesystem, run with a pool
+                    of workers
+
+        Filesystems can be a list of ZFS objects or filesystem names, by
+        default all filesystems in the pool. Batches that fail are retried
+        in parallel mode to find which snapshots failed. Recursive mode
+        always snapshots all descendants of root, and raises ZFSError if
+        filesystems is given or root is not a filesystem in this pool.
 
         If tag is not provided, we use a timestamp with SNAPSHOT_DATE_FORMAT
 
         """
+        if mode not in SNAPSHOT_MODES:
+            raise ZFSError('Invalid snapshot mode: %s' % mode)
+
         if tag is None:
             tag = datetime.now().strftime(SNAPSHOT_DATE_FORMAT)
-        for fs in self.filesystems:
-            fs.create_snapshot(tag)
+
+        results = ZFSSnapshotResults()
+        if mode == 'recursive':
+            if filesystems is not None:
+                raise ZFSError('Filesystems can not be selected in recursive snapshot mode')
+            root = root is not None and root or self.name
+            filesystems = [fs.name for fs in self.filesystems]
+            if root not in filesystems:
+                raise ZFSError('No such filesystem in pool %s: %s' % (self.name, root))
+            names = [
+                '%s@%s' % (name, tag) for name in filesystems
+                if name == root or name.startswith('%s/' % root)
+            ]
+            try:
+                execute(['zfs', 'snapshot', '-r', '%s@%s' % (root, tag)])
+                error = None
+            except ZFSError, emsg:
+                error = '%s' % emsg
+            results.update((name, error) for name in names)
+            results['%s@%s' % (root, tag)] = error
+            self.filesystem_properties.invalidate(root)
+            self.snapshot_index().invalidate()
+            return results
+
+        if filesystems is None:
+            filesystems = self.filesystems
+        names = []
+        index = self.snapshot_index()
+        for fs in filesystems:
+            name = '%s@%s' % (isinstance(fs, ZFS) and fs.name or fs, tag)
+            if index.get_snapshot(name) is not None:
+                results[name] = 'Snapshot already exists: %s' % name
+            else:
+                names.append(name)
+
+        pending = names
+        if mode == 'batch':
+            pending = []
+            for i in range(0, len(names), batch_size):
+                batch = names[i:i+batch_size]
+                try:
+                    execute(['zfs', 'snapshot'] + batch)
+                    results.update((name, None) for name in batch)
+                except ZFSError:
+                    pending.extend(batch)
+
+        errors = execute_parallel([['zfs', 'snapshot', name] for name in pending], workers)
+        for name, error in zip(pending, errors):
+            results[name] = error is not None and '%s' % error or None
+
+        now = int(time.time())
+        for name in names:
+            if results[name] is None:
+                snapshot = ZFSSnapshot(name, creation=now)
+                index.add(snapshot)
+                self.filesystem_properties.invalidate(snapshot.volume, children=False)
+
+        return results
 
     def filter_snapshots(self, start, stop, date_format=SNAPSHOT_DATE_FORMAT):
         """Filter snapshots by name